@@ -0,0 +1,344 @@
+# appointments/agenda.py
+"""
+Escritura de reservas sin carreras.
+
+Dos pacientes que reservan el mismo hueco a la vez deben terminar con una
+reserva y un conflicto, nunca con dos reservas solapadas. Para eso la
+comprobación de solapamiento y el INSERT/UPDATE se hacen en una transacción
+que tiene bloqueada la agenda del doctor:
+
+- PostgreSQL: `pg_advisory_xact_lock` por doctor (no bloquea la fila del
+  doctor para otras ediciones y se libera solo al terminar la transacción).
+- Otros motores con SELECT ... FOR UPDATE: la fila del doctor.
+- SQLite (sin bloqueos de fila): el bloqueo de escritura de la base, tomado
+  al abrir la transacción como haría BEGIN IMMEDIATE, más un candado por
+  doctor dentro del proceso. El primero es el que protege entre procesos
+  (varios workers de gunicorn), pero es de toda la base: en SQLite las
+  escrituras de agenda de todos los doctores se serializan. Es aceptable en
+  desarrollo o con un solo nodo; en producción con varios workers, PostgreSQL.
+
+En PostgreSQL y los motores con bloqueos de fila solo se serializan las
+reservas del mismo doctor.
+
+Mientras confirma, un paciente puede retener un hueco (ReservaTemporal)
+durante RESERVA_TEMPORAL_TTL segundos: cuenta como ocupado para los demás y
+se consume al reservar dentro de la misma transacción.
+"""
+
+import time
+
+import threading
+import weakref
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .disponibilidad_cache import invalidar_disponibilidad
+from .models import Doctor, HorarioTemplateItem, Reserva, ReservaTemporal
+
+# Espacio de nombres de los advisory locks de agenda en PostgreSQL
+ADVISORY_LOCK_NAMESPACE = 7001
+# Duración máxima de una reserva; acota la ventana de la consulta de solapes
+MAX_DURACION_MIN = getattr(settings, "RESERVA_MAX_DURACION_MIN", 8 * 60)
+# Segundos que dura una reserva temporal
+TEMPORAL_TTL = getattr(settings, "RESERVA_TEMPORAL_TTL", 300)
+# Cada cuántos segundos, como mucho, se barren las temporales vencidas
+BARRIDO_INTERVALO = getattr(settings, "RESERVA_TEMPORAL_BARRIDO", 60)
+
+
+class ConflictoReserva(Exception):
+    """El horario pedido se solapa con otra reserva del doctor."""
+
+
+class DuracionInvalida(Exception):
+    """La duración de la reserva no está entre 1 y MAX_DURACION_MIN minutos."""
+
+
+class HorarioInvalido(Exception):
+    """El horario pedido ya pasó o cae fuera de la plantilla activa del doctor."""
+
+
+# Un candado por doctor mientras alguien lo tenga o lo espere: las referencias
+# débiles dejan que desaparezca después, así que no crece con cada doctor.
+_candados = weakref.WeakValueDictionary()
+_candados_lock = threading.Lock()
+
+
+def _candado_local(doctor_id):
+    with _candados_lock:
+        candado = _candados.get(doctor_id)
+        if candado is None:
+            candado = _candados[doctor_id] = threading.Lock()
+        return candado
+
+
+def _bloquear_escritura_sqlite():
+    """
+    Toma el bloqueo de escritura (RESERVED) de SQLite ya, en lugar de al
+    primer INSERT/UPDATE: un UPDATE que no toca filas basta. Equivale a abrir
+    con BEGIN IMMEDIATE, pero funciona también dentro de una transacción ya
+    abierta. Otro proceso que quiera escribir espera hasta el commit.
+    """
+    tabla = connection.ops.quote_name(Doctor._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {tabla} SET id = id WHERE 0")
+
+
+@contextmanager
+def agendas_bloqueadas(doctor_ids):
+    """
+    Abre una transacción con las agendas de los doctores bloqueadas hasta el
+    commit. Se bloquean siempre en orden de id para que dos lotes que
+    comparten doctores no se esperen mutuamente. Las reservas de otros
+    doctores no esperan, salvo en SQLite (ver el docstring del módulo).
+    """
+    doctor_ids = sorted(set(doctor_ids))
+    with ExitStack() as pila:
+        # Sin bloqueos de fila en la base, el candado del proceso debe cubrir
+        # también el commit, así que se toma fuera de la transacción.
+        if not connection.features.has_select_for_update:
+            for doctor_id in doctor_ids:
+                pila.enter_context(_candado_local(doctor_id))
+        pila.enter_context(transaction.atomic())
+        if connection.vendor == "sqlite":
+            # Los candados del proceso no ven a los demás workers; una base
+            # en memoria, en cambio, no la abre ningún otro proceso
+            if not connection.is_in_memory_db():
+                _bloquear_escritura_sqlite()
+        elif connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                for doctor_id in doctor_ids:
+                    cursor.execute(
+                        "SELECT pg_advisory_xact_lock(%s, %s)",
+                        [ADVISORY_LOCK_NAMESPACE, doctor_id],
+                    )
+        elif connection.features.has_select_for_update and doctor_ids:
+            list(
+                Doctor.objects.select_for_update()
+                .filter(pk__in=doctor_ids)
+                .order_by("pk")
+                .values_list("pk")
+            )
+        yield
+
+
+def agenda_bloqueada(doctor_id):
+    """Abre una transacción con la agenda del doctor bloqueada hasta el commit."""
+    return agendas_bloqueadas([doctor_id])
+
+
+def filtro_solape(inicio, fin):
+    """
+    Reservas que se solapan con [inicio, fin): empiezan antes de `fin` y
+    terminan después de `inicio`. La cota inferior sobre fecha_hora no cambia
+    el resultado (ninguna reserva dura más de MAX_DURACION_MIN) pero acota el
+    recorrido del índice (doctor, fecha_hora, fecha_fin).
+    """
+    return Q(
+        fecha_hora__lt=fin,
+        fecha_fin__gt=inicio,
+        fecha_hora__gt=inicio - timedelta(minutes=MAX_DURACION_MIN),
+    )
+
+
+def reservas_solapadas(doctor_id, inicio, duracion_min, excluir_id=None):
+    """
+    Ids de las reservas no canceladas del doctor que se solapan con
+    [inicio, inicio + duracion_min), resuelto por completo en la base.
+    """
+    fin = inicio + timedelta(minutes=duracion_min)
+    solapadas = (
+        Reserva.objects.filter(filtro_solape(inicio, fin), doctor_id=doctor_id)
+        .exclude(estado="cancelada")
+        .values_list("id", flat=True)
+    )
+    if excluir_id is not None:
+        solapadas = solapadas.exclude(pk=excluir_id)
+    return list(solapadas)
+
+
+def temporales_solapadas(doctor_id, inicio, fin, excluir_paciente_id=None):
+    """
+    Ids de las reservas temporales vigentes del doctor que se solapan con
+    [inicio, fin). Las de `excluir_paciente_id` no cuentan: lo propio nunca
+    bloquea al mismo paciente.
+    """
+    temporales = ReservaTemporal.objects.filter(
+        filtro_solape(inicio, fin), doctor_id=doctor_id, expira_en__gt=timezone.now()
+    )
+    if excluir_paciente_id is not None:
+        temporales = temporales.exclude(paciente_id=excluir_paciente_id)
+    return list(temporales.values_list("id", flat=True))
+
+
+_ultimo_barrido = 0.0
+
+
+def barrer_temporales_vencidas(forzar=False):
+    """
+    Borra todas las reservas temporales vencidas con un único DELETE. Las
+    consultas ya ignoran las vencidas (expiración perezosa), así que esto solo
+    mantiene la tabla pequeña; sin `forzar` corre como mucho cada
+    BARRIDO_INTERVALO segundos por proceso. Devuelve cuántas borró.
+    """
+    global _ultimo_barrido
+    ahora = time.monotonic()
+    if not forzar and ahora - _ultimo_barrido < BARRIDO_INTERVALO:
+        return 0
+    _ultimo_barrido = ahora
+    borradas, _ = ReservaTemporal.objects.filter(expira_en__lte=timezone.now()).delete()
+    return borradas
+
+
+def _validar_duracion(duracion_min):
+    if not 0 < duracion_min <= MAX_DURACION_MIN:
+        raise DuracionInvalida(
+            f"La duración debe estar entre 1 y {MAX_DURACION_MIN} minutos."
+        )
+
+
+def _minutos(hora):
+    return hora.hour * 60 + hora.minute
+
+
+def _validar_horario(doctor_id, fecha_hora, duracion_min):
+    """
+    El tramo debe ser futuro y quedar cubierto por los bloques de la
+    plantilla activa del doctor (los bloques contiguos cuentan como uno).
+    """
+    if fecha_hora <= timezone.now():
+        raise HorarioInvalido("No se puede retener un horario que ya pasó.")
+    local = timezone.localtime(fecha_hora)
+    inicio = _minutos(local)
+    cubierto = inicio
+    for hora_inicio, hora_fin in (
+        HorarioTemplateItem.objects.filter(
+            template__doctor_id=doctor_id,
+            template__es_activo=True,
+            activo=True,
+            dia_semana=local.weekday(),
+        )
+        .order_by("hora_inicio")
+        .values_list("hora_inicio", "hora_fin")
+    ):
+        if _minutos(hora_inicio) <= cubierto < _minutos(hora_fin):
+            cubierto = _minutos(hora_fin)
+    if cubierto < inicio + duracion_min:
+        raise HorarioInvalido(
+            "El horario seleccionado está fuera del horario de atención del doctor."
+        )
+
+
+def retener_horario(paciente_id, doctor_id, fecha_hora, duracion_min):
+    """
+    Retiene [fecha_hora, fecha_hora + duracion_min) para el paciente durante
+    TEMPORAL_TTL segundos. Un paciente retiene un solo hueco a la vez: la
+    retención anterior se libera. Lanza ConflictoReserva, DuracionInvalida o
+    HorarioInvalido.
+    """
+    _validar_duracion(duracion_min)
+    _validar_horario(doctor_id, fecha_hora, duracion_min)
+    barrer_temporales_vencidas()
+    fin = fecha_hora + timedelta(minutes=duracion_min)
+
+    with agenda_bloqueada(doctor_id):
+        if reservas_solapadas(doctor_id, fecha_hora, duracion_min) or (
+            temporales_solapadas(
+                doctor_id, fecha_hora, fin, excluir_paciente_id=paciente_id
+            )
+        ):
+            raise ConflictoReserva(
+                "El horario seleccionado ya no está disponible para este doctor."
+            )
+        anteriores = ReservaTemporal.objects.filter(paciente_id=paciente_id)
+        liberados = set(anteriores.values_list("doctor_id", flat=True))
+        anteriores.delete()
+        temporal = ReservaTemporal.objects.create(
+            paciente_id=paciente_id,
+            doctor_id=doctor_id,
+            fecha_hora=fecha_hora,
+            duracion_min=duracion_min,
+            expira_en=timezone.now() + timedelta(seconds=TEMPORAL_TTL),
+        )
+
+    invalidar_disponibilidad(doctor_id, *liberados)
+    return temporal
+
+
+def liberar_horario(paciente_id, temporal_id):
+    """Suelta una reserva temporal del paciente. Devuelve False si no existía."""
+    temporales = ReservaTemporal.objects.filter(pk=temporal_id, paciente_id=paciente_id)
+    doctor_ids = list(temporales.values_list("doctor_id", flat=True))
+    if not doctor_ids:
+        return False
+    temporales.delete()
+    invalidar_disponibilidad(*doctor_ids)
+    return True
+
+
+def guardar_reserva(serializer, temporal_id=None):
+    """
+    Guarda un ReservaSerializer ya validado (alta o edición) comprobando,
+    con la agenda del doctor bloqueada, que no pisa otra reserva ni un hueco
+    retenido por otro paciente. Las reservas temporales del paciente que
+    cubren ese horario (y `temporal_id`, si se indica) se consumen en la
+    misma transacción. Lanza ConflictoReserva o DuracionInvalida.
+    """
+    datos = serializer.validated_data
+    reserva = serializer.instance
+
+    def valor(campo):
+        if campo in datos:
+            return datos[campo]
+        if reserva is not None:
+            return getattr(reserva, campo)
+        return Reserva._meta.get_field(campo).get_default()
+
+    doctor = valor("doctor")
+    paciente = valor("paciente")
+    fecha_hora = valor("fecha_hora")
+    duracion_min = valor("duracion_min")
+    _validar_duracion(duracion_min)
+    fin = fecha_hora + timedelta(minutes=duracion_min)
+
+    # Cancelar nunca genera conflictos, pero los receptores de post_save
+    # (contadores, disponibilidad) deben confirmarse junto con el UPDATE
+    if valor("estado") == "cancelada":
+        with transaction.atomic():
+            return serializer.save()
+
+    with agenda_bloqueada(doctor.id):
+        if reservas_solapadas(
+            doctor.id,
+            fecha_hora,
+            duracion_min,
+            excluir_id=reserva.pk if reserva is not None else None,
+        ):
+            raise ConflictoReserva(
+                "El horario seleccionado ya no está disponible para este doctor."
+            )
+        if temporales_solapadas(
+            doctor.id, fecha_hora, fin, excluir_paciente_id=paciente.id
+        ):
+            raise ConflictoReserva(
+                "Otro paciente está confirmando este horario. Intente con otro."
+            )
+        reserva = serializer.save()
+
+        consumidas = ReservaTemporal.objects.filter(
+            filtro_solape(fecha_hora, fin), doctor_id=doctor.id
+        )
+        if temporal_id is not None:
+            consumidas = consumidas | ReservaTemporal.objects.filter(pk=temporal_id)
+        consumidas = consumidas.filter(paciente_id=paciente.id)
+        # `temporal_id` puede ser de otro doctor; la señal de Reserva solo
+        # invalida el cache del doctor reservado
+        liberados = set(consumidas.values_list("doctor_id", flat=True)) - {doctor.id}
+        consumidas.delete()
+
+    invalidar_disponibilidad(*liberados)
+    return reserva
@@ -15,6 +15,7 @@ from ..serializers import (
     PacienteUpdateSerializer,
     DoctorUpdateSerializer,
 )
+from ..principal import get_auth0_id, get_principal, invalidate_principal
 
 
 class CustomUserViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
@@ -36,6 +37,7 @@ class CustomUserViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             user.role = "doctor"
             user.is_staff = True
             user.save()
+            invalidate_principal(user.auth0_id)
             return Response(
                 {"status": f"Usuario {user.email} promovido a doctor."},
                 status=status.HTTP_200_OK,
@@ -58,6 +60,7 @@ class CustomUserViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
             user.role = "paciente"
             user.is_staff = False
             user.save()
+            invalidate_principal(user.auth0_id)
             return Response(
                 {"status": f"Usuario {user.email} degradado a paciente."},
                 status=status.HTTP_200_OK,
@@ -133,44 +136,27 @@ def sync_user(request):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def whoami(request):
-    auth0_user = request.user
-    print("🔹 whoami: request.user =", auth0_user)
-
-    # Extraer sub desde Auth0User
-    auth0_id = None
-    if hasattr(auth0_user, "payload"):  # caso Auth0User wrapper
-        auth0_id = auth0_user.payload.get("sub")
-    else:
-        auth0_id = getattr(auth0_user, "sub", None)
-
-    print("🔹 whoami: auth0_id extraído =", auth0_id)
-
-    if not auth0_id:
+    if not get_auth0_id(request.user):
         return Response({"detail": "No se pudo extraer auth0_id"}, status=400)
 
-    try:
-        user = CustomUser.objects.get(auth0_id=auth0_id)
-        print("🔹 whoami: CustomUser encontrado =", user, "| staff =", user.is_staff)
-    except CustomUser.DoesNotExist:
-        print("⚠️ whoami: CustomUser no encontrado")
+    user = get_principal(request)
+    if user is None:
         return Response({"detail": "Usuario no encontrado"}, status=404)
 
     # Determinar rol
     role = "paciente"
-    if getattr(user, "is_staff", False):
+    if user.is_staff:
         role = "admin"
-    elif hasattr(user, "doctor_profile"):
+    elif user.doctor_id is not None:
         role = "doctor"
-    elif hasattr(user, "paciente_profile"):
+    elif user.paciente_id is not None:
         role = "paciente"
 
-    print(f"✅ Rol asignado para {user.email}: {role}")
-
     return Response(
         {
             "email": user.email,
             "role": role,
-            "nombre": f"{user.first_name} {user.last_name}".strip() or user.email,
+            "nombre": user.nombre,
         }
     )
 
@@ -178,11 +164,8 @@ def whoami(request):
 @api_view(["PATCH"])
 @permission_classes([IsAuthenticated])
 def update_profile(request):
-    auth0_id = request.user.payload.get("sub")
-
-    try:
-        user = CustomUser.objects.get(auth0_id=auth0_id)
-    except CustomUser.DoesNotExist:
+    user = get_principal(request)
+    if user is None:
         return Response(
             {"error": "Usuario no encontrado en la base de datos."},
             status=status.HTTP_404_NOT_FOUND,
@@ -208,7 +191,7 @@ def update_profile(request):
     # The rest of the logic remains the same
     if user.role == "paciente":
         try:
-            profile = Paciente.objects.get(user=user)
+            profile = Paciente.objects.get(pk=user.paciente_id)
             serializer = PacienteUpdateSerializer(
                 profile, data=request.data, partial=True
             )
@@ -220,7 +203,7 @@ def update_profile(request):
 
     elif user.role == "doctor":
         try:
-            profile = Doctor.objects.get(user=user)
+            profile = Doctor.objects.get(pk=user.doctor_id)
             serializer = DoctorUpdateSerializer(
                 profile, data=request.data, partial=True
             )
@@ -2,18 +2,29 @@
 from django.shortcuts import get_object_or_404
 from django.db import transaction
 from django.utils import timezone
-from datetime import timedelta
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time, timedelta
 
 # DRF Imports
 from rest_framework import viewsets, filters, status, parsers, permissions
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from rest_framework.exceptions import APIException
 
 # Project-specific Imports
 from ..models import Doctor, CustomUser, Reserva, Procedimiento
-from ..serializers import DoctorSerializer, ReservaSerializer, ProcedimientoSerializer
+from ..serializers import (
+    DoctorSerializer,
+    ReservaSerializer,
+    ReservaCalendarioSerializer,
+    ProcedimientoSerializer,
+)
 from ..permissions import EsAdmin, EsDoctor
+from ..principal import get_principal
+from ..agenda import filtro_solape
+from ..estadisticas import resumen_doctor
+from ..pagination import KeysetPagination, ReservaKeysetPagination
 
 
 class DoctorViewSet(viewsets.ModelViewSet):
@@ -32,6 +43,7 @@ class DoctorViewSet(viewsets.ModelViewSet):
         "user__email",
         "especialidad",
     ]
+    pagination_class = KeysetPagination
 
     def get_permissions(self):
         # This method is now primarily for actions *without* explicit @action permission_classes
@@ -56,21 +68,17 @@ class DoctorViewSet(viewsets.ModelViewSet):
         Obtiene el perfil de un doctor por su dirección de correo electrónico.
         """
         try:
-            # Obtiene el CustomUser real del usuario que hace la petición
-            auth0_id_requesting_user = request.user.payload.get("sub")
-            requesting_custom_user = CustomUser.objects.get(
-                auth0_id=auth0_id_requesting_user
-            )
+            # El CustomUser real del usuario que hace la petición
+            requesting_user = get_principal(request)
+            if requesting_user is None:
+                raise CustomUser.DoesNotExist
 
             # Obtiene el CustomUser del email en la URL
             user_in_url = CustomUser.objects.get(email=email)
             doctor = Doctor.objects.get(user=user_in_url)
 
             # 💡 Capa de seguridad: un doctor solo puede ver su propio perfil
-            if (
-                not requesting_custom_user.is_staff
-                and requesting_custom_user.email != email
-            ):
+            if not requesting_user.is_staff and requesting_user.email != email:
                 return Response(
                     {"error": "No tiene permiso para ver el perfil de otro doctor."},
                     status=status.HTTP_403_FORBIDDEN,
@@ -108,15 +116,11 @@ class DoctorViewSet(viewsets.ModelViewSet):
             procedimientos_ids = request.data.get("procedimientos", [])
 
             # 💡 Capa de seguridad: un doctor solo puede modificar su propio perfil
-            auth0_id_requesting_user = request.user.payload.get("sub")
-            requesting_custom_user = CustomUser.objects.get(
-                auth0_id=auth0_id_requesting_user
-            )
+            requesting_user = get_principal(request)
+            if requesting_user is None:
+                raise CustomUser.DoesNotExist
 
-            if (
-                not requesting_custom_user.is_staff
-                and requesting_custom_user.doctor_profile.id != int(pk)
-            ):
+            if not requesting_user.is_staff and requesting_user.doctor_id != int(pk):
                 return Response(
                     {
                         "error": "No tiene permiso para modificar los procedimientos de otro doctor."
@@ -153,20 +157,12 @@ def doctor_stats(request):
     Vista para obtener estadísticas de citas y pacientes para un doctor.
     """
     try:
-        # Get the CustomUser from the authenticated request
-        auth0_id = request.user.payload.get("sub")
-        custom_user = CustomUser.objects.get(auth0_id=auth0_id)
-
-        # Get the Doctor profile from the CustomUser
-        doctor_profile = Doctor.objects.get(user=custom_user)
+        # Doctor profile of the authenticated user (resolved once per request)
+        principal = get_principal(request)
+        if principal is None or principal.doctor_id is None:
+            raise Doctor.DoesNotExist
+        doctor_id = principal.doctor_id
 
-        # 1. Correctly filter for PENDING appointments of THIS DOCTOR
-        # Use a single, clear filter
-        citas_pendientes = Reserva.objects.filter(
-            doctor=doctor_profile, estado="pendiente", fecha_hora__gte=timezone.now()
-        ).count()
-
-        # 2. Appointments for THIS WEEK for THIS DOCTOR
         week_offset = int(request.GET.get("week_offset", 0))
         today = timezone.now().date()
         start_of_week = (
@@ -174,23 +170,9 @@ def doctor_stats(request):
         )
         end_of_week = start_of_week + timedelta(days=6)
 
-        citas_semana = Reserva.objects.filter(
-            doctor=doctor_profile, fecha_hora__date__range=[start_of_week, end_of_week]
-        ).count()
-
-        # 3. Total unique patients for THIS DOCTOR
-        total_pacientes = (
-            Reserva.objects.filter(doctor=doctor_profile)
-            .values("paciente")
-            .distinct()
-            .count()
-        )
-
-        data = {
-            "citas_pendientes": citas_pendientes,
-            "citas_semana": citas_semana,
-            "total_pacientes": total_pacientes,
-        }
+        # Pendientes futuras, citas de la semana y pacientes distintos del
+        # doctor en una sola consulta (ver estadisticas.py)
+        data = resumen_doctor(doctor_id, start_of_week, end_of_week)
 
         return Response(data, status=status.HTTP_200_OK)
 
@@ -203,27 +185,82 @@ def doctor_stats(request):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+MAX_VENTANA_CALENDARIO = timedelta(days=92)
+
+
+def _parse_limite(value):
+    """Acepta una fecha (YYYY-MM-DD, medianoche local) o un datetime ISO."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated, EsDoctor])
 def doctor_reservas(request):
     """
     Vista para obtener las reservas del DOCTOR actual para el calendario.
+
+    Con `start` y `end` devuelve solo las reservas de esa ventana
+    ([start, end)) en formato compacto; sin ellos, todas paginadas.
     """
     try:
-        auth0_id = request.user.payload.get("sub")
-        custom_user = CustomUser.objects.get(auth0_id=auth0_id)
-        doctor_profile = Doctor.objects.get(user=custom_user)
+        principal = get_principal(request)
+        if principal is None or principal.doctor_id is None:
+            raise Doctor.DoesNotExist
+        doctor_id = principal.doctor_id
+
+        start = request.query_params.get("start")
+        end = request.query_params.get("end")
+        if start or end:
+            try:
+                start, end = _parse_limite(start or ""), _parse_limite(end or "")
+            except ValueError:
+                return Response(
+                    {
+                        "error": "Debe indicar 'start' y 'end' como YYYY-MM-DD o ISO 8601."
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if end <= start or end - start > MAX_VENTANA_CALENDARIO:
+                return Response(
+                    {"error": "La ventana debe ser positiva y de como máximo 92 días."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            # Reservas que se solapan con la ventana, resuelto sobre el
+            # índice (doctor, fecha_hora, fecha_fin)
+            reservas = ReservaCalendarioSerializer.setup_eager_loading(
+                Reserva.objects.filter(
+                    filtro_solape(start, end), doctor_id=doctor_id
+                ).order_by("fecha_hora", "id")
+            )
+            serializer = ReservaCalendarioSerializer(reservas, many=True)
+            return Response(serializer.data, status=status.HTTP_200_OK)
 
         # 4. Filter appointments by doctor and show all (pending and confirmed) for the calendar
-        reservas = Reserva.objects.filter(doctor=doctor_profile).order_by("fecha_hora")
-        serializer = ReservaSerializer(reservas, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        reservas = ReservaSerializer.setup_eager_loading(
+            Reserva.objects.filter(doctor_id=doctor_id)
+        )
+        paginator = ReservaKeysetPagination()
+        page = paginator.paginate_queryset(reservas, request)
+        serializer = ReservaSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     except (CustomUser.DoesNotExist, Doctor.DoesNotExist):
         return Response(
             {"error": "No se encontró el perfil de doctor."},
             status=status.HTTP_404_NOT_FOUND,
         )
+    except APIException:
+        # p. ej. cursor inválido: DRF construye la respuesta adecuada
+        raise
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -243,15 +280,11 @@ class ProcedimientoViewSet(viewsets.ModelViewSet):
             return [permissions.IsAuthenticated()]
 
         # Get the CustomUser from the authenticated request to check the 'is_staff' attribute
-        try:
-            auth0_id = self.request.user.payload.get("sub")
-            user = CustomUser.objects.get(auth0_id=auth0_id)
-            if user.is_staff:
-                return [
-                    permissions.IsAuthenticated()
-                ]  # Return success if they are a staff member
-        except (CustomUser.DoesNotExist, AttributeError):
-            pass  # Continue to the final return statement to deny access
+        principal = get_principal(self.request)
+        if principal is not None and principal.is_staff:
+            return [
+                permissions.IsAuthenticated()
+            ]  # Return success if they are a staff member
 
         # Deny access if the user is not a staff member
         return [permissions.IsAdminUser()]
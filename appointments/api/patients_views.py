@@ -11,47 +11,35 @@ from rest_framework.response import Response
 from ..models import Paciente, CustomUser
 from ..serializers import PacienteSerializer
 from ..permissions import EsAdmin
+from ..principal import get_principal
+from ..pagination import KeysetPagination
 
 
 class PacienteViewSet(viewsets.ModelViewSet):
     serializer_class = PacienteSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ["user__first_name", "user__last_name", "user__email"]
+    pagination_class = KeysetPagination
 
     def get_permissions(self):
-        user = getattr(self.request, "user", None)
-        if user and getattr(user, "is_staff", False):
+        principal = get_principal(self.request)
+        if principal is not None and principal.is_staff:
             return [EsAdmin()]
         return [IsAuthenticated()]
 
     def get_queryset(self):
-        user = self.request.user
+        principal = get_principal(self.request)
 
-        if not user.is_authenticated:
+        if principal is None:
             return Paciente.objects.none()
 
-        if getattr(user, "is_staff", False):
+        if principal.is_staff:
             # Solo los administradores pueden ver todos los pacientes
             # Filtramos para asegurar que solo los pacientes con un usuario válido sean devueltos
-            queryset = Paciente.objects.filter(user__isnull=False)
-            print(
-                f"DEBUG: PacienteViewSet get_queryset encontró {queryset.count()} pacientes."
-            )
-            return queryset
+            return Paciente.objects.filter(user__isnull=False)
 
         # Los pacientes solo pueden ver su propio perfil
-        # Primero, obtenemos el CustomUser de Django a partir del Auth0User
-        auth0_id = getattr(user, "username", None) or getattr(user, "payload", {}).get(
-            "sub"
-        )
-        if not auth0_id:
-            return Paciente.objects.none()
-
-        try:
-            custom_user = CustomUser.objects.get(auth0_id=auth0_id)
-            return Paciente.objects.filter(user=custom_user)
-        except CustomUser.DoesNotExist:
-            return Paciente.objects.none()
+        return Paciente.objects.filter(user_id=principal.id)
 
 
 @api_view(["GET"])
@@ -1,6 +1,7 @@
 # Django Imports
+from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.utils.timezone import now
+from django.utils.timezone import localdate, now
 from django.db.models import Count
 from datetime import datetime, timedelta, date
 
@@ -15,15 +16,56 @@ from django_filters.rest_framework import DjangoFilterBackend
 # Project-specific Imports
 from ..models import (
     Reserva,
-    Paciente,
     Doctor,
     CustomUser,
     Procedimiento,
     HorarioSemanalTemplate,
     HorarioDoctor,
 )
-from ..serializers import ReservaSerializer
+from ..serializers import ReservaSerializer, ReservaTemporalSerializer
+from ..agenda import (
+    ConflictoReserva,
+    DuracionInvalida,
+    HorarioInvalido,
+    filtro_solape,
+    guardar_reserva,
+    liberar_horario,
+    retener_horario,
+)
+from ..estadisticas import (
+    AGRUPACIONES,
+    cacheado,
+    resumen_admin,
+    series_reservas,
+    utilizacion,
+)
+from ..estados import ACTUALIZADA, MAX_LOTE, cambiar_estados
 from ..permissions import EsAdmin, EsDoctor, EsPaciente
+from ..principal import get_principal
+from ..fechas import rango_dias
+from ..disponibilidad import (
+    a_iso,
+    agrupar_items,
+    calcular_slots,
+    cargar_reservas,
+    cargar_temporales,
+    combinar_slots,
+    como_ocupadas,
+    expandir_bloques,
+    generar_slots,
+    intervalos_ocupados,
+    libres_materializados,
+    minuto_de,
+    minutos_del_dia,
+    proximos_slots,
+    reservas_ocupadas,
+    restar_intervalos,
+    slots_a_iso,
+    slots_por_doctor,
+)
+from ..disponibilidad_cache import clave_slots, guardar_slots, leer_slots
+from ..idempotencia import idempotente
+from ..pagination import ReservaKeysetPagination
 
 
 class ReservaViewSet(viewsets.ModelViewSet):
@@ -32,54 +74,166 @@ class ReservaViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_fields = ["paciente__id", "doctor__id", "estado"]
     search_fields = ["paciente__nombre", "doctor__nombre"]
+    pagination_class = ReservaKeysetPagination
 
     def get_permissions(self):
-        user = self.request.user
-
-        if self.action == "create":
+        if self.action in ["create", "retener", "liberar"]:
             return [EsPaciente()]
 
-        if self.action in ["update", "partial_update", "destroy"]:
-            if getattr(user, "is_staff", False):
+        if self.action in ["update", "partial_update", "destroy", "cambiar_estado"]:
+            principal = get_principal(self.request)
+            if principal is not None and principal.is_staff:
                 return [EsAdmin()]
-            elif hasattr(user, "doctor_profile"):
+            elif principal is not None and principal.doctor_id is not None:
                 return [EsDoctor()]
             return [EsPaciente()]
 
         return [IsAuthenticated()]
 
-    def get_queryset(self):
-        auth0_user = self.request.user
-        print("🔹 Auth0User:", auth0_user)
-
-        # 🔹 Extraer auth0_id correctamente
-        auth0_id = getattr(auth0_user, "username", None) or getattr(
-            auth0_user, "payload", {}
-        ).get("sub")
-        print("🔹 auth0_id extraído:", auth0_id)
-
-        if not auth0_id:
-            print("⚠️ No se pudo extraer auth0_id")
-            return Reserva.objects.none()
+    def reservas_visibles(self):
+        """Reservas que el usuario puede ver y modificar, sin joins."""
+        principal = get_principal(self.request)
 
-        try:
-            user = CustomUser.objects.get(auth0_id=auth0_id)
-            print("🔹 CustomUser encontrado:", user)
-        except CustomUser.DoesNotExist:
-            print("⚠️ CustomUser no encontrado")
+        if principal is None:
             return Reserva.objects.none()
 
-        if getattr(user, "is_staff", False):
+        if principal.is_staff:
             return Reserva.objects.all()
+        elif principal.doctor_id is not None:
+            return Reserva.objects.filter(doctor_id=principal.doctor_id)
+        elif principal.paciente_id is not None:
+            return Reserva.objects.filter(paciente_id=principal.paciente_id)
+        return Reserva.objects.none()
 
-        if hasattr(user, "doctor_profile"):
-            return Reserva.objects.filter(doctor__user=user)
+    def get_queryset(self):
+        return ReservaSerializer.setup_eager_loading(self.reservas_visibles())
+
+    @idempotente
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        error = self.guardar(
+            serializer, temporal_id=request.data.get("reserva_temporal_id")
+        )
+        if error is not None:
+            return error
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data, status=status.HTTP_201_CREATED, headers=headers
+        )
 
+    @idempotente
+    def update(self, request, *args, **kwargs):
+        # partial_update delega aquí, así que también queda cubierto
+        partial = kwargs.pop("partial", False)
+        instance = self.get_object()
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        error = self.guardar(serializer)
+        if error is not None:
+            return error
+        if getattr(instance, "_prefetched_objects_cache", None):
+            instance._prefetched_objects_cache = {}
+        return Response(serializer.data)
+
+    @idempotente
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)
+
+    def guardar(self, serializer, temporal_id=None):
+        """
+        Alta/edición con la agenda del doctor bloqueada (ver agenda.py).
+        Devuelve una Response de error o None si se guardó.
+        """
         try:
-            paciente = user.paciente_profile
-            return Reserva.objects.filter(paciente=paciente).order_by("fecha_hora")
-        except Paciente.DoesNotExist:
-            return Reserva.objects.none()
+            temporal_id = int(temporal_id) if temporal_id else None
+        except (TypeError, ValueError):
+            temporal_id = None
+        try:
+            guardar_reserva(serializer, temporal_id=temporal_id)
+        except ConflictoReserva as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except DuracionInvalida as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return None
+
+    @action(detail=False, methods=["post"], url_path="estado")
+    @idempotente
+    def cambiar_estado(self, request):
+        """
+        Cambia el estado de varias reservas en una sola transacción, con un
+        UPDATE por estado destino. Acepta `{"ids": [...], "estado": "..."}` o
+        `{"cambios": [{"id": ..., "estado": "..."}, ...]}` y devuelve el
+        resultado de cada id. Los pacientes solo pueden cancelar.
+        """
+        cambios, error = parse_cambios_estado(request.data)
+        if error is not None:
+            return error
+
+        principal = get_principal(request)
+        solo_cancelar = not principal.is_staff and principal.doctor_id is None
+        estados = {valor for valor, _ in Reserva.ESTADO_CHOICES}
+        resultados = {}
+        for pk, estado in cambios.items():
+            if estado not in estados:
+                resultados[pk] = "estado_invalido"
+            elif solo_cancelar and estado != "cancelada":
+                resultados[pk] = "no_permitido"
+
+        validos = {pk: estado for pk, estado in cambios.items() if pk not in resultados}
+        if validos:
+            resultados.update(cambiar_estados(self.reservas_visibles(), validos))
+
+        return Response(
+            {
+                "actualizadas": sum(1 for r in resultados.values() if r == ACTUALIZADA),
+                "resultados": [
+                    {"id": pk, "estado": cambios[pk], "resultado": resultados[pk]}
+                    for pk in cambios
+                ],
+            }
+        )
+
+    @action(detail=False, methods=["post"])
+    def retener(self, request):
+        """
+        Retiene un horario para el paciente durante RESERVA_TEMPORAL_TTL
+        segundos mientras confirma. Se consume al crear la reserva (opcionalmente
+        indicando `reserva_temporal_id`).
+        """
+        principal = get_principal(request)
+        serializer = ReservaTemporalSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        datos = serializer.validated_data
+        try:
+            temporal = retener_horario(
+                principal.paciente_id,
+                datos["doctor"].id,
+                datos["fecha_hora"],
+                datos.get("duracion_min", 30),
+            )
+        except ConflictoReserva as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except (DuracionInvalida, HorarioInvalido) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            ReservaTemporalSerializer(temporal).data, status=status.HTTP_201_CREATED
+        )
+
+    @action(
+        detail=False,
+        methods=["delete"],
+        url_path=r"retener/(?P<temporal_id>\d+)",
+    )
+    def liberar(self, request, temporal_id=None):
+        """Suelta antes de tiempo un horario retenido por el paciente."""
+        principal = get_principal(request)
+        if not liberar_horario(principal.paciente_id, temporal_id):
+            return Response(
+                {"error": "Reserva temporal no encontrada."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=["get"])
     def disponibilidad(self, request):
@@ -97,19 +251,125 @@ class ReservaViewSet(viewsets.ModelViewSet):
                 {"error": "Doctor o procedimiento no encontrado"}, status=404
             )
 
-        # Ejemplo simple: tomar horarios activos del doctor
-        slots = []
-        for horario in doctor.horarios.filter(activo=True, dia_semana__gte=0):
-            # Aquí podrías generar slots por hora o por duración de procedimiento
-            hora_actual = datetime.combine(datetime.today(), horario.hora_inicio)
-            hora_fin = datetime.combine(datetime.today(), horario.hora_fin)
-            while (
-                hora_actual + timedelta(minutes=procedimiento.duracion_min) <= hora_fin
-            ):
-                slots.append(hora_actual.isoformat())
-                hora_actual += timedelta(minutes=procedimiento.duracion_min)
+        try:
+            fecha_str = request.query_params.get("fecha")
+            fecha = date.fromisoformat(fecha_str) if fecha_str else localdate()
+        except ValueError:
+            return Response(
+                {"error": "Formato de fecha inválido. Use YYYY-MM-DD."}, status=400
+            )
+
+        # Horarios activos del doctor para ese día, menos sus reservas
+        bloques = [
+            (minutos_del_dia(hora_inicio), minutos_del_dia(hora_fin))
+            for hora_inicio, hora_fin in doctor.horarios.filter(
+                activo=True, dia_semana=fecha.weekday()
+            )
+            .order_by("hora_inicio")
+            .values_list("hora_inicio", "hora_fin")
+        ]
+        slots = calcular_slots(
+            bloques,
+            cargar_reservas([doctor.id], fecha, fecha)[doctor.id],
+            fecha,
+            procedimiento.duracion_min,
+            desde=minuto_de(now(), fecha),
+        )
+
+        return Response({"slots_disponibles": [a_iso(fecha, s) for s, _ in slots]})
+
+
+def parse_cambios_estado(data):
+    """
+    Lee el cuerpo de reservas/estado/ como {id: estado}. Devuelve
+    (cambios, None) o (None, Response) con el error 400 correspondiente.
+    """
+
+    def error(mensaje):
+        return None, Response({"error": mensaje}, status=status.HTTP_400_BAD_REQUEST)
+
+    if "cambios" in data:
+        items = data.get("cambios")
+        if not isinstance(items, list) or not all(
+            isinstance(item, dict) for item in items
+        ):
+            return error("'cambios' debe ser una lista de {id, estado}.")
+        pares = [(item.get("id"), item.get("estado")) for item in items]
+    else:
+        ids = data.get("ids")
+        if not isinstance(ids, list):
+            return error("Indique 'ids' y 'estado', o una lista 'cambios'.")
+        pares = [(pk, data.get("estado")) for pk in ids]
+
+    if not pares:
+        return error("No hay reservas que cambiar.")
+    if len(pares) > MAX_LOTE:
+        return error(f"Como máximo {MAX_LOTE} reservas por lote.")
+
+    cambios = {}
+    for pk, estado in pares:
+        if isinstance(pk, bool):
+            return error("Los ids deben ser enteros.")
+        try:
+            pk = int(pk)
+        except (TypeError, ValueError):
+            return error("Los ids deben ser enteros.")
+        if pk in cambios:
+            return error(f"La reserva {pk} aparece más de una vez.")
+        cambios[pk] = estado
+    return cambios, None
+
+
+# Límite del rango consultable en DisponibilidadView (un trimestre)
+MAX_DIAS_DISPONIBILIDAD = getattr(settings, "DISPONIBILIDAD_MAX_DIAS", 92)
+
+
+def parse_rango_fechas(request, max_dias=MAX_DIAS_DISPONIBILIDAD):
+    """
+    Lee `start_date`/`end_date` (YYYY-MM-DD; por defecto la semana actual) y
+    valida que el rango no supere `max_dias`. Devuelve
+    (start_date, end_date, None) o (None, None, Response) con el error 400
+    correspondiente.
+    """
+    start_date_str = request.query_params.get("start_date")
+    end_date_str = request.query_params.get("end_date")
+    try:
+        if start_date_str and end_date_str:
+            start_date = date.fromisoformat(start_date_str)
+            end_date = date.fromisoformat(end_date_str)
+        else:
+            # Si no se proporcionan fechas, usar la semana actual.
+            start_date = date.today()
+            end_date = start_date + timedelta(days=6)
+    except ValueError:
+        return (
+            None,
+            None,
+            Response(
+                {"error": "Formato de fecha inválido. Use YYYY-MM-DD."},
+                status=status.HTTP_400_BAD_REQUEST,
+            ),
+        )
 
-        return Response({"slots_disponibles": slots})
+    if end_date < start_date:
+        return (
+            None,
+            None,
+            Response(
+                {"error": "La fecha final debe ser posterior a la inicial."},
+                status=status.HTTP_400_BAD_REQUEST,
+            ),
+        )
+    if (end_date - start_date).days + 1 > max_dias:
+        return (
+            None,
+            None,
+            Response(
+                {"error": f"El rango no puede superar {max_dias} días."},
+                status=status.HTTP_400_BAD_REQUEST,
+            ),
+        )
+    return start_date, end_date, None
 
 
 class DisponibilidadView(APIView):
@@ -117,9 +377,6 @@ class DisponibilidadView(APIView):
         doctor_id = request.query_params.get("doctor_id")
         procedimiento_id = request.query_params.get("procedimiento_id")
 
-        start_date_str = request.query_params.get("start_date")
-        end_date_str = request.query_params.get("end_date")
-
         if not doctor_id or not procedimiento_id:
             return Response(
                 {"error": "Debe seleccionar un doctor y un procedimiento."},
@@ -133,86 +390,236 @@ class DisponibilidadView(APIView):
                 {"error": "El doctor no existe."}, status=status.HTTP_404_NOT_FOUND
             )
 
-        # Parsear las fechas desde los parámetros de la URL.
         try:
-            if start_date_str and end_date_str:
-                start_date = date.fromisoformat(start_date_str)
-                end_date = date.fromisoformat(end_date_str)
+            procedimiento = Procedimiento.objects.get(id=procedimiento_id)
+        except Procedimiento.DoesNotExist:
+            return Response(
+                {"error": "El procedimiento no existe."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        # Parsear las fechas desde los parámetros de la URL.
+        start_date, end_date, error = parse_rango_fechas(request)
+        if error is not None:
+            return error
+
+        incluir_bloques = request.query_params.get("incluir_bloques", "").lower() in (
+            "1",
+            "true",
+        )
+
+        # Slots cacheados por (doctor, versión, duración, rango): la versión
+        # del doctor cambia con cada escritura de sus reservas o plantillas.
+        clave = clave_slots(doctor.id, procedimiento.duracion_min, start_date, end_date)
+        slots = None if incluir_bloques else leer_slots(clave)
+
+        if slots is None:
+            # Las reservas temporales vigentes cuentan como ocupadas
+            temporales = cargar_temporales([doctor.id], start_date, end_date)[doctor.id]
+
+            # Camino rápido: tramos libres ya materializados en DisponibilidadDia
+            libres = None
+            if not incluir_bloques:
+                libres = libres_materializados(doctor.id, start_date, end_date)
+
+            if libres is None:
+                # Encontrar la plantilla de horario semanal activa para el doctor.
+                try:
+                    active_template = HorarioSemanalTemplate.objects.get(
+                        doctor=doctor, es_activo=True
+                    )
+                except HorarioSemanalTemplate.DoesNotExist:
+                    return Response(
+                        {"error": "No hay un horario semanal activo para este doctor."},
+                        status=status.HTTP_404_NOT_FOUND,
+                    )
+                except HorarioSemanalTemplate.MultipleObjectsReturned:
+                    return Response(
+                        {
+                            "error": "Hay múltiples horarios activos para este doctor. Contacte al administrador."
+                        },
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    )
+
+                # Cargar los ítems activos de la plantilla una sola vez, agruparlos
+                # por día de la semana y expandirlos sobre todo el rango en memoria.
+                items_por_dia = agrupar_items(
+                    active_template.items.filter(activo=True).values_list(
+                        "dia_semana", "hora_inicio", "hora_fin"
+                    )
+                )
+                bloques = expandir_bloques(items_por_dia, start_date, end_date)
+
+                # Restar las reservas no canceladas y partir lo libre en slots
+                # de la duración del procedimiento.
+                slots = calcular_slots(
+                    bloques,
+                    [
+                        *reservas_ocupadas(doctor.id, start_date, end_date),
+                        *como_ocupadas(temporales),
+                    ],
+                    start_date,
+                    procedimiento.duracion_min,
+                )
             else:
-                # Si no se proporcionan fechas, usar la semana actual.
-                start_date = date.today()
-                end_date = start_date + timedelta(days=6)
-        except ValueError:
+                libres = restar_intervalos(
+                    libres, intervalos_ocupados(como_ocupadas(temporales), start_date)
+                )
+                slots = generar_slots(libres, procedimiento.duracion_min)
+
+            # Se cachean todos los slots; los que ya pasaron se omiten al responder.
+            guardar_slots(
+                clave,
+                slots,
+                expira_en=min((fila[2] for fila in temporales), default=None),
+            )
+
+        minuto_desde = minuto_de(now(), start_date)
+        data = {
+            "slots_disponibles": [
+                {"start": inicio, "end": fin}
+                for inicio, fin in slots_a_iso(
+                    start_date, [slot for slot in slots if slot[0] >= minuto_desde]
+                )
+            ]
+        }
+
+        # Bloques y citas en bruto solo si el cliente los pide explícitamente
+        if incluir_bloques:
+            rango_inicio, rango_fin = rango_dias(start_date, end_date)
+            reservas = Reserva.objects.filter(
+                filtro_solape(rango_inicio, rango_fin), doctor=doctor
+            ).values_list("fecha_hora", "fecha_fin")
+            data["bloques_disponibles"] = [
+                {"start": a_iso(start_date, inicio), "end": a_iso(start_date, fin)}
+                for inicio, fin in bloques
+            ]
+            data["citas_reservadas"] = [
+                {"start": fecha_hora.isoformat(), "end": fecha_fin.isoformat()}
+                for fecha_hora, fecha_fin in reservas
+            ]
+
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class DisponibilidadProcedimientoView(APIView):
+    """
+    Slots libres de un procedimiento combinando a todos los doctores
+    disponibles que lo realizan, en un número fijo de consultas.
+    """
+
+    def get(self, request):
+        procedimiento_id = request.query_params.get("procedimiento_id")
+        if not procedimiento_id:
             return Response(
-                {"error": "Formato de fecha inválido. Use YYYY-MM-DD."},
+                {"error": "Debe seleccionar un procedimiento."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        bloques_disponibles = []
-        citas_reservadas = []
-
-        # Encontrar la plantilla de horario semanal activa para el doctor.
         try:
-            active_template = HorarioSemanalTemplate.objects.get(
-                doctor=doctor, es_activo=True
-            )
-        except HorarioSemanalTemplate.DoesNotExist:
+            procedimiento = Procedimiento.objects.get(id=procedimiento_id)
+        except Procedimiento.DoesNotExist:
             return Response(
-                {"error": "No hay un horario semanal activo para este doctor."},
+                {"error": "El procedimiento no existe."},
                 status=status.HTTP_404_NOT_FOUND,
             )
-        except HorarioSemanalTemplate.MultipleObjectsReturned:
-            return Response(
-                {
-                    "error": "Hay múltiples horarios activos para este doctor. Contacte al administrador."
-                },
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+
+        start_date, end_date, error = parse_rango_fechas(request)
+        if error is not None:
+            return error
+
+        doctores = {
+            doctor_id: f"{first_name} {last_name}".strip() or email
+            for doctor_id, first_name, last_name, email in Doctor.objects.filter(
+                procedimientos=procedimiento, disponible=True
+            ).values_list("id", "user__first_name", "user__last_name", "user__email")
+        }
+
+        slots = combinar_slots(
+            slots_por_doctor(
+                doctores,
+                start_date,
+                end_date,
+                procedimiento.duracion_min,
+                desde=minuto_de(now(), start_date),
             )
+        )
 
-        # Generar una lista de fechas dentro del rango especificado.
-        current_date = start_date
-        while current_date <= end_date:
-            weekday = current_date.weekday()
+        return Response(
+            {
+                "doctores": [
+                    {"id": doctor_id, "nombre": nombre}
+                    for doctor_id, nombre in doctores.items()
+                ],
+                "slots_disponibles": [
+                    {"start": inicio, "end": fin, "doctores": doctor_ids}
+                    for (inicio, fin), (_, _, doctor_ids) in zip(
+                        slots_a_iso(start_date, [slot[:2] for slot in slots]), slots
+                    )
+                ],
+            },
+            status=status.HTTP_200_OK,
+        )
 
-            # Filtrar los ítems de la plantilla activa para el día de la semana actual.
-            template_items = active_template.items.filter(
-                dia_semana=weekday, activo=True
-            ).order_by("hora_inicio")
 
-            for item in template_items:
-                start_datetime = datetime.combine(current_date, item.hora_inicio)
-                end_datetime = datetime.combine(current_date, item.hora_fin)
+class ProximaDisponibilidadView(APIView):
+    """
+    Primeros `k` huecos libres para un procedimiento desde ahora, con uno o
+    varios doctores (`doctor_id` opcional, admite varios separados por coma).
+    """
 
-                bloques_disponibles.append(
-                    {
-                        "start": start_datetime.isoformat(),
-                        "end": end_datetime.isoformat(),
-                    }
-                )
+    MAX_K = 20
 
-            current_date += timedelta(days=1)
+    def get(self, request):
+        procedimiento_id = request.query_params.get("procedimiento_id")
+        if not procedimiento_id:
+            return Response(
+                {"error": "Debe seleccionar un procedimiento."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        # Obtener todas las reservas existentes para el rango de fechas.
-        reservas_queryset = Reserva.objects.filter(
-            doctor=doctor,
-            fecha_hora__gte=start_date,
-            fecha_hora__lte=end_date + timedelta(days=1),
-        )
+        try:
+            procedimiento = Procedimiento.objects.get(id=procedimiento_id)
+        except Procedimiento.DoesNotExist:
+            return Response(
+                {"error": "El procedimiento no existe."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
 
-        for reserva in reservas_queryset:
-            citas_reservadas.append(
-                {
-                    "start": reserva.fecha_hora.isoformat(),
-                    "end": (
-                        reserva.fecha_hora + timedelta(minutes=reserva.duracion_min)
-                    ).isoformat(),
-                }
+        try:
+            k = min(max(int(request.query_params.get("k", 1)), 1), self.MAX_K)
+            doctor_ids = [
+                int(doctor_id)
+                for doctor_id in request.query_params.get("doctor_id", "").split(",")
+                if doctor_id
+            ]
+        except ValueError:
+            return Response(
+                {"error": "Parámetros 'k' o 'doctor_id' inválidos."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
+        doctores = Doctor.objects.filter(procedimientos=procedimiento, disponible=True)
+        if doctor_ids:
+            doctores = doctores.filter(id__in=doctor_ids)
+
+        slots = proximos_slots(
+            doctores.values_list("id", flat=True),
+            procedimiento.duracion_min,
+            k,
+            now(),
+            horizonte_dias=getattr(settings, "PROXIMA_DISPONIBILIDAD_DIAS", 180),
+        )
         return Response(
             {
-                "bloques_disponibles": bloques_disponibles,
-                "citas_reservadas": citas_reservadas,
+                "slots_disponibles": [
+                    {
+                        "start": inicio.isoformat(),
+                        "end": fin.isoformat(),
+                        "doctor_id": doctor_id,
+                    }
+                    for inicio, fin, doctor_id in slots
+                ]
             },
             status=status.HTTP_200_OK,
         )
@@ -228,19 +635,103 @@ def admin_stats(request):
         start_of_week = today + timedelta(weeks=week_offset)
         end_of_week = start_of_week + timedelta(days=6)
 
-        # ✅ Ahora usando los campos correctos
-        citas_pendientes = Reserva.objects.filter(estado="pendiente").count()
-        citas_semana = Reserva.objects.filter(
-            fecha_hora__date__range=[start_of_week, end_of_week], estado="pendiente"
-        ).count()
-        total_pacientes = Paciente.objects.count()
+        # Una sola consulta para las tres cifras (ver estadisticas.py)
+        return Response(resumen_admin(start_of_week, end_of_week))
+    except Exception as e:
+        return Response({"error": str(e)}, status=500)
+
+
+# Rango máximo (en días) de stats/series/ y stats/utilizacion/
+MAX_DIAS_ESTADISTICAS = getattr(settings, "ESTADISTICAS_MAX_DIAS", 366)
+
+
+def alcance_estadisticas(request):
+    """
+    Doctor al que se limitan las estadísticas: un administrador ve toda la
+    clínica (None) o el `doctor_id` que pida; un doctor, solo lo suyo.
+    Devuelve (doctor_id, None) o (None, Response) con el error.
+    """
+    principal = get_principal(request)
+    if principal is not None and principal.is_staff:
+        doctor_id = request.query_params.get("doctor_id")
+        try:
+            return (int(doctor_id) if doctor_id else None), None
+        except ValueError:
+            return None, Response(
+                {"error": "doctor_id inválido."}, status=status.HTTP_400_BAD_REQUEST
+            )
+    if principal is not None and principal.doctor_id is not None:
+        return principal.doctor_id, None
+    return None, Response(
+        {"error": "Solo administradores y doctores."},
+        status=status.HTTP_403_FORBIDDEN,
+    )
 
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def stats_series(request):
+    """
+    Series por día o semana (`agrupar=dia|semana`) de las reservas entre
+    `start_date` y `end_date`, por estado y procedimiento, cacheadas por
+    rango y alcance (ver alcance_estadisticas).
+    """
+    doctor_id, error = alcance_estadisticas(request)
+    if error is not None:
+        return error
+    agrupar = request.query_params.get("agrupar", "dia")
+    if agrupar not in AGRUPACIONES:
         return Response(
-            {
-                "citas_pendientes": citas_pendientes,
-                "citas_semana": citas_semana,
-                "total_pacientes": total_pacientes,
-            }
+            {"error": f"agrupar debe ser uno de: {', '.join(AGRUPACIONES)}."},
+            status=status.HTTP_400_BAD_REQUEST,
         )
-    except Exception as e:
-        return Response({"error": str(e)}, status=500)
+    start_date, end_date, error = parse_rango_fechas(
+        request, max_dias=MAX_DIAS_ESTADISTICAS
+    )
+    if error is not None:
+        return error
+
+    alcance = doctor_id if doctor_id is not None else "todos"
+    return Response(
+        cacheado(
+            f"estadisticas:series:{alcance}:{agrupar}:{start_date}:{end_date}",
+            lambda: {
+                "agrupar": agrupar,
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                "doctor_id": doctor_id,
+                "series": series_reservas(start_date, end_date, agrupar, doctor_id),
+            },
+        )
+    )
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def stats_utilizacion(request):
+    """
+    Utilización de la agenda (minutos reservados / minutos de plantilla) por
+    doctor, semana y procedimiento entre `start_date` y `end_date`,
+    cacheada por rango y alcance (ver alcance_estadisticas).
+    """
+    doctor_id, error = alcance_estadisticas(request)
+    if error is not None:
+        return error
+    start_date, end_date, error = parse_rango_fechas(
+        request, max_dias=MAX_DIAS_ESTADISTICAS
+    )
+    if error is not None:
+        return error
+
+    alcance = doctor_id if doctor_id is not None else "todos"
+    return Response(
+        cacheado(
+            f"estadisticas:utilizacion:{alcance}:{start_date}:{end_date}",
+            lambda: {
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                "doctor_id": doctor_id,
+                **utilizacion(start_date, end_date, doctor_id),
+            },
+        )
+    )
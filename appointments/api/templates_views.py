@@ -11,6 +11,8 @@ from rest_framework.response import Response
 # Project-specific Imports
 from ..models import HorarioSemanalTemplate, HorarioDoctor, CustomUser, Doctor
 from ..serializers import HorarioSemanalTemplateSerializer, HorarioDoctorSerializer
+from ..horarios import COMPLETO, DIFERENCIAL, MODOS, aplicar_plantilla
+from ..principal import get_principal
 
 
 class HorarioSemanalTemplateViewSet(viewsets.ModelViewSet):
@@ -31,46 +33,60 @@ class HorarioSemanalTemplateViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(doctor_id=doctor_id)
         return queryset
 
+    def parametros_aplicacion(self, request, modo_por_defecto):
+        """
+        Valida `doctor_id` y `modo` del cuerpo antes de tocar nada. Devuelve
+        ((doctor, modo), None) o (None, Response de error).
+        """
+        doctor_id = request.data.get("doctor_id")
+        if not doctor_id:
+            return None, Response(
+                {"error": "Debe proporcionar un 'doctor_id'"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        modo = request.data.get("modo", modo_por_defecto)
+        if modo not in MODOS:
+            return None, Response(
+                {"error": f"'modo' debe ser uno de: {', '.join(MODOS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        doctor = Doctor.objects.select_related("user").filter(pk=doctor_id).first()
+        if doctor is None:
+            return None, Response(
+                {"error": "Doctor no encontrado"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return (doctor, modo), None
+
+    def respuesta_aplicacion(self, horarios, modo, cambios):
+        # Devolver los horarios resultantes para actualizar el frontend
+        serializer = HorarioDoctorSerializer(horarios, many=True)
+        return Response(
+            {
+                "message": "Plantilla aplicada con éxito",
+                "horarios_actualizados": serializer.data,
+                "modo": modo,
+                **cambios,
+            },
+            status=status.HTTP_200_OK,
+        )
+
     @action(detail=True, methods=["post"], url_path="aplicar_a_doctor")
     def aplicar_a_doctor(self, request, pk=None):
         """
-        Aplica una plantilla de horario a un doctor, borrando los horarios existentes.
+        Aplica una plantilla de horario a un doctor. Por defecto reemplaza todos
+        sus horarios; con modo="diferencial" solo inserta, actualiza o borra los
+        bloques que cambian.
         """
         try:
             template = get_object_or_404(HorarioSemanalTemplate, pk=pk)
-            doctor_id = request.data.get("doctor_id")
-            if not doctor_id:
-                return Response(
-                    {"error": "Debe proporcionar un 'doctor_id'"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+            parametros, error = self.parametros_aplicacion(request, COMPLETO)
+            if error is not None:
+                return error
+            doctor, modo = parametros
 
             with transaction.atomic():
-                # Borrar todos los horarios de disponibilidad del doctor
-                HorarioDoctor.objects.filter(doctor_id=doctor_id).delete()
-
-                # Crear los nuevos horarios a partir de la plantilla
-                # CORRECCIÓN: Usar el related_name "items" del modelo HorarioTemplateItem
-                items = template.items.all()
-                nuevos_horarios = []
-                for item in items:
-                    horario_doctor = HorarioDoctor.objects.create(
-                        doctor_id=doctor_id,
-                        dia_semana=item.dia_semana,
-                        hora_inicio=item.hora_inicio,
-                        hora_fin=item.hora_fin,
-                    )
-                    nuevos_horarios.append(horario_doctor)
-
-            # Devolver los nuevos horarios para actualizar el frontend
-            serializer = HorarioDoctorSerializer(nuevos_horarios, many=True)
-            return Response(
-                {
-                    "message": "Plantilla aplicada con éxito",
-                    "horarios_actualizados": serializer.data,
-                },
-                status=status.HTTP_200_OK,
-            )
+                horarios, cambios = aplicar_plantilla(template, doctor, modo)
+            return self.respuesta_aplicacion(horarios, modo, cambios)
         except Exception as e:
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -83,17 +99,15 @@ class HorarioSemanalTemplateViewSet(viewsets.ModelViewSet):
         """
         try:
             # ⭐ CORRECCIÓN CLAVE: Obtener el CustomUser del token
-            auth0_id = request.user.payload.get("sub")
-            try:
-                custom_user = CustomUser.objects.get(auth0_id=auth0_id)
-            except CustomUser.DoesNotExist:
+            custom_user = get_principal(request)
+            if custom_user is None:
                 return Response(
                     {"error": "Usuario no encontrado en la base de datos."},
                     status=status.HTTP_404_NOT_FOUND,
                 )
 
             # ⭐ CORRECCIÓN: Ahora puedes usar el objeto custom_user para verificar el perfil del doctor
-            if not hasattr(custom_user, "doctor_profile"):
+            if custom_user.doctor_id is None:
                 return Response(
                     {"error": "Permisos insuficientes. El usuario no es un doctor."},
                     status=status.HTTP_403_FORBIDDEN,
@@ -102,12 +116,19 @@ class HorarioSemanalTemplateViewSet(viewsets.ModelViewSet):
             template = get_object_or_404(HorarioSemanalTemplate, pk=pk)
 
             # Verificar que el doctor que intenta activar la plantilla sea su propietario
-            if custom_user.doctor_profile != template.doctor:
+            if custom_user.doctor_id != template.doctor_id:
                 return Response(
                     {"error": "No tiene permisos para modificar esta plantilla."},
                     status=status.HTTP_403_FORBIDDEN,
                 )
 
+            # Validar antes de abrir la transacción: un error no debe dejar la
+            # plantilla activada con los horarios del doctor sin aplicar
+            parametros, error = self.parametros_aplicacion(request, DIFERENCIAL)
+            if error is not None:
+                return error
+            doctor, modo = parametros
+
             with transaction.atomic():
                 # Desactivar todas las demás plantillas del mismo doctor
                 HorarioSemanalTemplate.objects.filter(
@@ -118,10 +139,12 @@ class HorarioSemanalTemplateViewSet(viewsets.ModelViewSet):
                 template.es_activo = True
                 template.save()
 
-                # Reutilizar la lógica para aplicar la plantilla a los horarios del doctor
-                aplicar_response = self.aplicar_a_doctor(request, pk)
+                # Aplicar la plantilla a los horarios del doctor; al reactivar una
+                # plantilla parecida solo cambian unos pocos bloques. Cualquier
+                # excepción deshace también la activación.
+                horarios, cambios = aplicar_plantilla(template, doctor, modo)
 
-            return aplicar_response
+            return self.respuesta_aplicacion(horarios, modo, cambios)
         except Exception as e:
             # Manejar errores más específicos si es necesario
             return Response(
@@ -1,10 +1,239 @@
+import copy
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
 import requests
-from jose import jwt
+from jose import jwk, jwt
 from django.conf import settings
 from rest_framework.authentication import BaseAuthentication
 from rest_framework import exceptions
 from django.contrib.auth.models import AnonymousUser
 
+logger = logging.getLogger(__name__)
+
+
+class JWKSKeyStore:
+    """
+    Almacén de llaves públicas (JWKS) de Auth0 indexadas por `kid`.
+
+    Las llaves se parsean una sola vez y se mantienen en memoria durante `ttl`
+    segundos. Cuando faltan menos de `refresh_margin` segundos para expirar se
+    lanza una recarga en segundo plano, y solo se vuelve a descargar el JWKS de
+    forma síncrona si aparece un `kid` desconocido (como máximo una vez cada
+    `min_refetch_interval` segundos). Un único hilo descarga a la vez.
+    """
+
+    def __init__(
+        self,
+        url=None,
+        path=None,
+        ttl=3600,
+        refresh_margin=300,
+        min_refetch_interval=30,
+        timeout=5,
+    ):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._fetch_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._refreshing = False
+
+    def get_key(self, kid):
+        """Devuelve la llave parseada para `kid`, o None si no existe."""
+        now = time.monotonic()
+        key = self._keys.get(kid)
+
+        if key is not None and now < self._expires_at:
+            if (
+                now >= self._expires_at - self.refresh_margin
+                and now - self._last_fetch >= self.min_refetch_interval
+            ):
+                self._refresh_in_background()
+            return key
+
+        # Llaves expiradas o `kid` desconocido: recarga síncrona.
+        if key is None and self._keys and now < self._expires_at:
+            # Evita que tokens con `kid` inventados disparen descargas continuas.
+            if now - self._last_fetch < self.min_refetch_interval:
+                return None
+
+        self._refresh(since=self._last_fetch)
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._fetch_lock:
+            self._keys = {}
+            self._expires_at = 0.0
+            self._last_fetch = 0.0
+
+    def _refresh(self, since=None):
+        with self._fetch_lock:
+            # Otro hilo ya recargó mientras esperábamos el lock.
+            if since is not None and self._last_fetch > since:
+                return
+            try:
+                keys = self._load_keys()
+            except Exception:
+                logger.exception("No se pudo obtener el JWKS de Auth0")
+                if not self._keys:
+                    raise
+                # Conserva las llaves anteriores y espacia los reintentos.
+                now = time.monotonic()
+                self._last_fetch = now
+                self._expires_at = max(
+                    self._expires_at, now + self.min_refetch_interval
+                )
+                return
+
+            now = time.monotonic()
+            self._keys = keys
+            self._last_fetch = now
+            self._expires_at = now + self.ttl
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self._refresh(since=self._last_fetch)
+            except Exception:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+
+    def _load_keys(self):
+        if self.path:
+            with open(self.path, encoding="utf-8") as fh:
+                jwks = json.load(fh)
+        else:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            jwks = response.json()
+
+        keys = {}
+        for key in jwks.get("keys", []):
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            rsa_key = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use", "sig"),
+                "n": key["n"],
+                "e": key["e"],
+            }
+            keys[key["kid"]] = jwk.construct(rsa_key, key.get("alg", "RS256"))
+        return keys
+
+
+_jwks_store = None
+_jwks_store_lock = threading.Lock()
+
+
+def get_jwks_store():
+    """Devuelve el almacén JWKS compartido por todo el proceso."""
+    global _jwks_store
+    if _jwks_store is None:
+        with _jwks_store_lock:
+            if _jwks_store is None:
+                _jwks_store = JWKSKeyStore(
+                    url=f"https://{settings.AUTH0_DOMAIN}/.well-known/jwks.json",
+                    path=getattr(settings, "AUTH0_JWKS_FILE", None),
+                    ttl=getattr(settings, "AUTH0_JWKS_TTL", 3600),
+                    refresh_margin=getattr(settings, "AUTH0_JWKS_REFRESH_MARGIN", 300),
+                )
+    return _jwks_store
+
+
+def reset_jwks_store():
+    """Descarta el almacén compartido (p. ej. tras cambiar settings en tests)."""
+    global _jwks_store
+    with _jwks_store_lock:
+        _jwks_store = None
+
+
+class VerifiedTokenCache:
+    """
+    LRU acotado de tokens ya verificados, indexado por el SHA-256 del token.
+
+    Cada entrada guarda el `Auth0User` ya construido y se descarta al llegar al
+    `exp` del token, de modo que una petición repetida con el mismo token evita
+    tanto la verificación RSA como el parseo del payload.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user, exp = entry
+                if exp > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    # Copia superficial: cada petición puede anotar su usuario.
+                    return copy.copy(user)
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, token, user):
+        exp = user.payload.get("exp")
+        if not isinstance(exp, (int, float)) or exp <= time.time():
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (copy.copy(user), exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+
+token_cache = VerifiedTokenCache(
+    max_size=getattr(settings, "AUTH0_TOKEN_CACHE_SIZE", 1024)
+)
+
 
 class Auth0User:
     """Pequeño wrapper para que DRF trate el payload como usuario válido"""
@@ -44,31 +273,24 @@ class Auth0JSONWebTokenAuthentication(BaseAuthentication):
             )
 
         token = parts[1]
+        user = token_cache.get(token)
+        if user is not None:
+            return (user, token)
+
         try:
             payload = self.decode_jwt(token)
         except Exception as e:
             raise exceptions.AuthenticationFailed(f"Invalid token: {str(e)}")
 
         user = Auth0User(payload)
+        token_cache.set(token, user)
         return (user, token)  # ✅ ahora sí DRF lo trata como usuario
 
     def decode_jwt(self, token):
-        jwks_url = f"https://{settings.AUTH0_DOMAIN}/.well-known/jwks.json"
-        jwks = requests.get(jwks_url).json()
-
         unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"],
-                }
-
-        if not rsa_key:
+        rsa_key = get_jwks_store().get_key(unverified_header.get("kid"))
+
+        if rsa_key is None:
             raise exceptions.AuthenticationFailed("No matching JWK found.")
 
         return jwt.decode(
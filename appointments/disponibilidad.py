@@ -0,0 +1,585 @@
+# appointments/disponibilidad.py
+"""
+Cálculo de disponibilidad a partir de las plantillas semanales.
+
+Los bloques se representan como pares de enteros (inicio, fin) en minutos
+desde la medianoche local del primer día del rango, lo que permite comparar y
+ordenar sin aritmética de datetime y convertir a ISO solo al final.
+"""
+
+import functools
+import heapq
+import threading
+from collections import defaultdict
+from itertools import chain
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional: sin él se usa el camino en Python puro
+    np = None
+
+from .agenda import filtro_solape
+from .disponibilidad_cache import invalidar_disponibilidad
+from .fechas import rango_dias
+from .models import (
+    DisponibilidadDia,
+    HorarioSemanalTemplate,
+    HorarioTemplateItem,
+    Reserva,
+    ReservaTemporal,
+)
+
+MINUTOS_DIA = 24 * 60
+
+# Días (desde hoy) que cubre la tabla materializada DisponibilidadDia
+HORIZONTE_DIAS = getattr(settings, "DISPONIBILIDAD_HORIZONTE_DIAS", 90)
+# A partir de cuántos bloques compensa restar y expandir con NumPy. Con
+# `manage.py bench_disponibilidad` (que mide solo ese paso) el cruce queda cerca
+# de 100 bloques: ~97 (62 días) empata y ~145 (92 días, el máximo de
+# reservas/disponibilidad/) va x1.2-1.3 más rápido con NumPy.
+NUMPY_MIN_BLOQUES = getattr(settings, "DISPONIBILIDAD_NUMPY_MIN_BLOQUES", 128)
+
+
+def minutos_del_dia(value):
+    return value.hour * 60 + value.minute
+
+
+def agrupar_items(items):
+    """
+    Agrupa filas (dia_semana, hora_inicio, hora_fin) por día de la semana,
+    como listas de (inicio, fin) en minutos ordenadas por inicio.
+    """
+    por_dia = defaultdict(list)
+    for dia_semana, hora_inicio, hora_fin in items:
+        por_dia[dia_semana].append(
+            (minutos_del_dia(hora_inicio), minutos_del_dia(hora_fin))
+        )
+    for bloques in por_dia.values():
+        bloques.sort()
+    return por_dia
+
+
+def expandir_bloques(items_por_dia, start_date, end_date):
+    """
+    Expande la plantilla agrupada sobre [start_date, end_date] (inclusive) y
+    devuelve los bloques ordenados, en minutos desde `start_date`.
+    """
+    bloques = []
+    if not items_por_dia:
+        return bloques
+    dias = (end_date - start_date).days + 1
+    weekday = start_date.weekday()
+    for offset in range(dias):
+        base = offset * MINUTOS_DIA
+        for inicio, fin in items_por_dia.get((weekday + offset) % 7, ()):
+            bloques.append((base + inicio, base + fin))
+    return bloques
+
+
+def a_datetime(start_date, minuto):
+    return datetime.combine(start_date, time.min) + timedelta(minutes=minuto)
+
+
+def a_iso(start_date, minuto):
+    return a_datetime(start_date, minuto).isoformat()
+
+
+def minuto_de(momento, start_date):
+    """Minutos locales de un datetime aware (o naive local) desde `start_date`."""
+    if timezone.is_aware(momento):
+        momento = timezone.localtime(momento).replace(tzinfo=None)
+    delta = momento - datetime.combine(start_date, time.min)
+    return int(delta.total_seconds() // 60)
+
+
+def intervalos_ocupados(reservas, start_date):
+    """
+    Convierte filas (fecha_hora, duracion_min) en intervalos ocupados en
+    minutos desde `start_date`, ordenados por inicio.
+    """
+    ocupados = []
+    for fecha_hora, duracion_min in reservas:
+        inicio = minuto_de(fecha_hora, start_date)
+        ocupados.append((inicio, inicio + duracion_min))
+    ocupados.sort()
+    return ocupados
+
+
+def restar_intervalos(bloques, ocupados):
+    """
+    Resta los intervalos `ocupados` de los `bloques` con un barrido sobre
+    ambas listas ordenadas por inicio: O(n + m) salvo por intervalos ocupados
+    que abarcan varios bloques. Devuelve los tramos libres ordenados.
+    """
+    libres = []
+    j = 0
+    total = len(ocupados)
+    for inicio, fin in bloques:
+        # Descartar los ocupados que terminan antes de este bloque; los
+        # bloques llegan ordenados, así que nunca hay que retroceder.
+        while j < total and ocupados[j][1] <= inicio:
+            j += 1
+        cursor = inicio
+        k = j
+        while k < total and ocupados[k][0] < fin:
+            ocupado_inicio, ocupado_fin = ocupados[k]
+            if ocupado_inicio > cursor:
+                libres.append((cursor, ocupado_inicio))
+            cursor = max(cursor, ocupado_fin)
+            if cursor >= fin:
+                break
+            k += 1
+        if cursor < fin:
+            libres.append((cursor, fin))
+    return libres
+
+
+def generar_slots(libres, duracion, desde=None):
+    """
+    Parte cada tramo libre en slots consecutivos de `duracion` minutos y
+    devuelve sus (inicio, fin). Con `desde` se omiten los que empiezan antes.
+    """
+    slots = []
+    if duracion <= 0:
+        return slots
+    for inicio, fin in libres:
+        if desde is not None and inicio < desde:
+            # Alinear al primer slot del tramo que no empiece antes de `desde`
+            inicio += -(-(desde - inicio) // duracion) * duracion
+        while inicio + duracion <= fin:
+            slots.append((inicio, inicio + duracion))
+            inicio += duracion
+    return slots
+
+
+def calcular_slots(bloques, reservas, start_date, duracion, desde=None):
+    """
+    Slots reservables de `duracion` minutos: bloques de la plantilla menos las
+    reservas (filas (fecha_hora, duracion_min), ya sin las canceladas).
+    Con NumPy instalado y rangos largos se usa el camino vectorizado.
+    """
+    ocupados = intervalos_ocupados(reservas, start_date)
+    if np is not None and len(bloques) >= NUMPY_MIN_BLOQUES:
+        return calcular_slots_numpy(bloques, ocupados, duracion, desde=desde)
+    return generar_slots(restar_intervalos(bloques, ocupados), duracion, desde=desde)
+
+
+def _repetir_rangos(conteos):
+    """Para conteos [2, 3] devuelve [0, 1, 0, 1, 2]: la posición dentro de cada grupo."""
+    total = int(conteos.sum())
+    return np.arange(total) - np.repeat(np.cumsum(conteos) - conteos, conteos)
+
+
+def _a_array(intervalos):
+    """Lista de pares (inicio, fin) a un array (n, 2); fromiter evita crear tuplas."""
+    if isinstance(intervalos, np.ndarray):
+        return intervalos.astype(np.int64, copy=False).reshape(-1, 2)
+    return np.fromiter(
+        chain.from_iterable(intervalos), dtype=np.int64, count=2 * len(intervalos)
+    ).reshape(-1, 2)
+
+
+def restar_intervalos_numpy(bloques, ocupados):
+    """
+    Equivalente vectorizado de `restar_intervalos`. Calcula los huecos entre
+    ocupados (el complemento de su unión) y los intersecta con los bloques
+    mediante búsquedas binarias. Devuelve dos arrays (inicios, fines).
+    """
+    bloques = _a_array(bloques)
+    ocupados = _a_array(ocupados)
+    ocupados = ocupados[np.argsort(ocupados[:, 0], kind="stable")]
+
+    limites = np.iinfo(np.int64)
+    fin_acumulado = np.maximum.accumulate(ocupados[:, 1])
+    hueco_inicio = np.concatenate(([limites.min], fin_acumulado))
+    hueco_fin = np.concatenate((ocupados[:, 0], [limites.max]))
+    validos = hueco_fin > hueco_inicio
+    hueco_inicio, hueco_fin = hueco_inicio[validos], hueco_fin[validos]
+
+    # Huecos que se solapan con cada bloque: [primero, ultimo)
+    primero = np.searchsorted(hueco_fin, bloques[:, 0], side="right")
+    ultimo = np.searchsorted(hueco_inicio, bloques[:, 1], side="left")
+    conteos = np.maximum(ultimo - primero, 0)
+
+    indice_bloque = np.repeat(np.arange(len(bloques)), conteos)
+    indice_hueco = np.repeat(primero, conteos) + _repetir_rangos(conteos)
+    inicios = np.maximum(bloques[indice_bloque, 0], hueco_inicio[indice_hueco])
+    fines = np.minimum(bloques[indice_bloque, 1], hueco_fin[indice_hueco])
+    no_vacios = inicios < fines
+    return inicios[no_vacios], fines[no_vacios]
+
+
+def generar_slots_numpy(inicios, fines, duracion, desde=None):
+    """Equivalente vectorizado de `generar_slots` sobre arrays de tramos libres."""
+    if duracion <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+    if desde is not None:
+        atrasados = inicios < desde
+        inicios = np.where(
+            atrasados, inicios - ((inicios - desde) // duracion) * duracion, inicios
+        )
+    conteos = np.maximum((fines - inicios) // duracion, 0)
+    comienzos = np.repeat(inicios, conteos) + _repetir_rangos(conteos) * duracion
+    return np.column_stack((comienzos, comienzos + duracion))
+
+
+def calcular_slots_numpy(bloques, ocupados, duracion, desde=None):
+    """Igual que `calcular_slots` pero con arrays; devuelve una lista de tuplas."""
+    inicios, fines = restar_intervalos_numpy(bloques, ocupados)
+    slots = generar_slots_numpy(inicios, fines, duracion, desde=desde)
+    return list(map(tuple, slots.tolist()))
+
+
+def slots_a_iso(start_date, slots):
+    """
+    Convierte slots (inicio, fin) en minutos a pares de cadenas ISO. Es el
+    único punto donde se construyen fechas; con NumPy se hace en bloque.
+    """
+    if np is None or not slots:
+        return [
+            (a_iso(start_date, inicio), a_iso(start_date, fin)) for inicio, fin in slots
+        ]
+    minutos = _a_array(slots)
+    base = np.datetime64(start_date.isoformat(), "m")
+    texto = np.datetime_as_string(base + minutos.astype("timedelta64[m]"), unit="s")
+    return list(map(tuple, texto.tolist()))
+
+
+def reservas_ocupadas(doctor_id, start_date, end_date):
+    """
+    Filas (fecha_hora, duracion_min) de las reservas no canceladas del doctor
+    que se solapan con los días de `start_date` a `end_date` (inclusive).
+    """
+    inicio, fin = rango_dias(start_date, end_date)
+    return (
+        Reserva.objects.filter(filtro_solape(inicio, fin), doctor_id=doctor_id)
+        .exclude(estado="cancelada")
+        .order_by("fecha_hora")
+        .values_list("fecha_hora", "duracion_min")
+    )
+
+
+def cargar_items_activos(doctor_ids):
+    """
+    Ítems activos de las plantillas activas de varios doctores en una sola
+    consulta, ya agrupados: {doctor_id: {dia_semana: [(inicio, fin), ...]}}.
+    """
+    items = defaultdict(list)
+    for doctor_id, *item in HorarioTemplateItem.objects.filter(
+        template__doctor_id__in=doctor_ids, template__es_activo=True, activo=True
+    ).values_list("template__doctor_id", "dia_semana", "hora_inicio", "hora_fin"):
+        items[doctor_id].append(item)
+    return {doctor_id: agrupar_items(filas) for doctor_id, filas in items.items()}
+
+
+def cargar_temporales(doctor_ids, start_date, end_date):
+    """
+    Reservas temporales vigentes de varios doctores entre `start_date` y
+    `end_date` en una sola consulta:
+    {doctor_id: [(fecha_hora, duracion_min, expira_en), ...]}.
+    """
+    temporales = defaultdict(list)
+    inicio, fin = rango_dias(start_date, end_date)
+    for doctor_id, *fila in ReservaTemporal.objects.filter(
+        filtro_solape(inicio, fin),
+        doctor_id__in=doctor_ids,
+        expira_en__gt=timezone.now(),
+    ).values_list("doctor_id", "fecha_hora", "duracion_min", "expira_en"):
+        temporales[doctor_id].append(tuple(fila))
+    return temporales
+
+
+def como_ocupadas(temporales):
+    """Filas de `cargar_temporales` en el formato (fecha_hora, duracion_min)."""
+    return [(fecha_hora, duracion_min) for fecha_hora, duracion_min, _ in temporales]
+
+
+def cargar_reservas(doctor_ids, start_date, end_date, incluir_temporales=True):
+    """
+    Reservas no canceladas de varios doctores entre `start_date` y `end_date`
+    en una sola consulta: {doctor_id: [(fecha_hora, duracion_min), ...]}.
+    Con `incluir_temporales` se suman las reservas temporales vigentes (una
+    consulta más); la disponibilidad materializada no las incluye porque
+    caducan sin que ocurra ninguna escritura.
+    """
+    reservas = defaultdict(list)
+    inicio, fin = rango_dias(start_date, end_date)
+    for doctor_id, fecha_hora, duracion_min in (
+        Reserva.objects.filter(filtro_solape(inicio, fin), doctor_id__in=doctor_ids)
+        .exclude(estado="cancelada")
+        .values_list("doctor_id", "fecha_hora", "duracion_min")
+    ):
+        reservas[doctor_id].append((fecha_hora, duracion_min))
+    if incluir_temporales:
+        for doctor_id, temporales in cargar_temporales(
+            doctor_ids, start_date, end_date
+        ).items():
+            reservas[doctor_id].extend(como_ocupadas(temporales))
+    return reservas
+
+
+def slots_por_doctor(doctor_ids, start_date, end_date, duracion, desde=None):
+    """
+    Slots libres de varios doctores a la vez. Usa exactamente tres consultas
+    (ítems de las plantillas activas, reservas no canceladas y reservas
+    temporales de todos los doctores) sin importar cuántos doctores haya.
+    Devuelve {doctor_id: [(inicio, fin), ...]}.
+    """
+    doctor_ids = list(doctor_ids)
+    if not doctor_ids:
+        return {}
+
+    items = cargar_items_activos(doctor_ids)
+    reservas = cargar_reservas(doctor_ids, start_date, end_date)
+    return {
+        doctor_id: calcular_slots(
+            expandir_bloques(items.get(doctor_id), start_date, end_date),
+            reservas[doctor_id],
+            start_date,
+            duracion,
+            desde=desde,
+        )
+        for doctor_id in doctor_ids
+    }
+
+
+def proximos_slots(doctor_ids, duracion, k, desde, horizonte_dias=180, ventana=7):
+    """
+    Primeros `k` slots libres a partir del datetime `desde` entre varios
+    doctores, como (datetime_inicio, datetime_fin, doctor_id).
+
+    Recorre el calendario en ventanas que se duplican (7, 14, 28... días) y se
+    detiene en cuanto reúne `k` slots, así que el coste depende de lo pronto
+    que aparezca hueco y no del horizonte. Cada ventana cuesta dos consultas
+    (reservas y reservas temporales); las plantillas se cargan una sola vez.
+    """
+    items = cargar_items_activos(list(doctor_ids))
+    if not items or k <= 0:
+        return []
+
+    hoy = timezone.localdate(desde) if timezone.is_aware(desde) else desde.date()
+    limite = hoy + timedelta(days=horizonte_dias - 1)
+    encontrados = []
+    start_date = hoy
+    while start_date <= limite:
+        end_date = min(start_date + timedelta(days=ventana - 1), limite)
+        reservas = cargar_reservas(list(items), start_date, end_date)
+        minuto_desde = minuto_de(desde, start_date)
+
+        por_doctor = {
+            doctor_id: calcular_slots(
+                expandir_bloques(items_por_dia, start_date, end_date),
+                reservas[doctor_id],
+                start_date,
+                duracion,
+                desde=minuto_desde,
+            )
+            for doctor_id, items_por_dia in items.items()
+        }
+        for inicio, fin, doctor_ids_slot in combinar_slots(por_doctor):
+            for doctor_id in doctor_ids_slot:
+                encontrados.append(
+                    (
+                        a_datetime(start_date, inicio),
+                        a_datetime(start_date, fin),
+                        doctor_id,
+                    )
+                )
+                if len(encontrados) == k:
+                    return encontrados
+
+        start_date = end_date + timedelta(days=1)
+        ventana *= 2
+    return encontrados
+
+
+def combinar_slots(slots_de_doctores):
+    """
+    Mezcla las listas ordenadas de cada doctor en una sola lista ordenada de
+    (inicio, fin, [doctor_ids]); los slots idénticos se agrupan.
+    """
+    combinados = []
+    for inicio, fin, doctor_id in heapq.merge(
+        *(
+            [(inicio, fin, doctor_id) for inicio, fin in slots]
+            for doctor_id, slots in slots_de_doctores.items()
+        )
+    ):
+        if combinados and combinados[-1][0] == inicio and combinados[-1][1] == fin:
+            combinados[-1][2].append(doctor_id)
+        else:
+            combinados.append((inicio, fin, [doctor_id]))
+    return combinados
+
+
+# --- Disponibilidad materializada (DisponibilidadDia) ---
+
+
+def horizonte(hoy=None):
+    """Primer y último día (inclusive) que cubre la tabla materializada."""
+    hoy = hoy or timezone.localdate()
+    return hoy, hoy + timedelta(days=HORIZONTE_DIAS - 1)
+
+
+def libres_por_dia(items_por_dia, reservas, start_date, end_date):
+    """
+    Tramos libres de cada día de [start_date, end_date] como
+    {fecha: [[inicio, fin], ...]}, en minutos desde la medianoche de ese día.
+    """
+    dias = {
+        start_date + timedelta(days=offset): []
+        for offset in range((end_date - start_date).days + 1)
+    }
+    libres = restar_intervalos(
+        expandir_bloques(items_por_dia, start_date, end_date),
+        intervalos_ocupados(reservas, start_date),
+    )
+    # Los bloques de la plantilla no cruzan la medianoche, así que cada tramo
+    # libre cae entero dentro de un día.
+    for inicio, fin in libres:
+        offset = inicio // MINUTOS_DIA
+        base = offset * MINUTOS_DIA
+        dias[start_date + timedelta(days=offset)].append([inicio - base, fin - base])
+    return dias
+
+
+def materializar_disponibilidad(doctor_ids, start_date=None, end_date=None):
+    """
+    Recalcula las filas de DisponibilidadDia de los doctores en
+    [start_date, end_date], recortado al horizonte. Cuesta una consulta de
+    ítems, una de reservas y un upsert, sin importar cuántos días o doctores.
+    Devuelve el número de filas escritas.
+    """
+    primero, ultimo = horizonte()
+    start_date = max(start_date or primero, primero)
+    end_date = min(end_date or ultimo, ultimo)
+    doctor_ids = list(doctor_ids)
+    if not doctor_ids or start_date > end_date:
+        return 0
+
+    items = cargar_items_activos(doctor_ids)
+    # Sin plantilla activa no se materializa nada: la lectura cae al cálculo
+    # en vivo, que es quien responde que no hay horario activo.
+    sin_plantilla = [doctor_id for doctor_id in doctor_ids if doctor_id not in items]
+    if sin_plantilla:
+        DisponibilidadDia.objects.filter(doctor_id__in=sin_plantilla).delete()
+    if not items:
+        return 0
+
+    reservas = cargar_reservas(
+        list(items), start_date, end_date, incluir_temporales=False
+    )
+    filas = [
+        DisponibilidadDia(doctor_id=doctor_id, fecha=fecha, libres=libres)
+        for doctor_id, items_por_dia in items.items()
+        for fecha, libres in libres_por_dia(
+            items_por_dia, reservas[doctor_id], start_date, end_date
+        ).items()
+    ]
+    DisponibilidadDia.objects.bulk_create(
+        filas,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["doctor", "fecha"],
+        update_fields=["libres", "actualizado_en"],
+    )
+    return len(filas)
+
+
+# Doctores por rematerializar en la transacción en curso de este hilo y el
+# callback on_commit que los procesará
+_pendientes = threading.local()
+
+
+def _materializar_pendientes():
+    doctor_ids = getattr(_pendientes, "doctor_ids", set())
+    _pendientes.doctor_ids = set()
+    if doctor_ids:
+        materializar_disponibilidad(doctor_ids)
+        invalidar_disponibilidad(*doctor_ids)
+
+
+def materializar_al_confirmar(doctor_id):
+    """
+    Rehace el horizonte del doctor al confirmarse la transacción en curso (en
+    el acto si no hay ninguna). Todas las ediciones de plantillas de una
+    transacción, como el borrado en cascada de los ítems de una plantilla, se
+    juntan en una sola llamada a materializar_disponibilidad.
+    """
+    pendientes = getattr(_pendientes, "doctor_ids", None)
+    if pendientes is None:
+        pendientes = _pendientes.doctor_ids = set()
+    # Con el conjunto vacío no hay nada programado; si no, solo lo está si el
+    # último callback sigue en la transacción (un rollback lo descarta y los
+    # doctores que quedaron se procesan con el siguiente).
+    callback = getattr(_pendientes, "callback", None)
+    programado = bool(pendientes) and any(
+        func is callback for _, func, _ in connection.run_on_commit
+    )
+    pendientes.add(doctor_id)
+    if not programado:
+        # Un objeto nuevo por transacción, para reconocerlo en run_on_commit
+        _pendientes.callback = functools.partial(_materializar_pendientes)
+        transaction.on_commit(_pendientes.callback)
+
+
+def descartar_sin_plantilla(doctor_id):
+    """
+    Borra la disponibilidad materializada del doctor si ya no le queda una
+    plantilla activa; si no, la lectura seguiría ofreciendo los slots de la
+    plantilla que perdió. Devuelve cuántas filas borró.
+    """
+    if HorarioSemanalTemplate.objects.filter(
+        doctor_id=doctor_id, es_activo=True
+    ).exists():
+        return 0
+    borradas, _ = DisponibilidadDia.objects.filter(doctor_id=doctor_id).delete()
+    return borradas
+
+
+def actualizar_disponibilidad(doctor_id, fechas):
+    """
+    Mantenimiento incremental tras crear, mover o cancelar una reserva:
+    recalcula solo los días afectados del doctor.
+    """
+    fechas = [fecha for fecha in fechas if fecha is not None]
+    if doctor_id is None or not fechas:
+        return 0
+    return materializar_disponibilidad([doctor_id], min(fechas), max(fechas))
+
+
+def libres_materializados(doctor_id, start_date, end_date):
+    """
+    Tramos libres del doctor en [start_date, end_date] leídos de
+    DisponibilidadDia con una única consulta por (doctor, fecha), en minutos
+    desde `start_date`. Devuelve None si la tabla no cubre todo el rango, en
+    cuyo caso hay que calcular en vivo. Los días anteriores a hoy se tratan
+    como vacíos: sus slots ya pasaron.
+    """
+    primero, ultimo = horizonte()
+    if end_date > ultimo:
+        return None
+    desde = max(start_date, primero)
+    if desde > end_date:
+        return []
+
+    filas = list(
+        DisponibilidadDia.objects.filter(
+            doctor_id=doctor_id, fecha__gte=desde, fecha__lte=end_date
+        )
+        .order_by("fecha")
+        .values_list("fecha", "libres")
+    )
+    if len(filas) != (end_date - desde).days + 1:
+        return None
+
+    libres = []
+    for fecha, tramos in filas:
+        base = (fecha - start_date).days * MINUTOS_DIA
+        libres.extend((base + inicio, base + fin) for inicio, fin in tramos)
+    return libres
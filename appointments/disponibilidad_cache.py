@@ -0,0 +1,97 @@
+# appointments/disponibilidad_cache.py
+"""
+Cache de slots de disponibilidad sobre el framework de cache de Django.
+
+Cada doctor tiene un contador de versión que forma parte de la clave; las
+señales de Reserva y de las plantillas lo incrementan, de modo que una
+escritura invalida de golpe todas las entradas del doctor sin tener que
+enumerarlas y ninguna entrada servida puede estar desactualizada.
+"""
+
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+
+def _cache():
+    return caches[getattr(settings, "DISPONIBILIDAD_CACHE_ALIAS", "default")]
+
+
+def _clave_version(doctor_id):
+    return f"disponibilidad:version:{doctor_id}"
+
+
+def _version_inicial():
+    # Si el contador se pierde (expulsión, reinicio) el nuevo valor no puede
+    # coincidir con uno anterior, así que las entradas viejas quedan huérfanas.
+    return time.time_ns()
+
+
+def version_doctor(doctor_id):
+    cache = _cache()
+    clave = _clave_version(doctor_id)
+    version = cache.get(clave)
+    if version is None:
+        cache.add(clave, _version_inicial(), None)
+        version = cache.get(clave)
+    return version
+
+
+def _incrementar(doctor_id):
+    cache = _cache()
+    try:
+        cache.incr(_clave_version(doctor_id))
+    except ValueError:
+        cache.set(_clave_version(doctor_id), _version_inicial(), None)
+
+
+def invalidar_disponibilidad(*doctor_ids):
+    """
+    Incrementa la versión de los doctores ahora y otra vez al hacer commit,
+    para que una lectura concurrente no deje cacheados datos sin confirmar.
+    """
+    doctor_ids = {doctor_id for doctor_id in doctor_ids if doctor_id is not None}
+    if not doctor_ids:
+        return
+
+    def incrementar_todos():
+        for doctor_id in doctor_ids:
+            _incrementar(doctor_id)
+
+    incrementar_todos()
+    transaction.on_commit(incrementar_todos)
+
+
+def clave_slots(doctor_id, duracion, start_date, end_date):
+    """
+    Clave de los slots de un doctor para una duración y un rango. Se calcula
+    antes de leer la base: si una escritura llega a mitad del cálculo, el
+    resultado queda bajo la versión anterior y nunca se vuelve a servir.
+    """
+    return (
+        f"disponibilidad:slots:{doctor_id}:{version_doctor(doctor_id)}:"
+        f"{duracion}:{start_date.isoformat()}:{end_date.isoformat()}"
+    )
+
+
+def leer_slots(clave):
+    return _cache().get(clave)
+
+
+def guardar_slots(clave, slots, expira_en=None):
+    """
+    Guarda los slots. `expira_en` es el vencimiento de la primera reserva
+    temporal tenida en cuenta: como vencer no es una escritura y no cambia la
+    versión, la entrada no debe sobrevivirla.
+    """
+    ttl = getattr(settings, "DISPONIBILIDAD_CACHE_TTL", 600)
+    if expira_en is not None:
+        restante = (expira_en - timezone.now()).total_seconds()
+        if restante <= 0:
+            return
+        ttl = min(ttl, math.ceil(restante))
+    _cache().set(clave, slots, ttl)
@@ -0,0 +1,361 @@
+# appointments/estadisticas.py
+"""
+Cifras de los dashboards de administración y de doctor.
+
+Los dashboards se consultan continuamente, así que no agregan la tabla de
+reservas: leen unas pocas filas de ContadorReservas (reservas por doctor,
+día y estado) y ContadorPacientes (reservas por doctor y paciente), que se
+ajustan en la misma transacción que cada alta, edición, baja o cambio de
+estado. Cada resumen sigue siendo una sola consulta. Para medirlo:
+`python manage.py bench_estadisticas`.
+
+Las series y la utilización, que recorren rangos de semanas o meses, se
+agrupan en SQL sobre la ventana de fecha_hora y se cachean CACHE_TTL segundos.
+"""
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    Count,
+    DateField,
+    F,
+    Func,
+    IntegerField,
+    Q,
+    Subquery,
+    Sum,
+)
+from django.db.models.functions import TruncDate, TruncWeek
+from django.utils import timezone
+
+from .disponibilidad import cargar_items_activos
+from .fechas import dia_local, rango_dias
+from .models import ContadorPacientes, ContadorReservas, Doctor, Paciente, Reserva
+
+# Campos de Reserva de los que dependen los contadores
+CAMPOS_CONTADORES = ("doctor_id", "paciente_id", "fecha_hora", "estado")
+# Segundos que se cachean las series y la utilización
+CACHE_TTL = getattr(settings, "ESTADISTICAS_CACHE_TTL", 60)
+
+
+def cacheado(clave, calcular):
+    """Devuelve `calcular()`, cacheado CACHE_TTL segundos bajo `clave`."""
+    cache = caches[getattr(settings, "ESTADISTICAS_CACHE_ALIAS", "default")]
+    valor = cache.get(clave)
+    if valor is None:
+        valor = calcular()
+        cache.set(clave, valor, CACHE_TTL)
+    return valor
+
+
+class SubconsultaEscalar(Subquery):
+    """
+    Subconsulta no correlacionada (un único valor) que puede ir junto a los
+    agregados de `aggregate()`, que por defecto solo admite agregados.
+    """
+
+    contains_aggregate = True
+
+
+def contar(queryset):
+    """`queryset.count()` como subconsulta escalar dentro de otra consulta."""
+    return SubconsultaEscalar(
+        queryset.order_by().values(cuenta=Func("pk", function="COUNT")),
+        output_field=IntegerField(),
+    )
+
+
+def _sumar(modelo, campos, deltas):
+    """Suma cada delta a la fila `campos = clave`, creándola si no existe."""
+    for clave, delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        filtro = dict(zip(campos, clave))
+        if modelo.objects.filter(**filtro).update(total=F("total") + delta):
+            continue
+        if delta < 0:
+            # Sin fila que descontar: el contador ya estaba desfasado y lo
+            # corrige reconstruir_contadores.
+            continue
+        try:
+            with transaction.atomic():
+                modelo.objects.create(total=delta, **filtro)
+        except IntegrityError:
+            # Otra transacción creó la fila entre el UPDATE y el INSERT
+            modelo.objects.filter(**filtro).update(total=F("total") + delta)
+
+
+def ajustar_contadores(transiciones):
+    """
+    Aplica a los contadores una serie de pares (antes, después) de reservas,
+    cada uno un dict con CAMPOS_CONTADORES o None para un alta o una baja.
+    Los cambios que se compensan (p. ej. confirmar y volver a pendiente en
+    el mismo lote) no tocan la base.
+    """
+    por_dia = Counter()
+    por_paciente = Counter()
+    for antes, despues in transiciones:
+        for valores, signo in ((antes, -1), (despues, 1)):
+            if valores is None:
+                continue
+            doctor_id = valores["doctor_id"]
+            fecha = dia_local(valores["fecha_hora"])
+            por_dia[(doctor_id, fecha, valores["estado"])] += signo
+            por_paciente[(doctor_id, valores["paciente_id"])] += signo
+    _sumar(ContadorReservas, ("doctor_id", "fecha", "estado"), por_dia)
+    _sumar(ContadorPacientes, ("doctor_id", "paciente_id"), por_paciente)
+
+
+def reconstruir_contadores(doctor_ids=None, lote=2000):
+    """
+    Recalcula desde Reserva los contadores de `doctor_ids` (todos si es
+    None) en una transacción. Devuelve cuántas filas de cada tabla creó.
+    """
+    reservas = Reserva.objects.order_by()
+    por_dia = ContadorReservas.objects.all()
+    por_paciente = ContadorPacientes.objects.all()
+    if doctor_ids is not None:
+        reservas = reservas.filter(doctor_id__in=doctor_ids)
+        por_dia = por_dia.filter(doctor_id__in=doctor_ids)
+        por_paciente = por_paciente.filter(doctor_id__in=doctor_ids)
+
+    with transaction.atomic():
+        por_dia.delete()
+        por_paciente.delete()
+        # TruncDate usa la zona horaria actual: el mismo día que dia_local()
+        dias = ContadorReservas.objects.bulk_create(
+            [
+                ContadorReservas(**fila)
+                for fila in reservas.annotate(fecha=TruncDate("fecha_hora"))
+                .values("doctor_id", "fecha", "estado")
+                .annotate(total=Count("*"))
+            ],
+            batch_size=lote,
+        )
+        pacientes = ContadorPacientes.objects.bulk_create(
+            [
+                ContadorPacientes(**fila)
+                for fila in reservas.values("doctor_id", "paciente_id").annotate(
+                    total=Count("*")
+                )
+            ],
+            batch_size=lote,
+        )
+    return len(dias), len(pacientes)
+
+
+def resumen_admin(start_date, end_date):
+    """
+    Reservas pendientes (en total y en [start_date, end_date]) y total de
+    pacientes.
+    """
+    return ContadorReservas.objects.filter(estado="pendiente").aggregate(
+        citas_pendientes=Sum("total", default=0),
+        citas_semana=Sum(
+            "total", filter=Q(fecha__range=(start_date, end_date)), default=0
+        ),
+        total_pacientes=contar(Paciente.objects.all()),
+    )
+
+
+def resumen_doctor(doctor_id, start_date, end_date):
+    """
+    Reservas pendientes futuras del doctor, sus reservas en
+    [start_date, end_date] y cuántos pacientes distintos ha atendido.
+    """
+    ahora = timezone.now()
+    hoy = timezone.localdate(ahora)
+    _, fin_de_hoy = rango_dias(hoy, hoy)
+    # Las pendientes de hoy se cuentan en Reserva, porque las de horas que ya
+    # pasaron no son futuras; para el resto de días basta el contador.
+    pendientes_hoy = Reserva.objects.filter(
+        doctor_id=doctor_id,
+        estado="pendiente",
+        fecha_hora__gte=ahora,
+        fecha_hora__lt=fin_de_hoy,
+    )
+    return ContadorReservas.objects.filter(doctor_id=doctor_id).aggregate(
+        citas_pendientes=Sum(
+            "total", filter=Q(estado="pendiente", fecha__gt=hoy), default=0
+        )
+        + contar(pendientes_hoy),
+        citas_semana=Sum(
+            "total", filter=Q(fecha__range=(start_date, end_date)), default=0
+        ),
+        total_pacientes=contar(
+            ContadorPacientes.objects.filter(doctor_id=doctor_id, total__gt=0)
+        ),
+    )
+
+
+# Agrupaciones de series_reservas: función de truncado y paso entre periodos
+AGRUPACIONES = {
+    "dia": (TruncDate, timedelta(days=1)),
+    "semana": (TruncWeek, timedelta(weeks=1)),
+}
+
+
+def series_reservas(start_date, end_date, agrupar="dia", doctor_id=None):
+    """
+    Reservas por día o semana (lunes) en [start_date, end_date], desglosadas
+    por estado y por procedimiento, para dibujar tendencias con una sola
+    petición. Se agrupa en SQL con una consulta sobre el rango de fecha_hora;
+    los periodos sin reservas aparecen con ceros.
+    """
+    truncar, paso = AGRUPACIONES[agrupar]
+    inicio, fin = rango_dias(start_date, end_date)
+    reservas = Reserva.objects.filter(fecha_hora__gte=inicio, fecha_hora__lt=fin)
+    if doctor_id is not None:
+        reservas = reservas.filter(doctor_id=doctor_id)
+    filas = (
+        reservas.annotate(periodo=truncar("fecha_hora", output_field=DateField()))
+        .values("periodo", "estado", "procedimiento_id")
+        .annotate(total=Count("*"))
+        .order_by()
+    )
+
+    por_estado = defaultdict(Counter)
+    por_procedimiento = defaultdict(Counter)
+    for fila in filas:
+        por_estado[fila["periodo"]][fila["estado"]] += fila["total"]
+        por_procedimiento[fila["periodo"]][fila["procedimiento_id"]] += fila["total"]
+
+    series = []
+    periodo = start_date
+    if agrupar == "semana":
+        periodo -= timedelta(days=start_date.weekday())
+    while periodo <= end_date:
+        estados = por_estado[periodo]
+        series.append(
+            {
+                "periodo": periodo.isoformat(),
+                "total": sum(estados.values()),
+                "por_estado": {
+                    estado: estados[estado] for estado, _ in Reserva.ESTADO_CHOICES
+                },
+                "por_procedimiento": [
+                    {"procedimiento_id": procedimiento_id, "total": total}
+                    for procedimiento_id, total in por_procedimiento[
+                        periodo
+                    ].most_common()
+                ],
+            }
+        )
+        periodo += paso
+    return series
+
+
+def _minutos_cubiertos(bloques):
+    """Minutos que cubre la unión de bloques (inicio, fin) ordenados."""
+    total = 0
+    fin_anterior = 0
+    for inicio, fin in bloques:
+        inicio = max(inicio, fin_anterior)
+        if fin > inicio:
+            total += fin - inicio
+            fin_anterior = fin
+    return total
+
+
+def _utilizacion(capacidad_min, reservados_min):
+    return {
+        "capacidad_min": capacidad_min,
+        "reservados_min": reservados_min,
+        "utilizacion": (
+            round(reservados_min / capacidad_min, 4) if capacidad_min else None
+        ),
+    }
+
+
+def utilizacion(start_date, end_date, doctor_id=None):
+    """
+    Utilización (minutos reservados / minutos de plantilla) de cada doctor
+    en [start_date, end_date], en total, por semana (lunes) y por
+    procedimiento, más el total de la clínica y su reparto por procedimiento.
+
+    La capacidad sale de los ítems activos de la plantilla activa de cada
+    doctor (la actual: las plantillas no guardan historial). Las reservas no
+    canceladas se agregan en SQL por (doctor, semana, procedimiento) sobre la
+    ventana de fecha_hora, así que todo son dos consultas que no crecen con
+    el número de doctores o de semanas.
+    """
+    doctores = [doctor_id] if doctor_id is not None else Doctor.objects.values("id")
+    items = cargar_items_activos(doctores)
+    inicio, fin = rango_dias(start_date, end_date)
+    reservas = Reserva.objects.filter(
+        fecha_hora__gte=inicio, fecha_hora__lt=fin
+    ).exclude(estado="cancelada")
+    if doctor_id is not None:
+        reservas = reservas.filter(doctor_id=doctor_id)
+
+    reservados = defaultdict(lambda: defaultdict(Counter))
+    for fila in (
+        reservas.annotate(semana=TruncWeek("fecha_hora", output_field=DateField()))
+        .values("doctor_id", "semana", "procedimiento_id")
+        .annotate(minutos=Sum("duracion_min"))
+        .order_by()
+    ):
+        reservados[fila["doctor_id"]][fila["semana"]][fila["procedimiento_id"]] += fila[
+            "minutos"
+        ]
+
+    # Semanas del rango con los días de cada una que caen dentro de él
+    semanas = defaultdict(list)
+    dia = start_date
+    while dia <= end_date:
+        semanas[dia - timedelta(days=dia.weekday())].append(dia.weekday())
+        dia += timedelta(days=1)
+
+    resultado = []
+    por_procedimiento = Counter()
+    capacidad_total = 0
+    for id_doctor in sorted(set(items) | set(reservados)):
+        minutos_dia = {
+            dia_semana: _minutos_cubiertos(bloques)
+            for dia_semana, bloques in items.get(id_doctor, {}).items()
+        }
+        semanas_doctor = []
+        procedimientos_doctor = Counter()
+        for semana, dias in sorted(semanas.items()):
+            capacidad = sum(minutos_dia.get(dia_semana, 0) for dia_semana in dias)
+            minutos = reservados[id_doctor][semana]
+            procedimientos_doctor.update(minutos)
+            semanas_doctor.append(
+                {
+                    "semana": semana.isoformat(),
+                    **_utilizacion(capacidad, sum(minutos.values())),
+                }
+            )
+        capacidad = sum(semana["capacidad_min"] for semana in semanas_doctor)
+        capacidad_total += capacidad
+        por_procedimiento.update(procedimientos_doctor)
+        resultado.append(
+            {
+                "doctor_id": id_doctor,
+                **_utilizacion(capacidad, sum(procedimientos_doctor.values())),
+                "semanas": semanas_doctor,
+                "procedimientos": [
+                    {
+                        "procedimiento_id": procedimiento_id,
+                        **_utilizacion(capacidad, minutos),
+                    }
+                    for procedimiento_id, minutos in procedimientos_doctor.most_common()
+                ],
+            }
+        )
+
+    return {
+        "total": _utilizacion(capacidad_total, sum(por_procedimiento.values())),
+        "procedimientos": [
+            {
+                "procedimiento_id": procedimiento_id,
+                **_utilizacion(capacidad_total, minutos),
+            }
+            for procedimiento_id, minutos in por_procedimiento.most_common()
+        ],
+        "doctores": resultado,
+    }
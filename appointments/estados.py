@@ -0,0 +1,138 @@
+# appointments/estados.py
+"""
+Cambios de estado de reservas en lote (confirmar o cancelar un día entero).
+
+Cada estado destino se aplica con un único UPDATE. Como `QuerySet.update()`
+no emite señales, aquí se hace a mano lo que harían post_save: ajustar los
+contadores de los dashboards, recalcular la disponibilidad materializada de
+los días que se liberan u ocupan e invalidar el cache de slots de esos
+doctores.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .agenda import agendas_bloqueadas, reservas_solapadas, temporales_solapadas
+from .disponibilidad import actualizar_disponibilidad
+from .disponibilidad_cache import invalidar_disponibilidad
+from .estadisticas import ajustar_contadores
+from .fechas import dia_local
+from .models import Reserva
+
+# Máximo de reservas por lote
+MAX_LOTE = getattr(settings, "RESERVA_ESTADO_MAX_LOTE", 500)
+
+ACTUALIZADA = "actualizada"
+SIN_CAMBIOS = "sin_cambios"
+NO_ENCONTRADA = "no_encontrada"
+CONFLICTO = "conflicto"
+
+
+def _se_solapan(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+
+def cambiar_estados(reservas, cambios):
+    """
+    Aplica `cambios` ({id: estado}) sobre el queryset `reservas`, que ya debe
+    estar acotado a lo que el usuario puede modificar. Devuelve {id: resultado}.
+
+    Cancelar o moverse entre estados activos nunca genera conflictos. Reactivar
+    una reserva cancelada vuelve a ocupar su horario, así que se hace con la
+    agenda del doctor bloqueada y después de aplicar las cancelaciones del
+    mismo lote; si el hueco ya está tomado el resultado es CONFLICTO.
+    """
+    resultados = {pk: NO_ENCONTRADA for pk in cambios}
+    reactivables = [pk for pk, estado in cambios.items() if estado != "cancelada"]
+    doctores_bloqueados = set(
+        reservas.filter(pk__in=reactivables, estado="cancelada")
+        .values_list("doctor_id", flat=True)
+        .distinct()
+    )
+
+    with agendas_bloqueadas(doctores_bloqueados):
+        actuales = {
+            fila[0]: fila[1:]
+            for fila in reservas.select_for_update()
+            .filter(pk__in=cambios)
+            .values_list(
+                "id",
+                "doctor_id",
+                "paciente_id",
+                "estado",
+                "fecha_hora",
+                "duracion_min",
+            )
+        }
+
+        por_estado = defaultdict(list)
+        reactivaciones = []
+        for pk, estado in cambios.items():
+            if pk not in actuales:
+                continue
+            anterior = actuales[pk][2]
+            if anterior == estado:
+                resultados[pk] = SIN_CAMBIOS
+            elif anterior == "cancelada":
+                reactivaciones.append(pk)
+            else:
+                por_estado[estado].append(pk)
+
+        ahora = timezone.now()
+        # Las cancelaciones van primero: liberan huecos que el mismo lote
+        # puede volver a ocupar.
+        canceladas = por_estado.pop("cancelada", [])
+        if canceladas:
+            Reserva.objects.filter(pk__in=canceladas).update(
+                estado="cancelada", actualizado_en=ahora
+            )
+
+        aceptadas = defaultdict(list)
+        for pk in sorted(reactivaciones, key=lambda pk: actuales[pk][3]):
+            doctor_id, paciente_id, _, fecha_hora, duracion_min = actuales[pk]
+            intervalo = (fecha_hora, fecha_hora + timedelta(minutes=duracion_min))
+            if (
+                # Se canceló entre la primera lectura y el bloqueo
+                doctor_id not in doctores_bloqueados
+                or any(_se_solapan(intervalo, otro) for otro in aceptadas[doctor_id])
+                or reservas_solapadas(doctor_id, fecha_hora, duracion_min, pk)
+                or temporales_solapadas(
+                    doctor_id, *intervalo, excluir_paciente_id=paciente_id
+                )
+            ):
+                resultados[pk] = CONFLICTO
+                continue
+            aceptadas[doctor_id].append(intervalo)
+            por_estado[cambios[pk]].append(pk)
+
+        for estado, ids in por_estado.items():
+            Reserva.objects.filter(pk__in=ids).update(
+                estado=estado, actualizado_en=ahora
+            )
+
+        dias = defaultdict(set)
+        transiciones = []
+        for estado, ids in [("cancelada", canceladas), *por_estado.items()]:
+            for pk in ids:
+                resultados[pk] = ACTUALIZADA
+                doctor_id, paciente_id, anterior, fecha_hora, _ = actuales[pk]
+                valores = {
+                    "doctor_id": doctor_id,
+                    "paciente_id": paciente_id,
+                    "fecha_hora": fecha_hora,
+                }
+                transiciones.append(
+                    ({**valores, "estado": anterior}, {**valores, "estado": estado})
+                )
+                # Solo cancelar o reactivar cambia lo que está ocupado
+                if "cancelada" in (anterior, estado):
+                    dias[doctor_id].add(dia_local(fecha_hora))
+        ajustar_contadores(transiciones)
+        for doctor_id, fechas in dias.items():
+            actualizar_disponibilidad(doctor_id, fechas)
+        invalidar_disponibilidad(*dias)
+
+    return resultados
@@ -0,0 +1,28 @@
+# appointments/fechas.py
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+
+def inicio_del_dia(day):
+    """Medianoche local (aware) de `day`."""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def rango_dias(start_date, end_date):
+    """
+    Convierte el rango de días [start_date, end_date] en el intervalo aware
+    [inicio, fin) equivalente. Filtrar con `fecha_hora__gte/__lt` sobre él
+    aprovecha los índices sobre fecha_hora, a diferencia de `__date__range`,
+    que aplica una función a la columna.
+    """
+    return inicio_del_dia(start_date), inicio_del_dia(end_date + timedelta(days=1))
+
+
+def dia_local(fecha_hora):
+    """Día (en la zona horaria local) en que cae `fecha_hora`."""
+    if fecha_hora is None:
+        return None
+    if timezone.is_aware(fecha_hora):
+        return timezone.localdate(fecha_hora)
+    return fecha_hora.date()
@@ -0,0 +1,118 @@
+# appointments/horarios.py
+"""
+Copia de una plantilla semanal a los horarios (HorarioDoctor) de un doctor.
+
+HorarioDoctor no tiene señales, así que todo se hace con operaciones en lote:
+un DELETE, un INSERT y, en modo diferencial, un UPDATE como máximo.
+"""
+
+from collections import defaultdict
+
+from django.utils import timezone
+
+from .models import HorarioDoctor
+
+COMPLETO = "completo"
+DIFERENCIAL = "diferencial"
+MODOS = (COMPLETO, DIFERENCIAL)
+
+
+def _diferencia(existentes, bloques):
+    """
+    Empareja los horarios existentes con los bloques deseados
+    (dia_semana, hora_inicio, hora_fin). Un bloque idéntico conserva su fila;
+    los que no coinciden se emparejan, por día y en orden de hora, con las
+    filas sobrantes de ese mismo día, que se actualizan con el nuevo horario.
+
+    Devuelve (conservados, movidos, nuevos, sobrantes): filas sin cambio de
+    horario, pares (fila, bloque) a actualizar, bloques a insertar y filas a
+    borrar.
+    """
+    actuales = {(h.dia_semana, h.hora_inicio, h.hora_fin): h for h in existentes}
+    conservados = [actuales[clave] for clave in bloques if clave in actuales]
+
+    deseados = set(bloques)
+    libres = defaultdict(list)
+    for clave, horario in sorted(actuales.items()):
+        if clave not in deseados:
+            libres[clave[0]].append(horario)
+
+    movidos, nuevos = [], []
+    for clave in bloques:
+        if clave in actuales:
+            continue
+        if libres[clave[0]]:
+            movidos.append((libres[clave[0]].pop(0), clave))
+        else:
+            nuevos.append(clave)
+    sobrantes = [h for filas in libres.values() for h in filas]
+    return conservados, movidos, nuevos, sobrantes
+
+
+def aplicar_plantilla(template, doctor, modo=COMPLETO):
+    """
+    Deja los horarios de `doctor` iguales a los bloques de `template`, todos
+    activos. Debe llamarse dentro de una transacción.
+
+    En modo COMPLETO se borran todos los horarios y se insertan de nuevo. En
+    modo DIFERENCIAL solo se tocan los bloques que cambian: un bloque cuyo día
+    sigue en la plantilla con otra hora se actualiza en su fila, los que
+    sobran se borran, los que faltan se insertan y los desactivados se
+    reactivan; el resto conserva su fila sin escribirse.
+
+    Devuelve (horarios, cambios), con los horarios resultantes ordenados y
+    cuántas filas se crearon, actualizaron y eliminaron.
+    """
+    bloques = list(
+        dict.fromkeys(
+            template.items.order_by("dia_semana", "hora_inicio").values_list(
+                "dia_semana", "hora_inicio", "hora_fin"
+            )
+        )
+    )
+    existentes = HorarioDoctor.objects.filter(doctor=doctor)
+
+    if modo == COMPLETO:
+        eliminados, _ = existentes.delete()
+        conservados, movidos, nuevos = [], [], bloques
+    else:
+        conservados, movidos, nuevos, sobrantes = _diferencia(existentes, bloques)
+        eliminados = 0
+        if sobrantes:
+            eliminados, _ = HorarioDoctor.objects.filter(
+                pk__in=[h.pk for h in sobrantes]
+            ).delete()
+
+    # Ningún horario nuevo coincide con una fila que se conserve (si no, esa
+    # fila se habría conservado tal cual), así que el UPDATE no choca con
+    # unique_together.
+    actualizados = [h for h in conservados if not h.activo]
+    for horario, (_, hora_inicio, hora_fin) in movidos:
+        horario.hora_inicio, horario.hora_fin = hora_inicio, hora_fin
+        actualizados.append(horario)
+    if actualizados:
+        # bulk_update() no pasa por auto_now
+        ahora = timezone.now()
+        for horario in actualizados:
+            horario.activo, horario.actualizado_en = True, ahora
+        HorarioDoctor.objects.bulk_update(
+            actualizados, ["hora_inicio", "hora_fin", "activo", "actualizado_en"]
+        )
+
+    creados = HorarioDoctor.objects.bulk_create(
+        HorarioDoctor(doctor=doctor, dia_semana=dia, hora_inicio=inicio, hora_fin=fin)
+        for dia, inicio, fin in nuevos
+    )
+    conservados += [horario for horario, _ in movidos]
+    for horario in conservados:
+        horario.doctor = doctor
+
+    horarios = sorted(
+        conservados + creados, key=lambda h: (h.dia_semana, h.hora_inicio)
+    )
+    cambios = {
+        "creados": len(creados),
+        "actualizados": len(actualizados),
+        "eliminados": eliminados,
+    }
+    return horarios, cambios
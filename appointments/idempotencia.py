@@ -0,0 +1,152 @@
+# appointments/idempotencia.py
+"""
+Soporte de la cabecera `Idempotency-Key` en las escrituras de reservas.
+
+La primera petición con una clave inserta una fila "en curso" (la restricción
+única (usuario, clave) hace de candado entre reintentos simultáneos), ejecuta
+la vista y guarda su respuesta. Los reintentos con la misma clave y el mismo
+cuerpo reciben esa respuesta sin volver a validar ni tocar las reservas.
+Una fila que sigue "en curso" pasado IDEMPOTENCIA_EN_CURSO_TTL se da por
+abandonada (el proceso murió o se cortó) y la clave vuelve a quedar libre.
+"""
+
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import ClaveIdempotencia
+from .principal import get_auth0_id
+
+CABECERA = "Idempotency-Key"
+# Segundos durante los que se recuerda una respuesta
+TTL = getattr(settings, "IDEMPOTENCIA_TTL", 24 * 60 * 60)
+# Segundos tras los que una petición "en curso" se da por abandonada
+EN_CURSO_TTL = getattr(settings, "IDEMPOTENCIA_EN_CURSO_TTL", 60)
+# Cada cuántos segundos, como mucho, se borran en bloque las claves vencidas
+BARRIDO_INTERVALO = getattr(settings, "IDEMPOTENCIA_BARRIDO", 600)
+
+_ultimo_barrido = 0.0
+
+
+def barrer_claves_vencidas(forzar=False):
+    """Borra las claves vencidas con un único DELETE; devuelve cuántas."""
+    global _ultimo_barrido
+    ahora = time.monotonic()
+    if not forzar and ahora - _ultimo_barrido < BARRIDO_INTERVALO:
+        return 0
+    _ultimo_barrido = ahora
+    borradas, _ = ClaveIdempotencia.objects.filter(
+        expira_en__lte=timezone.now()
+    ).delete()
+    return borradas
+
+
+def huella_peticion(request):
+    """sha256 de método, ruta y cuerpo (JSON canónico) de la petición."""
+    cuerpo = json.dumps(request.data, sort_keys=True, cls=JSONEncoder, default=str)
+    contenido = "\n".join([request.method, request.path, cuerpo])
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+def _vencida(registro, ahora):
+    """Vencida por TTL, o "en curso" desde hace más de EN_CURSO_TTL."""
+    abandonada = registro.estado_http is None and (
+        ahora - registro.creado_en > timedelta(seconds=EN_CURSO_TTL)
+    )
+    return registro.expira_en <= ahora or abandonada
+
+
+def _reservar_clave(usuario, clave, huella):
+    """
+    Inserta la fila "en curso" y la devuelve, o devuelve la fila existente
+    (con `_existente = True`) si otra petición ya usó la clave.
+    """
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                return ClaveIdempotencia.objects.create(
+                    usuario=usuario,
+                    clave=clave,
+                    huella=huella,
+                    expira_en=timezone.now() + timedelta(seconds=TTL),
+                )
+        except IntegrityError:
+            registro = ClaveIdempotencia.objects.filter(
+                usuario=usuario, clave=clave
+            ).first()
+            if registro is None:
+                continue
+            if _vencida(registro, timezone.now()):
+                # Vencida o abandonada: se trata como si no existiera
+                registro.delete()
+                continue
+            registro._existente = True
+            return registro
+    raise IntegrityError("No se pudo registrar la Idempotency-Key.")
+
+
+def idempotente(vista):
+    """
+    Decora un método de un ViewSet para respetar `Idempotency-Key`. Sin la
+    cabecera la vista se ejecuta igual que siempre.
+    """
+
+    @functools.wraps(vista)
+    def envoltura(self, request, *args, **kwargs):
+        clave = request.headers.get(CABECERA)
+        if not clave:
+            return vista(self, request, *args, **kwargs)
+        if len(clave) > 255:
+            return Response(
+                {"error": f"{CABECERA} no puede superar 255 caracteres."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        barrer_claves_vencidas()
+        huella = huella_peticion(request)
+        registro = _reservar_clave(get_auth0_id(request.user), clave, huella)
+
+        if getattr(registro, "_existente", False):
+            if registro.huella != huella:
+                return Response(
+                    {"error": f"La {CABECERA} ya se usó con otra petición."},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if registro.estado_http is None:
+                return Response(
+                    {"error": f"Hay una petición en curso con esta {CABECERA}."},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            return Response(
+                registro.respuesta,
+                status=registro.estado_http,
+                headers={"Idempotent-Replayed": "true"},
+            )
+
+        try:
+            response = vista(self, request, *args, **kwargs)
+        except Exception:
+            # Sin respuesta que recordar: el cliente puede reintentar
+            registro.delete()
+            raise
+
+        if response.status_code >= 500:
+            registro.delete()
+        else:
+            # Si la petición tardó más que EN_CURSO_TTL otro reintento pudo
+            # haber borrado la fila; update() no falla en ese caso.
+            ClaveIdempotencia.objects.filter(pk=registro.pk).update(
+                estado_http=response.status_code, respuesta=response.data
+            )
+        return response
+
+    return envoltura
@@ -0,0 +1,126 @@
+# appointments/management/benchutils.py
+"""
+Utilidades compartidas por los comandos de benchmark: una base de datos
+desechable y un generador de datos sintéticos con volúmenes realistas.
+"""
+
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from ..estadisticas import reconstruir_contadores
+from ..models import CustomUser, Doctor, Paciente, Procedimiento, Reserva
+
+
+@contextmanager
+def base_de_datos_temporal():
+    """
+    Ejecuta el bloque contra una base de datos de prueba recién creada (con
+    todas las migraciones) y la destruye al salir; nunca toca datos reales.
+    """
+    nombre_original = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(nombre_original, verbosity=0)
+
+
+def sembrar(reservas=50000, doctores=20, pacientes=1000, dias=730, semilla=0):
+    """
+    Crea doctores, pacientes, procedimientos y `reservas` reservas repartidas
+    en `dias` días centrados en hoy, con bulk_create (sin señales, así que los
+    contadores de los dashboards se reconstruyen al final).
+    """
+    rng = random.Random(semilla)
+
+    def crear_usuarios(prefijo, cantidad, rol):
+        return CustomUser.objects.bulk_create(
+            [
+                CustomUser(
+                    auth0_id=f"bench|{prefijo}{i}",
+                    email=f"{prefijo}{i}@bench.local",
+                    first_name=prefijo.capitalize(),
+                    last_name=str(i),
+                    role=rol,
+                    password="!",
+                )
+                for i in range(cantidad)
+            ]
+        )
+
+    doctores_creados = Doctor.objects.bulk_create(
+        [
+            Doctor(user=user, especialidad="General")
+            for user in crear_usuarios("doctor", doctores, "doctor")
+        ]
+    )
+    pacientes_creados = Paciente.objects.bulk_create(
+        [
+            Paciente(user=user)
+            for user in crear_usuarios("paciente", pacientes, "paciente")
+        ]
+    )
+    procedimientos = Procedimiento.objects.bulk_create(
+        [
+            Procedimiento(nombre=f"Procedimiento bench {minutos}", duracion_min=minutos)
+            for minutos in (30, 45, 60, 90)
+        ]
+    )
+    for doctor in doctores_creados:
+        doctor.procedimientos.set(rng.sample(procedimientos, 2))
+
+    estados = ["pendiente", "confirmada", "cancelada"]
+    pesos = [2, 6, 2]
+    inicio = timezone.make_aware(
+        datetime.combine(
+            timezone.localdate() - timedelta(days=dias // 2), datetime.min.time()
+        )
+    )
+    lote = []
+    for _ in range(reservas):
+        procedimiento = rng.choice(procedimientos)
+        fecha_hora = inicio + timedelta(
+            days=rng.randrange(dias), minutes=8 * 60 + 30 * rng.randrange(20)
+        )
+        lote.append(
+            Reserva(
+                paciente=rng.choice(pacientes_creados),
+                doctor=rng.choice(doctores_creados),
+                procedimiento=procedimiento,
+                fecha_hora=fecha_hora,
+                duracion_min=procedimiento.duracion_min,
+                # bulk_create no pasa por Reserva.save()
+                fecha_fin=fecha_hora + timedelta(minutes=procedimiento.duracion_min),
+                estado=rng.choices(estados, pesos)[0],
+            )
+        )
+        if len(lote) == 5000:
+            Reserva.objects.bulk_create(lote)
+            lote = []
+    Reserva.objects.bulk_create(lote)
+    reconstruir_contadores()
+
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+    return {
+        "doctores": doctores_creados,
+        "pacientes": pacientes_creados,
+        "procedimientos": procedimientos,
+    }
+
+
+def medir(funcion, repeticiones=5):
+    """Devuelve la mediana en milisegundos de `repeticiones` ejecuciones."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tiempos)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...agenda import barrer_temporales_vencidas
+
+
+class Command(BaseCommand):
+    help = (
+        "Borra en bloque las reservas temporales vencidas. Las consultas ya "
+        "las ignoran; esto solo mantiene la tabla pequeña."
+    )
+
+    def handle(self, *args, **options):
+        borradas = barrer_temporales_vencidas(forzar=True)
+        self.stdout.write(
+            self.style.SUCCESS(f"{borradas} reservas temporales vencidas eliminadas.")
+        )
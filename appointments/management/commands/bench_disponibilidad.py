@@ -0,0 +1,87 @@
+import random
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ... import disponibilidad
+from ..benchutils import medir
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara el paso de slots (restar reservas y expandir) en Python puro "
+        "con el camino vectorizado de NumPy sobre plantillas y reservas sintéticas de varios doctores "
+        "(sin base de datos), para ajustar DISPONIBILIDAD_NUMPY_MIN_BLOQUES."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--doctores", type=int, default=50)
+        parser.add_argument(
+            "--dias", type=int, nargs="+", default=[1, 7, 14, 31, 62, 92, 365]
+        )
+        parser.add_argument("--duracion", type=int, default=30)
+        parser.add_argument("--semilla", type=int, default=1)
+
+    def handle(self, *args, **options):
+        if disponibilidad.np is None:
+            raise CommandError("NumPy no está instalado.")
+
+        rng = random.Random(options["semilla"])
+        duracion = options["duracion"]
+        start_date = timezone.localdate()
+        # Mañana y tarde de lunes a viernes, mañana los sábados
+        items_por_dia = {dia: [(540, 780), (900, 1140)] for dia in range(5)}
+        items_por_dia[5] = [(540, 780)]
+
+        for dias in options["dias"]:
+            end_date = start_date + timedelta(days=dias - 1)
+            bloques = disponibilidad.expandir_bloques(
+                items_por_dia, start_date, end_date
+            )
+            # Las reservas ya convertidas a minutos: ese paso es común a ambos
+            # caminos y no forma parte de lo que se compara.
+            doctores = [
+                (
+                    bloques,
+                    disponibilidad.intervalos_ocupados(
+                        self.reservas(rng, start_date, bloques), start_date
+                    ),
+                )
+                for _ in range(options["doctores"])
+            ]
+
+            # Solo el paso que decide NUMPY_MIN_BLOQUES (restar y expandir en
+            # slots); la conversión a ISO va aparte en ambos caminos.
+            def python():
+                for bloques, ocupados in doctores:
+                    disponibilidad.generar_slots(
+                        disponibilidad.restar_intervalos(bloques, ocupados), duracion
+                    )
+
+            def vectorizado():
+                for bloques, ocupados in doctores:
+                    disponibilidad.calcular_slots_numpy(bloques, ocupados, duracion)
+
+            ms_python = medir(python)
+            ms_numpy = medir(vectorizado)
+            self.stdout.write(
+                f"{dias:>4} días x {options['doctores']} doctores "
+                f"({len(bloques)} bloques c/u): python {ms_python:8.2f} ms | "
+                f"numpy {ms_numpy:8.2f} ms | x{ms_python / ms_numpy:.1f}"
+            )
+
+    def reservas(self, rng, start_date, bloques):
+        """Ocupa al azar cerca de la mitad de los slots de cada bloque."""
+        inicio_dia = timezone.make_aware(disponibilidad.a_datetime(start_date, 0))
+        reservas = []
+        for inicio, fin in bloques:
+            for minuto in range(inicio, fin, 30):
+                if rng.random() < 0.5:
+                    reservas.append(
+                        (
+                            inicio_dia + timedelta(minutes=minuto),
+                            rng.choice((30, 45, 60)),
+                        )
+                    )
+        return reservas
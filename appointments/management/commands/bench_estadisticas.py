@@ -0,0 +1,87 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ...estadisticas import resumen_admin, resumen_doctor
+from ...fechas import rango_dias
+from ...models import Paciente, Reserva
+from ..benchutils import base_de_datos_temporal, medir, sembrar
+
+
+class Command(BaseCommand):
+    help = (
+        "Siembra una base de datos temporal y compara, en consultas y latencia, "
+        "los resúmenes de admin_stats y doctor_stats con un count() por cifra "
+        "sobre Reserva frente a la lectura de los contadores de estadisticas.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reservas", type=int, default=300000)
+        parser.add_argument("--doctores", type=int, default=50)
+        parser.add_argument("--pacientes", type=int, default=5000)
+        parser.add_argument("--repeticiones", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with base_de_datos_temporal():
+            datos = sembrar(
+                reservas=options["reservas"],
+                doctores=options["doctores"],
+                pacientes=options["pacientes"],
+            )
+            doctor_id = datos["doctores"][0].id
+            hoy = timezone.localdate()
+            semana = (hoy - timedelta(days=hoy.weekday()),)
+            semana += (semana[0] + timedelta(days=6),)
+
+            casos = {
+                "admin_stats": (
+                    lambda: self.admin_por_separado(*semana),
+                    lambda: resumen_admin(*semana),
+                ),
+                "doctor_stats": (
+                    lambda: self.doctor_por_separado(doctor_id, *semana),
+                    lambda: resumen_doctor(doctor_id, *semana),
+                ),
+            }
+            for nombre, (por_separado, contadores) in casos.items():
+                if por_separado() != contadores():
+                    self.stderr.write(f"{nombre}: los resultados no coinciden")
+                self.stdout.write(self.style.MIGRATE_HEADING(f"\n== {nombre}"))
+                for etiqueta, funcion in (
+                    ("un count() por cifra", por_separado),
+                    ("contadores", contadores),
+                ):
+                    with CaptureQueriesContext(connection) as ctx:
+                        funcion()
+                    ms = medir(funcion, options["repeticiones"])
+                    self.stdout.write(
+                        f"{etiqueta:<24} {len(ctx.captured_queries)} consultas "
+                        f"{ms:8.2f} ms"
+                    )
+
+    def admin_por_separado(self, start_date, end_date):
+        inicio, fin = rango_dias(start_date, end_date)
+        pendientes = Reserva.objects.filter(estado="pendiente")
+        return {
+            "citas_pendientes": pendientes.count(),
+            "citas_semana": pendientes.filter(
+                fecha_hora__gte=inicio, fecha_hora__lt=fin
+            ).count(),
+            "total_pacientes": Paciente.objects.count(),
+        }
+
+    def doctor_por_separado(self, doctor_id, start_date, end_date):
+        inicio, fin = rango_dias(start_date, end_date)
+        reservas = Reserva.objects.filter(doctor_id=doctor_id)
+        return {
+            "citas_pendientes": reservas.filter(
+                estado="pendiente", fecha_hora__gte=timezone.now()
+            ).count(),
+            "citas_semana": reservas.filter(
+                fecha_hora__gte=inicio, fecha_hora__lt=fin
+            ).count(),
+            "total_pacientes": reservas.values("paciente").distinct().count(),
+        }
@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from ...agenda import filtro_solape
+from ...models import Reserva
+from ..benchutils import base_de_datos_temporal, medir, sembrar
+
+
+class Command(BaseCommand):
+    help = (
+        "Siembra una base de datos temporal y muestra el plan de ejecución y la "
+        "latencia de las consultas frecuentes sobre Reserva sin y con los "
+        "índices compuestos de Reserva.Meta.indexes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reservas", type=int, default=50000)
+        parser.add_argument("--doctores", type=int, default=20)
+        parser.add_argument("--pacientes", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with base_de_datos_temporal():
+            datos = sembrar(
+                reservas=options["reservas"],
+                doctores=options["doctores"],
+                pacientes=options["pacientes"],
+            )
+            consultas = self.consultas(datos)
+
+            indices = list(Reserva._meta.indexes)
+            with connection.schema_editor() as editor:
+                for index in indices:
+                    editor.remove_index(Reserva, index)
+            self.analizar()
+            antes = self.ejecutar(consultas)
+
+            with connection.schema_editor() as editor:
+                for index in indices:
+                    editor.add_index(Reserva, index)
+            self.analizar()
+            despues = self.ejecutar(consultas)
+
+        for nombre in consultas:
+            plan_antes, ms_antes = antes[nombre]
+            plan_despues, ms_despues = despues[nombre]
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n== {nombre}"))
+            self.stdout.write(f"-- sin índices ({ms_antes:.2f} ms)\n{plan_antes}")
+            self.stdout.write(f"-- con índices ({ms_despues:.2f} ms)\n{plan_despues}")
+
+    def consultas(self, datos):
+        doctor = datos["doctores"][0]
+        paciente = datos["pacientes"][0]
+        hoy = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        semana = (hoy, hoy + timedelta(days=7))
+        return {
+            "calendario del doctor (solape con la ventana)": Reserva.objects.filter(
+                filtro_solape(*semana), doctor=doctor
+            ),
+            "conflictos de una nueva reserva": Reserva.objects.filter(
+                filtro_solape(hoy + timedelta(hours=9), hoy + timedelta(hours=10)),
+                doctor=doctor,
+            ).exclude(estado="cancelada"),
+            "reservas de un paciente": Reserva.objects.filter(
+                paciente=paciente
+            ).order_by("fecha_hora", "id")[:50],
+            "filterset por estado": Reserva.objects.filter(
+                estado="confirmada"
+            ).order_by("fecha_hora", "id")[:50],
+            "listado paginado": Reserva.objects.filter(fecha_hora__gt=hoy).order_by(
+                "fecha_hora", "id"
+            )[:50],
+            "pendientes de la semana (admin_stats)": Reserva.objects.filter(
+                estado="pendiente",
+                fecha_hora__gte=semana[0],
+                fecha_hora__lt=semana[1],
+            ),
+            "pendientes futuras del doctor (doctor_stats)": Reserva.objects.filter(
+                doctor=doctor, estado="pendiente", fecha_hora__gte=hoy
+            ),
+        }
+
+    def ejecutar(self, consultas):
+        return {
+            nombre: (queryset.explain(), medir(lambda: list(queryset.all())))
+            for nombre, queryset in consultas.items()
+        }
+
+    def analizar(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
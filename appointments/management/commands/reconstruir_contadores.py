@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...estadisticas import reconstruir_contadores
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula desde las reservas los contadores de los dashboards "
+        "(ContadorReservas y ContadorPacientes). Solo hace falta si se "
+        "modificaron reservas sin pasar por el ORM o por bulk_create."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--doctor", type=int, action="append", help="Solo estos doctores."
+        )
+
+    def handle(self, *args, **options):
+        inicio = timezone.now()
+        dias, pacientes = reconstruir_contadores(options["doctor"])
+        segundos = (timezone.now() - inicio).total_seconds()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{dias} contadores por día y {pacientes} por paciente "
+                f"reconstruidos en {segundos:.2f}s."
+            )
+        )
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...disponibilidad import horizonte, materializar_disponibilidad
+from ...models import DisponibilidadDia, Doctor
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconstruye por completo la disponibilidad materializada "
+        "(DisponibilidadDia) de todos los doctores sobre el horizonte "
+        "configurado y borra los días que ya pasaron. Conviene ejecutarlo a "
+        "diario para que el horizonte avance."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--doctor", type=int, action="append", help="Solo estos doctores."
+        )
+        parser.add_argument("--lote", type=int, default=200, help="Doctores por lote.")
+
+    def handle(self, *args, **options):
+        doctor_ids = options["doctor"] or list(
+            Doctor.objects.order_by("id").values_list("id", flat=True)
+        )
+        primero, ultimo = horizonte()
+        borrados, _ = DisponibilidadDia.objects.filter(fecha__lt=primero).delete()
+
+        inicio = timezone.now()
+        filas = 0
+        lote = max(1, options["lote"])
+        for i in range(0, len(doctor_ids), lote):
+            filas += materializar_disponibilidad(doctor_ids[i : i + lote])
+
+        segundos = (timezone.now() - inicio).total_seconds()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{filas} días materializados para {len(doctor_ids)} doctores "
+                f"({primero} a {ultimo}) en {segundos:.2f}s; "
+                f"{borrados} días pasados eliminados."
+            )
+        )
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0009_procedimiento_imagen_delete_mensaje"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="reserva",
+            index=models.Index(
+                fields=["doctor", "fecha_hora"], name="reserva_doctor_fecha_idx"
+            ),
+        ),
+    ]
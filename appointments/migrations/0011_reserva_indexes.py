@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0010_reserva_doctor_fecha_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="reserva",
+            index=models.Index(
+                fields=["paciente", "fecha_hora"], name="reserva_paciente_fecha_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="reserva",
+            index=models.Index(
+                fields=["estado", "fecha_hora"], name="reserva_estado_fecha_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="reserva",
+            index=models.Index(
+                fields=["fecha_hora", "id"], name="reserva_fecha_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="reserva",
+            index=models.Index(
+                condition=models.Q(("estado", "pendiente")),
+                fields=["fecha_hora"],
+                name="reserva_pendiente_fecha_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0011_reserva_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DisponibilidadDia",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fecha", models.DateField()),
+                ("libres", models.JSONField(default=list)),
+                ("actualizado_en", models.DateTimeField(auto_now=True)),
+                (
+                    "doctor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="disponibilidad_dias",
+                        to="appointments.doctor",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["doctor", "fecha"],
+                "unique_together": {("doctor", "fecha")},
+            },
+        ),
+    ]
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def calcular_fecha_fin(apps, schema_editor):
+    Reserva = apps.get_model("appointments", "Reserva")
+    lote = []
+    for reserva in (
+        Reserva.objects.only("id", "fecha_hora", "duracion_min")
+        .order_by("id")
+        .iterator(chunk_size=2000)
+    ):
+        reserva.fecha_fin = reserva.fecha_hora + timedelta(minutes=reserva.duracion_min)
+        lote.append(reserva)
+        if len(lote) == 2000:
+            Reserva.objects.bulk_update(lote, ["fecha_fin"])
+            lote = []
+    Reserva.objects.bulk_update(lote, ["fecha_fin"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0012_disponibilidaddia"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="reserva",
+            name="fecha_fin",
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(calcular_fecha_fin, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="reserva",
+            name="fecha_fin",
+            field=models.DateTimeField(editable=False),
+        ),
+        migrations.RemoveIndex(
+            model_name="reserva",
+            name="reserva_doctor_fecha_idx",
+        ),
+        migrations.AddIndex(
+            model_name="reserva",
+            index=models.Index(
+                fields=["doctor", "fecha_hora", "fecha_fin"],
+                name="reserva_doctor_rango_idx",
+            ),
+        ),
+    ]
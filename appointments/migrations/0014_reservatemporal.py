@@ -0,0 +1,57 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0013_reserva_fecha_fin"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReservaTemporal",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fecha_hora", models.DateTimeField()),
+                ("duracion_min", models.PositiveIntegerField(default=30)),
+                ("fecha_fin", models.DateTimeField(editable=False)),
+                ("expira_en", models.DateTimeField(db_index=True)),
+                ("creado_en", models.DateTimeField(auto_now_add=True)),
+                (
+                    "doctor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="reservas_temporales",
+                        to="appointments.doctor",
+                    ),
+                ),
+                (
+                    "paciente",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="reservas_temporales",
+                        to="appointments.paciente",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["doctor", "fecha_hora", "fecha_fin"],
+                        name="temporal_doctor_rango_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:27
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0014_reservatemporal"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClaveIdempotencia",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("usuario", models.CharField(max_length=255)),
+                ("clave", models.CharField(max_length=255)),
+                ("huella", models.CharField(max_length=64)),
+                (
+                    "estado_http",
+                    models.PositiveSmallIntegerField(blank=True, null=True),
+                ),
+                (
+                    "respuesta",
+                    models.JSONField(
+                        blank=True,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                        null=True,
+                    ),
+                ),
+                ("creado_en", models.DateTimeField(auto_now_add=True)),
+                ("expira_en", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "unique_together": {("usuario", "clave")},
+            },
+        ),
+    ]
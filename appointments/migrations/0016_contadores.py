@@ -0,0 +1,119 @@
+# Generated by Django 5.2.5 on 2026-10-17 00:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def calcular_contadores(apps, schema_editor):
+    Reserva = apps.get_model("appointments", "Reserva")
+    ContadorReservas = apps.get_model("appointments", "ContadorReservas")
+    ContadorPacientes = apps.get_model("appointments", "ContadorPacientes")
+    reservas = Reserva.objects.order_by()
+    ContadorReservas.objects.bulk_create(
+        [
+            ContadorReservas(**fila)
+            for fila in reservas.annotate(fecha=TruncDate("fecha_hora"))
+            .values("doctor_id", "fecha", "estado")
+            .annotate(total=Count("*"))
+        ],
+        batch_size=2000,
+    )
+    ContadorPacientes.objects.bulk_create(
+        [
+            ContadorPacientes(**fila)
+            for fila in reservas.values("doctor_id", "paciente_id").annotate(
+                total=Count("*")
+            )
+        ],
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0015_claveidempotencia"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ContadorPacientes",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("total", models.IntegerField(default=0)),
+                (
+                    "doctor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="contadores_pacientes",
+                        to="appointments.doctor",
+                    ),
+                ),
+                (
+                    "paciente",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="appointments.paciente",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("doctor", "paciente")},
+            },
+        ),
+        migrations.CreateModel(
+            name="ContadorReservas",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fecha", models.DateField()),
+                (
+                    "estado",
+                    models.CharField(
+                        choices=[
+                            ("pendiente", "Pendiente"),
+                            ("confirmada", "Confirmada"),
+                            ("cancelada", "Cancelada"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("total", models.IntegerField(default=0)),
+                (
+                    "doctor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="contadores_reservas",
+                        to="appointments.doctor",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["estado", "fecha", "total"],
+                        name="contador_estado_fecha_idx",
+                    )
+                ],
+                "unique_together": {("doctor", "fecha", "estado")},
+            },
+        ),
+        migrations.RunPython(calcular_contadores, migrations.RunPython.noop),
+    ]
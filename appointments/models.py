@@ -1,3 +1,6 @@
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import (
@@ -99,6 +102,8 @@ class Reserva(models.Model):
     )
     fecha_hora = models.DateTimeField()
     duracion_min = models.PositiveIntegerField(default=30)
+    # fecha_hora + duracion_min, guardado para poder filtrar solapes en la base
+    fecha_fin = models.DateTimeField(editable=False)
     estado = models.CharField(
         max_length=20, choices=ESTADO_CHOICES, default="pendiente"
     )
@@ -106,6 +111,49 @@ class Reserva(models.Model):
     actualizado_en = models.DateTimeField(auto_now=True)
     notas_doctor = models.TextField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Calendario y solapes del doctor: WHERE doctor_id = ? AND
+            # fecha_hora < fin AND fecha_fin > inicio, resuelto en el índice
+            models.Index(
+                fields=["doctor", "fecha_hora", "fecha_fin"],
+                name="reserva_doctor_rango_idx",
+            ),
+            # Reservas de un paciente ordenadas por fecha
+            models.Index(
+                fields=["paciente", "fecha_hora"], name="reserva_paciente_fecha_idx"
+            ),
+            # Filtro por estado (filterset de ReservaViewSet) ordenado por fecha
+            models.Index(
+                fields=["estado", "fecha_hora"], name="reserva_estado_fecha_idx"
+            ),
+            # Listado completo paginado por (fecha_hora, id)
+            models.Index(fields=["fecha_hora", "id"], name="reserva_fecha_id_idx"),
+            # Contadores de pendientes (admin_stats): índice parcial y pequeño
+            models.Index(
+                fields=["fecha_hora"],
+                condition=models.Q(estado="pendiente"),
+                name="reserva_pendiente_fecha_idx",
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Valores tal como se leyeron de la base, para que las señales sepan
+        # de dónde se movió una reserva sin volver a consultarla.
+        instance._valores_originales = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.fecha_fin = self.fecha_hora + timedelta(minutes=self.duracion_min)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"fecha_hora", "duracion_min"} & set(
+            update_fields
+        ):
+            kwargs["update_fields"] = {*update_fields, "fecha_fin"}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         paciente_nombre = (
             getattr(self.paciente.user, "first_name", "")
@@ -224,3 +272,132 @@ class HorarioTemplateItem(models.Model):
 
     def __str__(self):
         return f"Día {self.get_dia_semana_display()} de {self.hora_inicio} a {self.hora_fin}"
+
+
+class ReservaTemporal(models.Model):
+    """
+    Hueco retenido por un paciente mientras confirma la reserva. Cuenta como
+    ocupado hasta `expira_en`; las vencidas se ignoran en las consultas y se
+    borran en bloque (ver agenda.barrer_temporales_vencidas).
+    """
+
+    paciente = models.ForeignKey(
+        "Paciente", on_delete=models.CASCADE, related_name="reservas_temporales"
+    )
+    doctor = models.ForeignKey(
+        "Doctor", on_delete=models.CASCADE, related_name="reservas_temporales"
+    )
+    fecha_hora = models.DateTimeField()
+    duracion_min = models.PositiveIntegerField(default=30)
+    fecha_fin = models.DateTimeField(editable=False)
+    expira_en = models.DateTimeField(db_index=True)
+    creado_en = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["doctor", "fecha_hora", "fecha_fin"],
+                name="temporal_doctor_rango_idx",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.fecha_fin = self.fecha_hora + timedelta(minutes=self.duracion_min)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.paciente} retiene {self.fecha_hora:%Y-%m-%d %H:%M} hasta {self.expira_en:%H:%M:%S}"
+
+
+class DisponibilidadDia(models.Model):
+    """
+    Tramos libres materializados de un doctor en un día: plantilla activa
+    menos reservas no canceladas, en minutos desde la medianoche local.
+    Se mantiene incrementalmente (ver disponibilidad.actualizar_disponibilidad)
+    y se reconstruye con `manage.py reconstruir_disponibilidad`.
+    """
+
+    doctor = models.ForeignKey(
+        "Doctor", on_delete=models.CASCADE, related_name="disponibilidad_dias"
+    )
+    fecha = models.DateField()
+    libres = models.JSONField(default=list)
+    actualizado_en = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("doctor", "fecha")
+        ordering = ["doctor", "fecha"]
+
+    def __str__(self):
+        return f"{self.doctor} - {self.fecha}"
+
+
+class ContadorReservas(models.Model):
+    """
+    Número de reservas de un doctor por día (local) y estado. Lo mantienen en
+    la misma transacción las señales de Reserva y los cambios de estado en
+    lote (ver estadisticas.ajustar_contadores); se reconstruye con
+    `manage.py reconstruir_contadores`. Los dashboards leen de aquí.
+    """
+
+    doctor = models.ForeignKey(
+        "Doctor", on_delete=models.CASCADE, related_name="contadores_reservas"
+    )
+    fecha = models.DateField()
+    estado = models.CharField(max_length=20, choices=Reserva.ESTADO_CHOICES)
+    total = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("doctor", "fecha", "estado")
+        indexes = [
+            # Totales globales por estado (admin_stats): incluye `total` para
+            # sumarlos sin leer la tabla
+            models.Index(
+                fields=["estado", "fecha", "total"], name="contador_estado_fecha_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor} - {self.fecha} - {self.estado}: {self.total}"
+
+
+class ContadorPacientes(models.Model):
+    """
+    Número de reservas de un paciente con un doctor, para contar sus
+    pacientes distintos sin recorrer su historial. Se mantiene igual que
+    ContadorReservas.
+    """
+
+    doctor = models.ForeignKey(
+        "Doctor", on_delete=models.CASCADE, related_name="contadores_pacientes"
+    )
+    paciente = models.ForeignKey("Paciente", on_delete=models.CASCADE)
+    total = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("doctor", "paciente")
+
+    def __str__(self):
+        return f"{self.doctor} - {self.paciente}: {self.total}"
+
+
+class ClaveIdempotencia(models.Model):
+    """
+    Primera respuesta a una petición con cabecera Idempotency-Key, para
+    devolverla tal cual en los reintentos (ver appointments/idempotencia.py).
+    Mientras la petición original está en curso `estado_http` es NULL.
+    """
+
+    usuario = models.CharField(max_length=255)  # auth0_id
+    clave = models.CharField(max_length=255)
+    huella = models.CharField(max_length=64)  # sha256 de método, ruta y cuerpo
+    estado_http = models.PositiveSmallIntegerField(null=True, blank=True)
+    respuesta = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    creado_en = models.DateTimeField(auto_now_add=True)
+    expira_en = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ("usuario", "clave")
+
+    def __str__(self):
+        return f"{self.usuario} {self.clave} ({self.estado_http or 'en curso'})"
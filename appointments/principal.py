@@ -0,0 +1,178 @@
+# appointments/principal.py
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+
+from .models import CustomUser
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    Datos del CustomUser autenticado que necesitan permisos y vistas:
+    rol, is_staff y los ids de sus perfiles de doctor y paciente.
+    """
+
+    id: int
+    auth0_id: str
+    email: str
+    first_name: str
+    last_name: str
+    role: str
+    is_staff: bool
+    doctor_id: int = None
+    paciente_id: int = None
+
+    @property
+    def nombre(self):
+        return f"{self.first_name} {self.last_name}".strip() or self.email
+
+
+PRINCIPAL_FIELDS = (
+    "id",
+    "auth0_id",
+    "email",
+    "first_name",
+    "last_name",
+    "role",
+    "is_staff",
+)
+
+_UNRESOLVED = object()
+
+
+class PrincipalCache:
+    """
+    Cache entre peticiones de auth0_id -> Principal.
+
+    Por defecto es un LRU local al proceso con TTL. Si se define
+    `PRINCIPAL_CACHE_ALIAS`, las entradas se guardan en ese cache de Django
+    (p. ej. Redis) para que todos los workers compartan las invalidaciones.
+    """
+
+    key_prefix = "principal:"
+
+    def __init__(self, ttl=300, max_size=2048, alias=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.alias = alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return caches[self.alias] if self.alias else None
+
+    def get(self, auth0_id):
+        if self.alias:
+            return self.backend.get(self.key_prefix + auth0_id)
+
+        with self._lock:
+            entry = self._entries.get(auth0_id)
+            if entry is None:
+                return None
+            principal, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[auth0_id]
+                return None
+            self._entries.move_to_end(auth0_id)
+            return principal
+
+    def set(self, auth0_id, principal):
+        if self.alias:
+            self.backend.set(self.key_prefix + auth0_id, principal, self.ttl)
+            return
+
+        with self._lock:
+            self._entries[auth0_id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(auth0_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, auth0_id):
+        if self.alias:
+            self.backend.delete(self.key_prefix + auth0_id)
+            return
+
+        with self._lock:
+            self._entries.pop(auth0_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(
+    ttl=getattr(settings, "PRINCIPAL_CACHE_TTL", 300),
+    max_size=getattr(settings, "PRINCIPAL_CACHE_SIZE", 2048),
+    alias=getattr(settings, "PRINCIPAL_CACHE_ALIAS", None),
+)
+
+
+def invalidate_principal(auth0_id):
+    """
+    Descarta el Principal cacheado de un usuario. Se repite al hacer commit
+    para que una petición concurrente no vuelva a cachear datos anteriores.
+    """
+    if not auth0_id:
+        return
+    principal_cache.delete(auth0_id)
+    transaction.on_commit(lambda: principal_cache.delete(auth0_id))
+
+
+def get_auth0_id(user):
+    """Extrae el auth0_id del usuario de la petición (Auth0User o CustomUser)."""
+    auth0_id = getattr(user, "auth0_id", None)
+    if not auth0_id and hasattr(user, "payload"):
+        auth0_id = user.payload.get("sub")
+    return auth0_id
+
+
+def load_principal(auth0_id):
+    """
+    Carga el CustomUser y los ids de sus perfiles en una sola consulta
+    (LEFT JOIN contra doctor y paciente).
+    """
+    rows = list(
+        CustomUser.objects.filter(auth0_id=auth0_id).values(
+            *PRINCIPAL_FIELDS,
+            doctor_id=F("doctor_profile__id"),
+            paciente_id=F("paciente_profile__id"),
+        )[:1]
+    )
+    return Principal(**rows[0]) if rows else None
+
+
+def get_principal(request):
+    """
+    Devuelve el `Principal` del usuario autenticado, o None si no existe.
+
+    El resultado se guarda en `request.user.principal`, de modo que todos los
+    permisos y la vista de una misma petición comparten una única consulta, y
+    además en `principal_cache` para las peticiones siguientes.
+    """
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        return None
+
+    principal = getattr(user, "principal", _UNRESOLVED)
+    if principal is not _UNRESOLVED:
+        return principal
+
+    principal = None
+    auth0_id = get_auth0_id(user)
+    if auth0_id:
+        principal = principal_cache.get(auth0_id)
+        if principal is None:
+            principal = load_principal(auth0_id)
+            if principal is not None:
+                principal_cache.set(auth0_id, principal)
+
+    user.principal = principal
+    return principal
@@ -1,9 +1,11 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import (
     CustomUser,
     Paciente,
     Doctor,
     Reserva,
+    ReservaTemporal,
     Procedimiento,
     HorarioDoctor,
     HorarioSemanalTemplate,
@@ -142,12 +144,85 @@ class ReservaSerializer(serializers.ModelSerializer):
             "procedimiento_id",
             "fecha_hora",
             "duracion_min",
+            "fecha_fin",
             "estado",
             "creado_en",
             "actualizado_en",
             "notas_doctor",
         ]
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Carga todo el árbol anidado (paciente, doctor con sus procedimientos y
+        procedimiento con sus doctores) en un número fijo de consultas.
+        """
+        return queryset.select_related(
+            "paciente__user", "doctor__user", "procedimiento"
+        ).prefetch_related(
+            "doctor__procedimientos",
+            Prefetch(
+                "procedimiento__doctores",
+                queryset=Doctor.objects.select_related("user"),
+            ),
+        )
+
+
+class ReservaTemporalSerializer(serializers.ModelSerializer):
+    """Hueco retenido mientras el paciente confirma la reserva."""
+
+    doctor_id = serializers.PrimaryKeyRelatedField(
+        queryset=Doctor.objects.all(), source="doctor"
+    )
+
+    class Meta:
+        model = ReservaTemporal
+        fields = [
+            "id",
+            "doctor_id",
+            "fecha_hora",
+            "duracion_min",
+            "fecha_fin",
+            "expira_en",
+        ]
+        read_only_fields = ["expira_en"]
+
+
+class ReservaCalendarioSerializer(serializers.ModelSerializer):
+    """
+    Representación compacta de una reserva para el calendario del doctor.
+    Evita el árbol anidado completo de ReservaSerializer.
+    """
+
+    start = serializers.DateTimeField(source="fecha_hora")
+    end = serializers.DateTimeField(source="fecha_fin")
+    paciente = serializers.SerializerMethodField()
+    procedimiento = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Reserva
+        fields = ["id", "start", "end", "estado", "paciente", "procedimiento"]
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related("paciente__user", "procedimiento").only(
+            "id",
+            "fecha_hora",
+            "fecha_fin",
+            "estado",
+            "paciente__user__first_name",
+            "paciente__user__last_name",
+            "paciente__user__email",
+            "procedimiento__nombre",
+        )
+
+    def get_paciente(self, obj):
+        user = obj.paciente.user
+        return f"{user.first_name} {user.last_name}".strip() or user.email
+
+    def get_procedimiento(self, obj):
+        return obj.procedimiento.nombre if obj.procedimiento else None
+
 
 class HorarioDoctorSerializer(serializers.ModelSerializer):
     doctor = serializers.SerializerMethodField(read_only=True)
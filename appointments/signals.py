@@ -1,6 +1,25 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import CustomUser, Doctor, Paciente
+from .models import (
+    CustomUser,
+    Doctor,
+    Paciente,
+    Reserva,
+    HorarioSemanalTemplate,
+    HorarioTemplateItem,
+)
+from .principal import invalidate_principal
+from .fechas import dia_local
+from .disponibilidad import (
+    actualizar_disponibilidad,
+    descartar_sin_plantilla,
+    materializar_al_confirmar,
+)
+from .disponibilidad_cache import invalidar_disponibilidad
+from .estadisticas import CAMPOS_CONTADORES, ajustar_contadores
+
+# Campos de Reserva que afectan a la disponibilidad materializada
+CAMPOS_DISPONIBILIDAD = ("doctor_id", "fecha_hora", "duracion_min", "estado")
 
 
 @receiver(post_save, sender=CustomUser)
@@ -9,6 +28,9 @@ def create_related_profile(sender, instance, created, **kwargs):
     Cada vez que se crea o actualiza un CustomUser,
     se asegura que exista el perfil correspondiente según su rol.
     """
+    # Rol / is_staff pueden haber cambiado: descartar el Principal cacheado
+    invalidate_principal(instance.auth0_id)
+
     # Doctor
     if instance.role == "doctor":
         Doctor.objects.get_or_create(user=instance)
@@ -23,3 +45,117 @@ def create_related_profile(sender, instance, created, **kwargs):
         if not instance.is_staff:
             instance.is_staff = True
             instance.save(update_fields=["is_staff"])
+
+
+@receiver(post_delete, sender=CustomUser)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    invalidate_principal(instance.auth0_id)
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_save, sender=Paciente)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Paciente)
+def invalidate_profile_owner(sender, instance, created=True, **kwargs):
+    """
+    Los ids de perfil del Principal solo cambian cuando un perfil se crea o
+    se elimina; las demás ediciones no afectan al cache.
+    """
+    if not created:
+        return
+    try:
+        invalidate_principal(instance.user.auth0_id)
+    except CustomUser.DoesNotExist:
+        pass
+
+
+@receiver(post_save, sender=Reserva)
+@receiver(post_delete, sender=Reserva)
+def actualizar_disponibilidad_reserva(sender, instance, **kwargs):
+    """
+    Recalcula en DisponibilidadDia los días que toca una reserva: el día
+    anterior y el nuevo si se movió, o el día actual si se creó, canceló o
+    eliminó. Las ediciones que no cambian horario ni estado no hacen nada.
+    """
+    anteriores = getattr(instance, "_valores_originales", {})
+    actuales = {campo: getattr(instance, campo) for campo in CAMPOS_DISPONIBILIDAD}
+    if kwargs.get("created") is False and all(
+        anteriores.get(campo, valor) == valor for campo, valor in actuales.items()
+    ):
+        return
+
+    afectados = {(instance.doctor_id, dia_local(instance.fecha_hora))}
+    if "doctor_id" in anteriores or "fecha_hora" in anteriores:
+        afectados.add(
+            (
+                anteriores.get("doctor_id", instance.doctor_id),
+                dia_local(anteriores.get("fecha_hora", instance.fecha_hora)),
+            )
+        )
+    for doctor_id, fecha in afectados:
+        actualizar_disponibilidad(doctor_id, [fecha])
+    invalidar_disponibilidad(*(doctor_id for doctor_id, _ in afectados))
+
+
+@receiver(post_save, sender=Reserva)
+@receiver(post_delete, sender=Reserva)
+def ajustar_contadores_reserva(sender, instance, signal, created=False, **kwargs):
+    """Mantiene ContadorReservas y ContadorPacientes en la misma transacción."""
+    anteriores = getattr(instance, "_valores_originales", {})
+    actuales = {campo: getattr(instance, campo) for campo in CAMPOS_CONTADORES}
+    guardados = {
+        campo: anteriores.get(campo, valor) for campo, valor in actuales.items()
+    }
+    if signal is post_delete:
+        ajustar_contadores([(guardados, None)])
+    elif created:
+        ajustar_contadores([(None, actuales)])
+    elif guardados != actuales:
+        ajustar_contadores([(guardados, actuales)])
+
+
+@receiver(post_save, sender=Reserva)
+def recordar_valores_guardados(sender, instance, **kwargs):
+    """
+    La instancia sigue viva: las próximas comparaciones de los receptores
+    anteriores (que se ejecutan antes por estar conectados antes) deben
+    partir de lo guardado.
+    """
+    instance._valores_originales = {
+        **getattr(instance, "_valores_originales", {}),
+        **{
+            campo: getattr(instance, campo)
+            for campo in CAMPOS_DISPONIBILIDAD + CAMPOS_CONTADORES
+        },
+    }
+
+
+@receiver(post_save, sender=HorarioSemanalTemplate)
+def materializar_plantilla_activa(sender, instance, **kwargs):
+    """
+    Activar (o editar) la plantilla activa rehace todo el horizonte del doctor
+    al confirmar; desactivar la única que tenía lo deja sin disponibilidad
+    materializada.
+    """
+    if instance.es_activo:
+        materializar_al_confirmar(instance.doctor_id)
+    else:
+        invalidar_disponibilidad(instance.doctor_id)
+        descartar_sin_plantilla(instance.doctor_id)
+
+
+@receiver(post_delete, sender=HorarioSemanalTemplate)
+def invalidar_plantilla_eliminada(sender, instance, **kwargs):
+    invalidar_disponibilidad(instance.doctor_id)
+    descartar_sin_plantilla(instance.doctor_id)
+
+
+@receiver(post_save, sender=HorarioTemplateItem)
+@receiver(post_delete, sender=HorarioTemplateItem)
+def materializar_item_plantilla(sender, instance, **kwargs):
+    try:
+        template = instance.template
+    except HorarioSemanalTemplate.DoesNotExist:
+        return
+    if template.es_activo:
+        materializar_al_confirmar(template.doctor_id)
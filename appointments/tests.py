@@ -1,9 +1,62 @@
-from django.test import TestCase
+import base64
+import gc
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
+
+import rsa
+from jose import jwt as jose_jwt
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APIClient
 from django.contrib.auth.models import User
-from .models import Paciente, Doctor, Reserva
+from .auth0backend import (
+    Auth0JSONWebTokenAuthentication,
+    Auth0User,
+    JWKSKeyStore,
+    VerifiedTokenCache,
+    reset_jwks_store,
+)
+from .models import (
+    CustomUser,
+    DisponibilidadDia,
+    Paciente,
+    Doctor,
+    Procedimiento,
+    Reserva,
+    ReservaTemporal,
+    ClaveIdempotencia,
+    ContadorPacientes,
+    ContadorReservas,
+    HorarioDoctor,
+    HorarioSemanalTemplate,
+    HorarioTemplateItem,
+)
+from .principal import load_principal, principal_cache
+from django.core.management import call_command
+from . import agenda, disponibilidad, estadisticas
+from .disponibilidad import (
+    HORIZONTE_DIAS,
+    generar_slots,
+    libres_materializados,
+    proximos_slots,
+    restar_intervalos,
+)
 from rest_framework import status
-from datetime import datetime, timedelta
+from datetime import date, datetime, time as dt_time, timedelta
 
 
 class ReservaAPITest(TestCase):
@@ -64,3 +117,1750 @@ class ReservaAPITest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         for r in response.data:
             self.assertEqual(r["paciente"]["email"], "paciente@test.com")
+
+
+def _b64url_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+class JWKSTestMixin:
+    """Genera un par de llaves RSA y un JWKS local para firmar tokens de prueba."""
+
+    kid = "test-kid"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        public_key, private_key = rsa.newkeys(1024)
+        cls.private_pem = private_key.save_pkcs1().decode("ascii")
+        cls.jwks_dir = tempfile.TemporaryDirectory()
+        cls.jwks_path = os.path.join(cls.jwks_dir.name, "jwks.json")
+        with open(cls.jwks_path, "w", encoding="utf-8") as fh:
+            json.dump(
+                {
+                    "keys": [
+                        {
+                            "kty": "RSA",
+                            "kid": cls.kid,
+                            "use": "sig",
+                            "alg": "RS256",
+                            "n": _b64url_uint(public_key.n),
+                            "e": _b64url_uint(public_key.e),
+                        }
+                    ]
+                },
+                fh,
+            )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.jwks_dir.cleanup()
+        super().tearDownClass()
+
+    def make_token(self, sub="auth0|test", kid=None, **claims):
+        payload = {
+            "sub": sub,
+            "aud": settings.API_IDENTIFIER,
+            "iss": f"https://{settings.AUTH0_DOMAIN}/",
+            "exp": int(time.time()) + 3600,
+        }
+        payload.update(claims)
+        return jose_jwt.encode(
+            payload,
+            self.private_pem,
+            algorithm="RS256",
+            headers={"kid": kid or self.kid},
+        )
+
+
+class JWKSKeyStoreTest(JWKSTestMixin, SimpleTestCase):
+    def test_loads_keys_from_local_file(self):
+        store = JWKSKeyStore(path=self.jwks_path)
+        self.assertIsNotNone(store.get_key(self.kid))
+        self.assertIsNone(store.get_key("otro-kid"))
+
+    def test_unknown_kid_does_not_refetch_within_interval(self):
+        store = JWKSKeyStore(path=self.jwks_path, min_refetch_interval=60)
+        with mock.patch.object(store, "_load_keys", wraps=store._load_keys) as load:
+            store.get_key(self.kid)
+            store.get_key(self.kid)
+            store.get_key("desconocido")
+            store.get_key("desconocido")
+        self.assertEqual(load.call_count, 1)
+
+    def test_expired_keys_are_reloaded(self):
+        store = JWKSKeyStore(path=self.jwks_path, ttl=0)
+        with mock.patch.object(store, "_load_keys", wraps=store._load_keys) as load:
+            store.get_key(self.kid)
+            store.get_key(self.kid)
+        self.assertEqual(load.call_count, 2)
+
+    def test_decode_jwt_uses_cached_keys(self):
+        with override_settings(AUTH0_JWKS_FILE=self.jwks_path):
+            reset_jwks_store()
+            try:
+                backend = Auth0JSONWebTokenAuthentication()
+                with mock.patch("appointments.auth0backend.requests.get") as get:
+                    payload = backend.decode_jwt(self.make_token(sub="auth0|abc"))
+                    backend.decode_jwt(self.make_token(sub="auth0|abc"))
+                get.assert_not_called()
+                self.assertEqual(payload["sub"], "auth0|abc")
+            finally:
+                reset_jwks_store()
+
+
+class VerifiedTokenCacheTest(JWKSTestMixin, SimpleTestCase):
+    def test_repeated_token_skips_verification(self):
+        cache = VerifiedTokenCache(max_size=10)
+        backend = Auth0JSONWebTokenAuthentication()
+        token = self.make_token(sub="auth0|repetido")
+        request = mock.Mock(headers={"Authorization": f"Bearer {token}"})
+
+        with mock.patch(
+            "appointments.auth0backend.token_cache", cache
+        ), mock.patch.object(
+            backend, "decode_jwt", return_value=jose_jwt.get_unverified_claims(token)
+        ) as decode:
+            first, _ = backend.authenticate(request)
+            second, _ = backend.authenticate(request)
+
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(second.username, "auth0|repetido")
+        self.assertIsNot(first, second)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_entries_expire_at_exp_claim(self):
+        cache = VerifiedTokenCache()
+        user = Auth0User({"sub": "auth0|x", "exp": time.time() + 60})
+        cache.set("token", user)
+        self.assertIsNotNone(cache.get("token"))
+        with mock.patch(
+            "appointments.auth0backend.time.time", return_value=time.time() + 120
+        ):
+            self.assertIsNone(cache.get("token"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_cache_is_bounded(self):
+        cache = VerifiedTokenCache(max_size=2)
+        exp = time.time() + 60
+        for token in ("a", "b", "c"):
+            cache.set(token, Auth0User({"sub": token, "exp": exp}))
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+
+class APITestMixin:
+    """Crea usuarios con sus perfiles y autentica peticiones como Auth0User."""
+
+    def setUp(self):
+        super().setUp()
+        # Los caches sobreviven al rollback de cada test
+        principal_cache.clear()
+        caches["default"].clear()
+
+    def create_user(self, auth0_id, role="paciente", **extra):
+        extra.setdefault("email", f"{auth0_id.split('|')[-1]}@test.com")
+        return CustomUser.objects.create_user(auth0_id=auth0_id, role=role, **extra)
+
+    def authenticate(self, auth0_id):
+        # Un Auth0User nuevo por petición, como lo haría el backend real.
+        self.client.force_authenticate(user=Auth0User({"sub": auth0_id}))
+
+    def count_user_lookups(self, queries):
+        lookup = f'"{CustomUser._meta.db_table}"."auth0_id" ='
+        return sum(1 for q in queries if lookup in q["sql"])
+
+
+class PrincipalResolutionTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.doctor_user = self.create_user("auth0|doctor", role="doctor")
+        self.paciente_user = self.create_user("auth0|paciente")
+        self.reserva = Reserva.objects.create(
+            paciente=self.paciente_user.paciente_profile,
+            doctor=self.doctor_user.doctor_profile,
+            fecha_hora=timezone.now() + timedelta(days=1),
+        )
+
+    def test_principal_joins_profile_ids(self):
+        principal = load_principal("auth0|doctor")
+        self.assertEqual(principal.doctor_id, self.doctor_user.doctor_profile.id)
+        self.assertIsNone(principal.paciente_id)
+        self.assertIsNone(load_principal("auth0|desconocido"))
+
+    def test_user_is_loaded_once_per_request(self):
+        self.authenticate("auth0|doctor")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.patch(
+                f"/api/reservas/{self.reserva.id}/",
+                {"estado": "confirmada"},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.count_user_lookups(ctx.captured_queries), 1)
+
+    def test_whoami_uses_principal(self):
+        self.authenticate("auth0|paciente")
+        response = self.client.get("/api/whoami/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["role"], "paciente")
+
+
+class PrincipalCacheTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.paciente_user = self.create_user("auth0|paciente")
+
+    def test_principal_is_reused_across_requests(self):
+        self.authenticate("auth0|paciente")
+        self.client.get("/api/whoami/")
+        self.authenticate("auth0|paciente")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/api/whoami/")
+        self.assertEqual(response.data["role"], "paciente")
+        self.assertEqual(self.count_user_lookups(ctx.captured_queries), 0)
+
+    def test_role_change_invalidates_cache(self):
+        self.authenticate("auth0|paciente")
+        self.assertEqual(self.client.get("/api/whoami/").data["role"], "paciente")
+
+        self.authenticate("auth0|paciente")
+        response = self.client.patch(
+            f"/api/users/{self.paciente_user.id}/promote_to_doctor/"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.authenticate("auth0|paciente")
+        response = self.client.get("/api/whoami/")
+        self.assertEqual(response.data["role"], "admin")
+        self.assertIsNotNone(principal_cache.get("auth0|paciente").doctor_id)
+
+    def test_profile_creation_invalidates_cache(self):
+        self.authenticate("auth0|paciente")
+        self.client.get("/api/whoami/")
+        Doctor.objects.create(user=self.paciente_user, especialidad="General")
+        self.assertIsNone(principal_cache.get("auth0|paciente"))
+
+
+class ReservaListingQueryCountTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.admin_user = self.create_user("auth0|admin", role="admin")
+        self.paciente = self.create_user("auth0|paciente").paciente_profile
+        self.doctor_user = self.create_user("auth0|doctor", role="doctor")
+        self.n = 0
+
+    def add_reservas(self, count):
+        for _ in range(count):
+            self.n += 1
+            doctor = self.create_user(
+                f"auth0|doc{self.n}", role="doctor"
+            ).doctor_profile
+            procedimiento = Procedimiento.objects.create(
+                nombre=f"Procedimiento {self.n}", duracion_min=30
+            )
+            procedimiento.doctores.add(doctor, self.doctor_user.doctor_profile)
+            for target in (doctor, self.doctor_user.doctor_profile):
+                Reserva.objects.create(
+                    paciente=self.paciente,
+                    doctor=target,
+                    procedimiento=procedimiento,
+                    fecha_hora=timezone.now() + timedelta(days=self.n),
+                )
+
+    def count_queries(self, url, auth0_id):
+        principal_cache.clear()
+        self.authenticate(auth0_id)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(ctx.captured_queries)
+
+    def test_reserva_list_query_count_is_constant(self):
+        self.add_reservas(2)
+        small = self.count_queries("/api/reservas/", "auth0|admin")
+        # principal + reservas + procedimientos del doctor + doctores del procedimiento
+        self.assertEqual(small, 4)
+        self.add_reservas(8)
+        self.assertEqual(self.count_queries("/api/reservas/", "auth0|admin"), small)
+
+    def test_doctor_reservas_query_count_is_constant(self):
+        self.add_reservas(2)
+        small = self.count_queries("/api/doctor/reservas/", "auth0|doctor")
+        self.add_reservas(8)
+        self.assertEqual(
+            self.count_queries("/api/doctor/reservas/", "auth0|doctor"), small
+        )
+
+
+class KeysetPaginationTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.create_user("auth0|admin", role="admin")
+        paciente = self.create_user("auth0|paciente").paciente_profile
+        doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        fecha = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        # Varias reservas comparten fecha_hora para probar el desempate por id
+        self.reservas = [
+            Reserva.objects.create(
+                paciente=paciente,
+                doctor=doctor,
+                fecha_hora=fecha + timedelta(hours=i // 2),
+            )
+            for i in range(7)
+        ]
+
+    def collect(self, url):
+        ids = []
+        while url:
+            self.authenticate("auth0|admin")
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 3)
+            ids.extend(r["id"] for r in response.data["results"])
+            url = response.data["next"]
+        return ids
+
+    def test_walks_all_reservas_in_order(self):
+        ids = self.collect("/api/reservas/?page_size=3")
+        self.assertEqual(ids, [r.id for r in self.reservas])
+
+    def test_doctor_reservas_is_paginated(self):
+        self.authenticate("auth0|doctor")
+        response = self.client.get("/api/doctor/reservas/?page_size=5")
+        self.assertEqual(len(response.data["results"]), 5)
+        self.assertIsNotNone(response.data["next"])
+
+    def test_invalid_cursor(self):
+        self.authenticate("auth0|admin")
+        response = self.client.get("/api/reservas/?cursor=basura")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class DoctorCalendarioTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        paciente_user = self.create_user(
+            "auth0|paciente", first_name="Ana", last_name="Pérez"
+        )
+        self.procedimiento = Procedimiento.objects.create(
+            nombre="Limpieza", duracion_min=45
+        )
+        self.inicio = timezone.make_aware(datetime(2030, 1, 7, 9, 0))
+        for dias in (0, 3, 10):
+            Reserva.objects.create(
+                paciente=paciente_user.paciente_profile,
+                doctor=self.doctor,
+                procedimiento=self.procedimiento,
+                fecha_hora=self.inicio + timedelta(days=dias),
+                duracion_min=45,
+            )
+
+    def test_window_returns_compact_rows(self):
+        self.authenticate("auth0|doctor")
+        response = self.client.get(
+            "/api/doctor/reservas/?start=2030-01-07&end=2030-01-14"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        fila = response.data[0]
+        self.assertEqual(
+            set(fila), {"id", "start", "end", "estado", "paciente", "procedimiento"}
+        )
+        self.assertEqual(fila["paciente"], "Ana Pérez")
+        self.assertEqual(fila["procedimiento"], "Limpieza")
+
+    def test_window_is_bounded(self):
+        self.authenticate("auth0|doctor")
+        response = self.client.get(
+            "/api/doctor/reservas/?start=2030-01-01&end=2031-01-01"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DisponibilidadViewTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.create_user("auth0|paciente")
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        self.procedimiento = Procedimiento.objects.create(
+            nombre="Consulta", duracion_min=30
+        )
+        template = HorarioSemanalTemplate.objects.create(
+            doctor=self.doctor, nombre="Semana", es_activo=True
+        )
+        # Lunes y miércoles de 09:00 a 12:00; un bloque inactivo el martes
+        for dia, activo in ((0, True), (2, True), (1, False)):
+            HorarioTemplateItem.objects.create(
+                template=template,
+                dia_semana=dia,
+                hora_inicio=dt_time(9, 0),
+                hora_fin=dt_time(12, 0),
+                activo=activo,
+            )
+
+    def get(self, start_date, end_date, **extra):
+        self.authenticate("auth0|paciente")
+        return self.client.get(
+            "/api/reservas/disponibilidad/",
+            {
+                "doctor_id": self.doctor.id,
+                "procedimiento_id": self.procedimiento.id,
+                "start_date": start_date,
+                "end_date": end_date,
+                **extra,
+            },
+        )
+
+    def reservar(self, fecha_hora, duracion_min=30, estado="pendiente"):
+        paciente = CustomUser.objects.get(auth0_id="auth0|paciente").paciente_profile
+        return Reserva.objects.create(
+            paciente=paciente,
+            doctor=self.doctor,
+            fecha_hora=timezone.make_aware(fecha_hora),
+            duracion_min=duracion_min,
+            estado=estado,
+        )
+
+    def test_blocks_expand_over_range(self):
+        # 2030-01-07 es lunes
+        response = self.get("2030-01-07", "2030-01-13", incluir_bloques="true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["bloques_disponibles"],
+            [
+                {"start": "2030-01-07T09:00:00", "end": "2030-01-07T12:00:00"},
+                {"start": "2030-01-09T09:00:00", "end": "2030-01-09T12:00:00"},
+            ],
+        )
+
+    def test_query_count_does_not_depend_on_range(self):
+        self.get("2030-01-07", "2030-01-07")
+        with CaptureQueriesContext(connection) as semana:
+            self.get("2030-01-07", "2030-01-13")
+        with CaptureQueriesContext(connection) as trimestre:
+            response = self.get("2030-01-07", "2030-04-06")
+        # 26 días con bloque de 3 horas, 6 slots de 30 minutos cada uno
+        self.assertEqual(len(response.data["slots_disponibles"]), 26 * 6)
+        self.assertEqual(len(semana.captured_queries), len(trimestre.captured_queries))
+
+    def test_range_is_capped(self):
+        response = self.get("2030-01-01", "2030-12-31")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_slots_exclude_booked_time(self):
+        self.reservar(datetime(2030, 1, 7, 10, 0), duracion_min=45)
+        self.reservar(datetime(2030, 1, 7, 9, 0), estado="cancelada")
+        response = self.get("2030-01-07", "2030-01-07")
+        self.assertEqual(
+            [slot["start"] for slot in response.data["slots_disponibles"]],
+            [
+                "2030-01-07T09:00:00",
+                "2030-01-07T09:30:00",
+                "2030-01-07T10:45:00",
+                "2030-01-07T11:15:00",
+            ],
+        )
+        self.assertNotIn("bloques_disponibles", response.data)
+
+
+class HorarioDiarioMixin(APITestMixin):
+    """Doctor con plantilla activa de 09:00 a 12:00 todos los días."""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.paciente = self.create_user("auth0|paciente").paciente_profile
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        self.procedimiento = Procedimiento.objects.create(
+            nombre="Consulta", duracion_min=60
+        )
+        # Todos los días de 09:00 a 12:00; al confirmar, crear la plantilla
+        # activa materializa el horizonte completo.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.template = HorarioSemanalTemplate.objects.create(
+                doctor=self.doctor, nombre="Diario", es_activo=True
+            )
+            for dia in range(7):
+                HorarioTemplateItem.objects.create(
+                    template=self.template,
+                    dia_semana=dia,
+                    hora_inicio=dt_time(9, 0),
+                    hora_fin=dt_time(12, 0),
+                )
+        self.manana = timezone.localdate() + timedelta(days=1)
+
+    def libres(self, fecha):
+        return DisponibilidadDia.objects.get(doctor=self.doctor, fecha=fecha).libres
+
+    def reservar(self, fecha, hora, **extra):
+        return Reserva.objects.create(
+            paciente=self.paciente,
+            doctor=self.doctor,
+            fecha_hora=timezone.make_aware(datetime.combine(fecha, dt_time(hora, 0))),
+            duracion_min=60,
+            **extra,
+        )
+
+    def get(self, start_date, end_date, **extra):
+        self.authenticate("auth0|paciente")
+        return self.client.get(
+            "/api/reservas/disponibilidad/",
+            {
+                "doctor_id": self.doctor.id,
+                "procedimiento_id": self.procedimiento.id,
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                **extra,
+            },
+        )
+
+
+class DisponibilidadMaterializadaTest(HorarioDiarioMixin, TestCase):
+    def test_horizon_is_materialized(self):
+        self.assertEqual(
+            DisponibilidadDia.objects.filter(doctor=self.doctor).count(),
+            HORIZONTE_DIAS,
+        )
+        self.assertEqual(self.libres(self.manana), [[540, 720]])
+
+    def test_reserva_create_move_and_cancel(self):
+        reserva = self.reservar(self.manana, 10)
+        self.assertEqual(self.libres(self.manana), [[540, 600], [660, 720]])
+
+        pasado = self.manana + timedelta(days=1)
+        reserva.fecha_hora += timedelta(days=1)
+        reserva.save()
+        self.assertEqual(self.libres(self.manana), [[540, 720]])
+        self.assertEqual(self.libres(pasado), [[540, 600], [660, 720]])
+
+        reserva = Reserva.objects.get(pk=reserva.pk)
+        reserva.estado = "cancelada"
+        reserva.save()
+        self.assertEqual(self.libres(pasado), [[540, 720]])
+
+    def test_read_uses_store_and_matches_live(self):
+        self.reservar(self.manana, 9)
+        end_date = self.manana + timedelta(days=6)
+        self.get(self.manana, end_date)
+        with CaptureQueriesContext(connection) as ctx:
+            materializada = self.get(self.manana, end_date)
+        self.assertFalse(
+            any("horariosemanaltemplate" in q["sql"] for q in ctx.captured_queries)
+        )
+        # incluir_bloques fuerza el cálculo en vivo
+        en_vivo = self.get(self.manana, end_date, incluir_bloques="true")
+        self.assertEqual(
+            materializada.data["slots_disponibles"],
+            en_vivo.data["slots_disponibles"],
+        )
+        self.assertEqual(len(materializada.data["slots_disponibles"]), 7 * 3 - 1)
+
+    def test_incomplete_store_falls_back_to_live(self):
+        DisponibilidadDia.objects.filter(doctor=self.doctor, fecha=self.manana).delete()
+        response = self.get(self.manana, self.manana)
+        self.assertEqual(len(response.data["slots_disponibles"]), 3)
+
+    def test_activar_plantilla_rebuilds(self):
+        tarde = HorarioSemanalTemplate.objects.create(
+            doctor=self.doctor, nombre="Tarde"
+        )
+        HorarioTemplateItem.objects.create(
+            template=tarde,
+            dia_semana=self.manana.weekday(),
+            hora_inicio=dt_time(15, 0),
+            hora_fin=dt_time(17, 0),
+        )
+        self.authenticate("auth0|doctor")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f"/api/horarios-semanales/{tarde.id}/activar/",
+                {"doctor_id": self.doctor.id},
+            )
+        self.assertEqual(self.libres(self.manana), [[900, 1020]])
+        self.assertEqual(self.libres(self.manana + timedelta(days=1)), [])
+
+    def test_deactivating_last_template_discards_store(self):
+        self.template.es_activo = False
+        self.template.save()
+        self.assertFalse(DisponibilidadDia.objects.filter(doctor=self.doctor).exists())
+        self.assertIsNone(
+            libres_materializados(self.doctor.id, self.manana, self.manana)
+        )
+        self.assertEqual(
+            self.get(self.manana, self.manana).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+    def test_deleting_active_template_discards_store(self):
+        otra = HorarioSemanalTemplate.objects.create(doctor=self.doctor, nombre="Otra")
+        otra.delete()
+        self.assertEqual(self.libres(self.manana), [[540, 720]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.template.delete()
+        self.assertFalse(DisponibilidadDia.objects.filter(doctor=self.doctor).exists())
+        self.assertEqual(
+            self.get(self.manana, self.manana).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+    def test_template_edits_rebuild_once_on_commit(self):
+        with mock.patch.object(
+            disponibilidad,
+            "materializar_disponibilidad",
+            wraps=disponibilidad.materializar_disponibilidad,
+        ) as materializar:
+            with self.captureOnCommitCallbacks(execute=True):
+                for item in HorarioTemplateItem.objects.filter(template=self.template):
+                    item.hora_fin = dt_time(11, 0)
+                    item.save()
+                self.template.nombre = "Diario corto"
+                self.template.save()
+                self.assertEqual(materializar.call_count, 0)
+        materializar.assert_called_once_with({self.doctor.id})
+        self.assertEqual(self.libres(self.manana), [[540, 660]])
+
+    def test_rolled_back_edit_does_not_block_later_rebuilds(self):
+        item = HorarioTemplateItem.objects.get(
+            template=self.template, dia_semana=self.manana.weekday()
+        )
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            item.hora_fin = dt_time(10, 0)
+            item.save()
+            raise RuntimeError
+        item.hora_fin = dt_time(11, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            item.save()
+        self.assertEqual(self.libres(self.manana), [[540, 660]])
+
+    def test_rebuild_command(self):
+        DisponibilidadDia.objects.all().delete()
+        call_command("reconstruir_disponibilidad", stdout=open(os.devnull, "w"))
+        self.assertEqual(
+            DisponibilidadDia.objects.filter(doctor=self.doctor).count(),
+            HORIZONTE_DIAS,
+        )
+
+
+class DisponibilidadCacheTest(HorarioDiarioMixin, TestCase):
+    def slots(self):
+        response = self.get(self.manana, self.manana)
+        return [slot["start"] for slot in response.data["slots_disponibles"]]
+
+    def test_repeated_reads_hit_cache(self):
+        self.slots()
+        with CaptureQueriesContext(connection) as ctx:
+            self.slots()
+        self.assertFalse(
+            any("disponibilidaddia" in q["sql"] for q in ctx.captured_queries)
+        )
+
+    def test_reserva_write_invalidates(self):
+        self.assertEqual(len(self.slots()), 3)
+        reserva = self.reservar(self.manana, 10)
+        self.assertEqual(len(self.slots()), 2)
+        reserva.delete()
+        self.assertEqual(len(self.slots()), 3)
+
+    def test_template_item_write_invalidates(self):
+        self.slots()
+        item = HorarioTemplateItem.objects.get(
+            template=self.template, dia_semana=self.manana.weekday()
+        )
+        item.hora_fin = dt_time(10, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            item.save()
+        self.assertEqual(len(self.slots()), 1)
+
+    def test_other_doctors_keep_their_entries(self):
+        otro = self.create_user("auth0|otro", role="doctor").doctor_profile
+        self.slots()
+        Reserva.objects.create(
+            paciente=self.paciente,
+            doctor=otro,
+            fecha_hora=timezone.now() + timedelta(days=1),
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            self.slots()
+        self.assertFalse(
+            any("disponibilidaddia" in q["sql"] for q in ctx.captured_queries)
+        )
+
+
+class ReservaTemporalTest(HorarioDiarioMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.otro = self.create_user("auth0|otro").paciente_profile
+        self.nueve = timezone.make_aware(datetime.combine(self.manana, dt_time(9, 0)))
+
+    def retener(self, auth0_id="auth0|paciente", hora=None):
+        self.authenticate(auth0_id)
+        return self.client.post(
+            "/api/reservas/retener/",
+            {
+                "doctor_id": self.doctor.id,
+                "fecha_hora": (hora or self.nueve).isoformat(),
+                "duracion_min": 60,
+            },
+        )
+
+    def confirmar(self, paciente, auth0_id, **extra):
+        self.authenticate(auth0_id)
+        return self.client.post(
+            "/api/reservas/",
+            {
+                "paciente_id": paciente.id,
+                "doctor_id": self.doctor.id,
+                "fecha_hora": self.nueve.isoformat(),
+                "duracion_min": 60,
+                **extra,
+            },
+        )
+
+    def slots(self):
+        response = self.get(self.manana, self.manana)
+        return [slot["start"] for slot in response.data["slots_disponibles"]]
+
+    def test_hold_is_busy_for_everyone_else(self):
+        self.assertEqual(len(self.slots()), 3)
+        self.assertEqual(self.retener().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(self.slots()), 2)
+        self.assertEqual(
+            self.retener("auth0|otro").status_code, status.HTTP_409_CONFLICT
+        )
+        self.assertEqual(
+            self.confirmar(self.otro, "auth0|otro").status_code,
+            status.HTTP_409_CONFLICT,
+        )
+
+    def test_booking_consumes_hold(self):
+        temporal_id = self.retener().data["id"]
+        response = self.confirmar(
+            self.paciente, "auth0|paciente", reserva_temporal_id=temporal_id
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(ReservaTemporal.objects.exists())
+        self.assertEqual(len(self.slots()), 2)
+
+    def test_consuming_hold_of_other_doctor_frees_its_slot(self):
+        temporal_id = self.retener().data["id"]
+        self.assertEqual(len(self.slots()), 2)
+        otro_doctor = self.create_user("auth0|doctor2", role="doctor").doctor_profile
+        response = self.confirmar(
+            self.paciente,
+            "auth0|paciente",
+            doctor_id=otro_doctor.id,
+            reserva_temporal_id=temporal_id,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(ReservaTemporal.objects.exists())
+        self.assertEqual(len(self.slots()), 3)
+
+    def test_past_or_off_schedule_hold_is_rejected(self):
+        for hora in (
+            self.nueve - timedelta(days=2),
+            self.nueve + timedelta(hours=2, minutes=30),
+            self.nueve + timedelta(hours=5),
+        ):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.retener(hora=hora)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertFalse(
+                any("reservatemporal" in q["sql"] for q in ctx.captured_queries)
+            )
+        self.assertEqual(
+            self.retener(hora=self.nueve + timedelta(hours=2)).status_code,
+            status.HTTP_201_CREATED,
+        )
+
+    def test_new_hold_replaces_previous(self):
+        self.retener()
+        self.retener(hora=self.nueve + timedelta(hours=2))
+        self.assertEqual(ReservaTemporal.objects.count(), 1)
+        self.assertEqual(len(self.slots()), 2)
+
+    def test_release(self):
+        temporal_id = self.retener().data["id"]
+        self.authenticate("auth0|otro")
+        response = self.client.delete(f"/api/reservas/retener/{temporal_id}/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.authenticate("auth0|paciente")
+        response = self.client.delete(f"/api/reservas/retener/{temporal_id}/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.slots()), 3)
+
+    def test_expired_holds_are_ignored_and_swept_in_bulk(self):
+        self.retener()
+        self.retener("auth0|otro", hora=self.nueve + timedelta(hours=2))
+        ReservaTemporal.objects.update(expira_en=timezone.now() - timedelta(seconds=1))
+        caches["default"].clear()
+        self.assertEqual(len(self.slots()), 3)
+        self.assertEqual(
+            self.confirmar(self.otro, "auth0|otro").status_code,
+            status.HTTP_201_CREATED,
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(agenda.barrer_temporales_vencidas(forzar=True), 2)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_cache_entry_does_not_outlive_hold(self):
+        self.retener()
+        with mock.patch("appointments.disponibilidad_cache._cache") as cache:
+            cache.return_value.get.return_value = None
+            self.slots()
+        timeout = cache.return_value.set.call_args.args[2]
+        self.assertLessEqual(timeout, agenda.TEMPORAL_TTL)
+
+
+class ReservaConflictoTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.paciente = self.create_user("auth0|paciente").paciente_profile
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        self.inicio = timezone.make_aware(datetime(2030, 1, 7, 9, 0))
+
+    def reservar(self, minutos, duracion_min=30, doctor=None):
+        self.authenticate("auth0|paciente")
+        return self.client.post(
+            "/api/reservas/",
+            {
+                "paciente_id": self.paciente.id,
+                "doctor_id": (doctor or self.doctor).id,
+                "fecha_hora": (self.inicio + timedelta(minutes=minutos)).isoformat(),
+                "duracion_min": duracion_min,
+            },
+        )
+
+    def test_overlap_is_rejected(self):
+        self.assertEqual(self.reservar(0, 60).status_code, status.HTTP_201_CREATED)
+        response = self.reservar(30)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("error", response.data)
+        # Contiguas sí
+        self.assertEqual(self.reservar(60).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.reservar(-30).status_code, status.HTTP_201_CREATED)
+
+    def test_cancelled_and_other_doctors_do_not_conflict(self):
+        reserva_id = self.reservar(0).data["id"]
+        Reserva.objects.filter(pk=reserva_id).update(estado="cancelada")
+        self.assertEqual(self.reservar(0).status_code, status.HTTP_201_CREATED)
+        otro = self.create_user("auth0|otro", role="doctor").doctor_profile
+        self.assertEqual(
+            self.reservar(0, doctor=otro).status_code, status.HTTP_201_CREATED
+        )
+
+    def test_moving_onto_another_reserva_is_rejected(self):
+        self.reservar(0)
+        reserva_id = self.reservar(120).data["id"]
+        self.authenticate("auth0|paciente")
+        response = self.client.patch(
+            f"/api/reservas/{reserva_id}/",
+            {"fecha_hora": (self.inicio + timedelta(minutes=15)).isoformat()},
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        # Moverla sobre sí misma no es un conflicto
+        response = self.client.patch(
+            f"/api/reservas/{reserva_id}/", {"duracion_min": 60}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_fecha_fin_is_maintained(self):
+        reserva = Reserva.objects.get(pk=self.reservar(0, 45).data["id"])
+        self.assertEqual(reserva.fecha_fin, self.inicio + timedelta(minutes=45))
+        reserva.duracion_min = 60
+        reserva.save(update_fields=["duracion_min"])
+        reserva.refresh_from_db()
+        self.assertEqual(reserva.fecha_fin, self.inicio + timedelta(minutes=60))
+
+    def test_overlap_is_resolved_in_the_database(self):
+        self.reservar(0, 60)
+        with CaptureQueriesContext(connection) as ctx:
+            solapadas = agenda.reservas_solapadas(self.doctor.id, self.inicio, 30)
+        self.assertEqual(len(solapadas), 1)
+        self.assertIn('"fecha_fin" >', ctx.captured_queries[0]["sql"])
+        self.assertEqual(
+            agenda.reservas_solapadas(
+                self.doctor.id, self.inicio + timedelta(minutes=60), 30
+            ),
+            [],
+        )
+
+    def test_duration_is_bounded(self):
+        response = self.reservar(0, duracion_min=agenda.MAX_DURACION_MIN + 1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CambioEstadoLoteTest(HorarioDiarioMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.reservas = [self.reservar(self.manana, hora) for hora in (9, 10, 11)]
+        self.ids = [reserva.id for reserva in self.reservas]
+
+    def cambiar(self, cuerpo, usuario="auth0|doctor"):
+        self.authenticate(usuario)
+        return self.client.post("/api/reservas/estado/", cuerpo, format="json")
+
+    def estados(self):
+        return dict(Reserva.objects.filter(pk__in=self.ids).values_list("id", "estado"))
+
+    def test_confirm_day_with_one_update(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.cambiar({"ids": self.ids, "estado": "confirmada"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["actualizadas"], 3)
+        self.assertEqual(set(self.estados().values()), {"confirmada"})
+        updates = [
+            q
+            for q in ctx.captured_queries
+            if q["sql"].startswith(f'UPDATE "{Reserva._meta.db_table}"')
+        ]
+        self.assertEqual(len(updates), 1)
+        # Confirmar no cambia lo ocupado
+        self.assertEqual(self.libres(self.manana), [])
+
+    def test_per_id_results(self):
+        Reserva.objects.filter(pk=self.ids[0]).update(estado="confirmada")
+        otro = self.create_user("auth0|otro", role="doctor").doctor_profile
+        ajena = Reserva.objects.create(
+            paciente=self.paciente,
+            doctor=otro,
+            fecha_hora=self.reservas[0].fecha_hora,
+        )
+        response = self.cambiar(
+            {
+                "cambios": [
+                    {"id": self.ids[0], "estado": "confirmada"},
+                    {"id": self.ids[1], "estado": "cancelada"},
+                    {"id": self.ids[2], "estado": "archivada"},
+                    {"id": ajena.id, "estado": "cancelada"},
+                ]
+            }
+        )
+        self.assertEqual(
+            {r["id"]: r["resultado"] for r in response.data["resultados"]},
+            {
+                self.ids[0]: "sin_cambios",
+                self.ids[1]: "actualizada",
+                self.ids[2]: "estado_invalido",
+                ajena.id: "no_encontrada",
+            },
+        )
+        ajena.refresh_from_db()
+        self.assertEqual(ajena.estado, "pendiente")
+        # La cancelación libera el hueco en la disponibilidad materializada
+        self.assertEqual(self.libres(self.manana), [[600, 660]])
+
+    def test_reactivation_checks_overlaps(self):
+        self.cambiar({"ids": self.ids[:2], "estado": "cancelada"})
+        nueva = self.reservar(self.manana, 9)
+        response = self.cambiar({"ids": self.ids[:2], "estado": "pendiente"})
+        self.assertEqual(
+            [r["resultado"] for r in response.data["resultados"]],
+            ["conflicto", "actualizada"],
+        )
+        # Cancelar y reactivar en el mismo lote: primero se libera el hueco
+        response = self.cambiar(
+            {
+                "cambios": [
+                    {"id": nueva.id, "estado": "cancelada"},
+                    {"id": self.ids[0], "estado": "confirmada"},
+                ]
+            }
+        )
+        self.assertEqual(response.data["actualizadas"], 2)
+        self.assertEqual(self.libres(self.manana), [])
+
+    def test_paciente_can_only_cancel(self):
+        response = self.cambiar(
+            {
+                "cambios": [
+                    {"id": self.ids[0], "estado": "confirmada"},
+                    {"id": self.ids[1], "estado": "cancelada"},
+                ]
+            },
+            usuario="auth0|paciente",
+        )
+        self.assertEqual(
+            [r["resultado"] for r in response.data["resultados"]],
+            ["no_permitido", "actualizada"],
+        )
+
+    def test_invalid_body(self):
+        self.assertEqual(
+            self.cambiar({"estado": "confirmada"}).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        self.assertEqual(
+            self.cambiar({"ids": ["x"], "estado": "confirmada"}).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+        self.assertEqual(
+            self.cambiar(
+                {"ids": [self.ids[0], self.ids[0]], "estado": "confirmada"}
+            ).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class IdempotenciaTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.paciente = self.create_user("auth0|paciente").paciente_profile
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        self.datos = {
+            "paciente_id": self.paciente.id,
+            "doctor_id": self.doctor.id,
+            "fecha_hora": timezone.make_aware(datetime(2030, 1, 7, 9, 0)).isoformat(),
+            "duracion_min": 30,
+        }
+        self.authenticate("auth0|paciente")
+
+    def post(self, clave, **cambios):
+        return self.client.post(
+            "/api/reservas/",
+            {**self.datos, **cambios},
+            format="json",
+            HTTP_IDEMPOTENCY_KEY=clave,
+        )
+
+    def test_retry_replays_first_response(self):
+        primera = self.post("clave-1")
+        self.assertEqual(primera.status_code, status.HTTP_201_CREATED)
+        with CaptureQueriesContext(connection) as ctx:
+            segunda = self.post("clave-1")
+        self.assertEqual(segunda.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(segunda["Idempotent-Replayed"], "true")
+        self.assertEqual(segunda.data["id"], primera.data["id"])
+        self.assertEqual(Reserva.objects.count(), 1)
+        self.assertFalse(
+            any(Reserva._meta.db_table in q["sql"] for q in ctx.captured_queries)
+        )
+
+    def test_without_key_behaves_as_before(self):
+        self.assertEqual(self.post("").status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.post("").status_code, status.HTTP_409_CONFLICT)
+
+    def test_key_reused_with_other_body(self):
+        self.post("clave-1")
+        response = self.post("clave-1", duracion_min=45)
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_request_in_flight(self):
+        self.post("clave-1")
+        # Como si la primera petición aún no hubiera terminado
+        ClaveIdempotencia.objects.update(estado_http=None, respuesta=None)
+        response = self.post("clave-1")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Reserva.objects.count(), 1)
+
+    def test_abandoned_request_frees_key(self):
+        self.post("clave-1")
+        # La primera petición murió sin guardar respuesta
+        ClaveIdempotencia.objects.update(
+            estado_http=None,
+            respuesta=None,
+            creado_en=timezone.now() - timedelta(minutes=5),
+        )
+        Reserva.objects.all().delete()
+        response = self.post("clave-1")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(
+            ClaveIdempotencia.objects.get().estado_http, status.HTTP_201_CREATED
+        )
+
+    def test_expired_key_runs_again(self):
+        self.post("clave-1")
+        ClaveIdempotencia.objects.update(expira_en=timezone.now())
+        Reserva.objects.all().delete()
+        response = self.post("clave-1")
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Reserva.objects.count(), 1)
+
+    def test_cancel_is_replayed(self):
+        reserva_id = self.post("alta").data["id"]
+        for _ in range(2):
+            response = self.client.patch(
+                f"/api/reservas/{reserva_id}/",
+                {"estado": "cancelada"},
+                format="json",
+                HTTP_IDEMPOTENCY_KEY="cancelar",
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["estado"], "cancelada")
+        self.assertEqual(ClaveIdempotencia.objects.count(), 2)
+
+
+class ReservaConcurrenciaTest(APITestMixin, TransactionTestCase):
+    """Muchos hilos reservando a la vez: solo uno puede quedarse con el hueco."""
+
+    hilos = 12
+
+    def setUp(self):
+        super().setUp()
+        self.paciente = self.create_user("auth0|paciente").paciente_profile
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        self.inicio = timezone.make_aware(datetime(2030, 1, 7, 9, 0))
+
+    def en_paralelo(self, funcion, argumentos):
+        barrera = threading.Barrier(len(argumentos))
+        resultados = [None] * len(argumentos)
+
+        def ejecutar(i, argumento):
+            try:
+                barrera.wait()
+                resultados[i] = funcion(argumento)
+            finally:
+                connection.close()
+
+        hilos = [
+            threading.Thread(target=ejecutar, args=(i, argumento))
+            for i, argumento in enumerate(argumentos)
+        ]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        return resultados
+
+    def reservar(self, minutos):
+        client = APIClient()
+        client.force_authenticate(user=Auth0User({"sub": "auth0|paciente"}))
+        return client.post(
+            "/api/reservas/",
+            {
+                "paciente_id": self.paciente.id,
+                "doctor_id": self.doctor.id,
+                "fecha_hora": (self.inicio + timedelta(minutes=minutos)).isoformat(),
+                "duracion_min": 30,
+            },
+        ).status_code
+
+    def test_only_one_booking_wins(self):
+        # Horarios de 30 minutos que se solapan todos entre sí
+        codigos = self.en_paralelo(self.reservar, [0, 5, 10, 15, -5, -10] * 2)
+        self.assertEqual(codigos.count(status.HTTP_201_CREATED), 1)
+        self.assertEqual(codigos.count(status.HTTP_409_CONFLICT), self.hilos - 1)
+        self.assertEqual(Reserva.objects.filter(doctor=self.doctor).count(), 1)
+
+    def test_disjoint_slots_all_succeed(self):
+        codigos = self.en_paralelo(self.reservar, [30 * i for i in range(self.hilos)])
+        self.assertEqual(codigos, [status.HTTP_201_CREATED] * self.hilos)
+
+    def test_other_doctors_are_not_blocked(self):
+        otro = self.create_user("auth0|otro", role="doctor").doctor_profile
+        dentro = threading.Event()
+        soltar = threading.Event()
+
+        def retener():
+            try:
+                with agenda.agenda_bloqueada(self.doctor.id):
+                    dentro.set()
+                    soltar.wait(5)
+            finally:
+                connection.close()
+
+        hilo = threading.Thread(target=retener)
+        hilo.start()
+        try:
+            self.assertTrue(dentro.wait(5))
+            inicio = time.monotonic()
+            with agenda.agenda_bloqueada(otro.id):
+                pass
+            self.assertLess(time.monotonic() - inicio, 1)
+        finally:
+            soltar.set()
+            hilo.join()
+
+    @skipIf(connection.vendor != "sqlite", "solo SQLite")
+    def test_sqlite_file_takes_write_lock_up_front(self):
+        with mock.patch.object(connection, "is_in_memory_db", return_value=False):
+            with CaptureQueriesContext(connection) as ctx:
+                with agenda.agenda_bloqueada(self.doctor.id):
+                    pass
+        self.assertTrue(
+            any(
+                q["sql"].startswith("UPDATE") and "WHERE 0" in q["sql"]
+                for q in ctx.captured_queries
+            )
+        )
+
+    def test_local_locks_are_per_doctor_and_released(self):
+        otro = self.create_user("auth0|otro", role="doctor").doctor_profile
+        with agenda.agendas_bloqueadas([otro.id, self.doctor.id]):
+            self.assertIsNot(
+                agenda._candado_local(self.doctor.id), agenda._candado_local(otro.id)
+            )
+        gc.collect()
+        self.assertNotIn(self.doctor.id, agenda._candados)
+
+
+class IntervalEngineTest(SimpleTestCase):
+    def test_restar_intervalos(self):
+        libres = restar_intervalos(
+            [(0, 100), (200, 300)], [(10, 20), (15, 30), (90, 210), (250, 260)]
+        )
+        self.assertEqual(libres, [(0, 10), (30, 90), (210, 250), (260, 300)])
+
+    def test_generar_slots_respeta_desde(self):
+        self.assertEqual(generar_slots([(0, 100)], 30, desde=31), [(60, 90)])
+
+
+@skipIf(disponibilidad.np is None, "NumPy no está instalado")
+class NumpySlotsTest(SimpleTestCase):
+    """El camino vectorizado debe dar exactamente lo mismo que el de Python."""
+
+    def test_equivalent_to_python_path(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            bloques = sorted(
+                (inicio, inicio + rng.randint(0, 240))
+                for inicio in (rng.randint(0, 5000) for _ in range(rng.randint(0, 30)))
+            )
+            ocupados = sorted(
+                (inicio, inicio + rng.choice((0, 15, 30, 45, 60, 500)))
+                for inicio in (rng.randint(0, 5000) for _ in range(rng.randint(0, 40)))
+            )
+            duracion = rng.choice((15, 30, 45, 60))
+            desde = rng.choice((None, rng.randint(0, 5000)))
+
+            esperado = generar_slots(
+                restar_intervalos(bloques, ocupados), duracion, desde=desde
+            )
+            self.assertEqual(
+                disponibilidad.calcular_slots_numpy(
+                    bloques, ocupados, duracion, desde=desde
+                ),
+                esperado,
+            )
+
+    def test_max_availability_range_takes_numpy_path(self):
+        # Lunes a viernes, mañana y tarde, sobre el rango máximo de 92 días
+        items_por_dia = {dia: [(540, 780), (900, 1140)] for dia in range(5)}
+        start_date = date(2030, 1, 7)
+        bloques = disponibilidad.expandir_bloques(
+            items_por_dia, start_date, start_date + timedelta(days=91)
+        )
+        with mock.patch.object(
+            disponibilidad, "calcular_slots_numpy", return_value=[]
+        ) as numpy:
+            disponibilidad.calcular_slots(bloques, [], start_date, 30)
+            disponibilidad.calcular_slots(bloques[:10], [], start_date, 30)
+        self.assertEqual(numpy.call_count, 1)
+
+    def test_iso_conversion(self):
+        start_date = date(2030, 1, 7)
+        slots = [(540, 570), (1439, 1469), (3 * 1440 + 60, 3 * 1440 + 120)]
+        self.assertEqual(
+            disponibilidad.slots_a_iso(start_date, slots),
+            [
+                (
+                    disponibilidad.a_iso(start_date, inicio),
+                    disponibilidad.a_iso(start_date, fin),
+                )
+                for inicio, fin in slots
+            ],
+        )
+
+
+class DisponibilidadProcedimientoTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.create_user("auth0|paciente")
+        self.procedimiento = Procedimiento.objects.create(
+            nombre="Blanqueamiento", duracion_min=60
+        )
+        self.doctores = [self.crear_doctor(i, dt_time(9, 0)) for i in range(2)]
+
+    def crear_doctor(self, i, inicio, disponible=True):
+        doctor = self.create_user(f"auth0|doctor{i}", role="doctor").doctor_profile
+        doctor.disponible = disponible
+        doctor.save()
+        doctor.procedimientos.add(self.procedimiento)
+        template = HorarioSemanalTemplate.objects.create(
+            doctor=doctor, nombre="Semana", es_activo=True
+        )
+        HorarioTemplateItem.objects.create(
+            template=template,
+            dia_semana=0,
+            hora_inicio=inicio,
+            hora_fin=dt_time(inicio.hour + 2, 0),
+        )
+        return doctor
+
+    def get(self):
+        self.authenticate("auth0|paciente")
+        return self.client.get(
+            "/api/reservas/disponibilidad/procedimiento/",
+            {
+                "procedimiento_id": self.procedimiento.id,
+                "start_date": "2030-01-07",
+                "end_date": "2030-01-13",
+            },
+        )
+
+    def test_merges_slots_across_available_doctors(self):
+        self.crear_doctor(9, dt_time(9, 0), disponible=False)
+        tarde = self.crear_doctor(3, dt_time(14, 0))
+        response = self.get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = sorted(d.id for d in self.doctores)
+        self.assertEqual(
+            [
+                (s["start"], sorted(s["doctores"]))
+                for s in response.data["slots_disponibles"]
+            ],
+            [
+                ("2030-01-07T09:00:00", ids),
+                ("2030-01-07T10:00:00", ids),
+                ("2030-01-07T14:00:00", [tarde.id]),
+                ("2030-01-07T15:00:00", [tarde.id]),
+            ],
+        )
+
+    def test_query_count_does_not_depend_on_doctors(self):
+        self.get()
+        with CaptureQueriesContext(connection) as pocos:
+            self.get()
+        for i in range(10, 15):
+            self.crear_doctor(i, dt_time(9, 0))
+        with CaptureQueriesContext(connection) as muchos:
+            self.get()
+        self.assertEqual(len(pocos.captured_queries), len(muchos.captured_queries))
+
+
+class ProximaDisponibilidadTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.paciente = self.create_user("auth0|paciente").paciente_profile
+        self.procedimiento = Procedimiento.objects.create(
+            nombre="Control", duracion_min=60
+        )
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        self.doctor.procedimientos.add(self.procedimiento)
+        template = HorarioSemanalTemplate.objects.create(
+            doctor=self.doctor, nombre="Lunes", es_activo=True
+        )
+        HorarioTemplateItem.objects.create(
+            template=template,
+            dia_semana=0,
+            hora_inicio=dt_time(9, 0),
+            hora_fin=dt_time(11, 0),
+        )
+        # Lunes 2030-01-07 a las 08:00
+        self.desde = timezone.make_aware(datetime(2030, 1, 7, 8, 0))
+
+    def test_returns_first_k_slots_in_order(self):
+        slots = proximos_slots([self.doctor.id], 60, 3, self.desde)
+        self.assertEqual(
+            [inicio.isoformat() for inicio, _, _ in slots],
+            ["2030-01-07T09:00:00", "2030-01-07T10:00:00", "2030-01-14T09:00:00"],
+        )
+
+    def test_stops_at_first_window_when_possible(self):
+        with CaptureQueriesContext(connection) as ctx:
+            proximos_slots([self.doctor.id], 60, 1, self.desde)
+        # ítems de plantilla + reservas y temporales de la primera ventana
+        self.assertEqual(len(ctx.captured_queries), 3)
+
+    def test_skips_booked_weeks(self):
+        for semana in range(4):
+            for hora in (9, 10):
+                Reserva.objects.create(
+                    paciente=self.paciente,
+                    doctor=self.doctor,
+                    fecha_hora=self.desde + timedelta(weeks=semana, hours=hora - 8),
+                    duracion_min=60,
+                )
+        slots = proximos_slots([self.doctor.id], 60, 1, self.desde)
+        self.assertEqual(slots[0][0].isoformat(), "2030-02-04T09:00:00")
+
+    def test_endpoint(self):
+        self.authenticate("auth0|paciente")
+        response = self.client.get(
+            "/api/reservas/proxima-disponibilidad/",
+            {"procedimiento_id": self.procedimiento.id, "k": 2},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["slots_disponibles"]), 2)
+        self.assertEqual(
+            response.data["slots_disponibles"][0]["doctor_id"], self.doctor.id
+        )
+
+
+class DashboardStatsTest(APITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.create_user("auth0|admin", role="admin")
+        self.doctor = self.create_user("auth0|doctor", role="doctor").doctor_profile
+        otro = self.create_user("auth0|otro", role="doctor").doctor_profile
+        pacientes = [
+            self.create_user(f"auth0|paciente{i}").paciente_profile for i in range(3)
+        ]
+        hoy = timezone.localtime().replace(hour=9, minute=0, second=0, microsecond=0)
+        self.lunes = hoy - timedelta(days=hoy.weekday())
+        for paciente, doctor, dias, estado in [
+            (pacientes[0], self.doctor, 0, "pendiente"),
+            (pacientes[0], self.doctor, 7, "pendiente"),
+            (pacientes[1], self.doctor, 1, "confirmada"),
+            (pacientes[1], self.doctor, -7, "cancelada"),
+            (pacientes[2], otro, 2, "pendiente"),
+        ]:
+            Reserva.objects.create(
+                paciente=paciente,
+                doctor=doctor,
+                fecha_hora=self.lunes + timedelta(days=dias),
+                estado=estado,
+            )
+
+    def test_admin_stats(self):
+        # admin_stats cuenta la semana desde hoy
+        with mock.patch("appointments.api.reservas_views.now", return_value=self.lunes):
+            self.authenticate("auth0|admin")
+            response = self.client.get("/api/admin/stats/")
+        self.assertEqual(
+            response.data,
+            {"citas_pendientes": 3, "citas_semana": 2, "total_pacientes": 3},
+        )
+        with self.assertNumQueries(1):
+            estadisticas.resumen_admin(self.lunes.date(), self.lunes.date())
+
+    def test_doctor_stats(self):
+        with mock.patch.object(timezone, "now", return_value=self.lunes):
+            self.authenticate("auth0|doctor")
+            response = self.client.get("/api/doctor/stats/")
+        self.assertEqual(
+            response.data,
+            {"citas_pendientes": 2, "citas_semana": 2, "total_pacientes": 2},
+        )
+        with self.assertNumQueries(1):
+            estadisticas.resumen_doctor(
+                self.doctor.id, self.lunes.date(), self.lunes.date()
+            )
+
+    def series(self, usuario, **params):
+        self.authenticate(usuario)
+        inicio = self.lunes.date() - timedelta(days=7)
+        return self.client.get(
+            "/api/stats/series/",
+            {
+                "start_date": inicio.isoformat(),
+                "end_date": (inicio + timedelta(days=20)).isoformat(),
+                **params,
+            },
+        )
+
+    def test_series_by_week(self):
+        response = self.series("auth0|admin", agrupar="semana")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        series = response.data["series"]
+        self.assertEqual([p["total"] for p in series], [1, 3, 1])
+        self.assertEqual(series[1]["periodo"], self.lunes.date().isoformat())
+        self.assertEqual(
+            series[1]["por_estado"],
+            {"pendiente": 2, "confirmada": 1, "cancelada": 0},
+        )
+        self.assertEqual(
+            series[1]["por_procedimiento"], [{"procedimiento_id": None, "total": 3}]
+        )
+        # Un doctor solo ve su agenda, aunque pida otra
+        response = self.series("auth0|doctor", agrupar="semana", doctor_id=0)
+        self.assertEqual([p["total"] for p in response.data["series"]], [1, 2, 1])
+
+    def test_series_by_day_is_cached(self):
+        response = self.series("auth0|doctor")
+        self.assertEqual(len(response.data["series"]), 21)
+        self.assertEqual(response.data["series"][7]["total"], 1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.series("auth0|doctor").data, response.data)
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_series_validation(self):
+        self.assertEqual(
+            self.series("auth0|paciente0").status_code, status.HTTP_403_FORBIDDEN
+        )
+        self.assertEqual(
+            self.series("auth0|admin", agrupar="mes").status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class ContadoresTest(HorarioDiarioMixin, TestCase):
+    def contadores(self):
+        return {
+            "dias": {
+                (fila.fecha, fila.estado): fila.total
+                for fila in ContadorReservas.objects.filter(doctor=self.doctor)
+                if fila.total
+            },
+            "pacientes": {
+                fila.paciente_id: fila.total
+                for fila in ContadorPacientes.objects.filter(doctor=self.doctor)
+                if fila.total
+            },
+        }
+
+    def assertCoincideConReconstruccion(self):
+        mantenidos = self.contadores()
+        call_command("reconstruir_contadores", stdout=open(os.devnull, "w"))
+        self.assertEqual(mantenidos, self.contadores())
+
+    def test_create_move_cancel_and_delete(self):
+        pasado = self.manana + timedelta(days=1)
+        reserva = self.reservar(self.manana, 9)
+        otro = self.create_user("auth0|otro").paciente_profile
+        Reserva.objects.create(
+            paciente=otro, doctor=self.doctor, fecha_hora=reserva.fecha_fin
+        )
+        self.assertEqual(
+            self.contadores(),
+            {
+                "dias": {(self.manana, "pendiente"): 2},
+                "pacientes": {self.paciente.id: 1, otro.id: 1},
+            },
+        )
+
+        reserva.fecha_hora += timedelta(days=1)
+        reserva.estado = "confirmada"
+        reserva.save()
+        reserva.estado = "cancelada"
+        reserva.save()
+        self.assertEqual(
+            self.contadores()["dias"],
+            {(self.manana, "pendiente"): 1, (pasado, "cancelada"): 1},
+        )
+        self.assertCoincideConReconstruccion()
+
+        Reserva.objects.get(pk=reserva.pk).delete()
+        self.assertEqual(
+            self.contadores(),
+            {"dias": {(self.manana, "pendiente"): 1}, "pacientes": {otro.id: 1}},
+        )
+
+    def test_bulk_state_change(self):
+        ids = [self.reservar(self.manana, hora).id for hora in (9, 10, 11)]
+        self.authenticate("auth0|doctor")
+        self.client.post(
+            "/api/reservas/estado/",
+            {"ids": ids[:2], "estado": "confirmada"},
+            format="json",
+        )
+        self.assertEqual(
+            self.contadores()["dias"],
+            {(self.manana, "pendiente"): 1, (self.manana, "confirmada"): 2},
+        )
+        self.assertCoincideConReconstruccion()
+
+    def test_cancel_rolls_back_with_counters(self):
+        reserva = self.reservar(self.manana, 9)
+        self.authenticate("auth0|paciente")
+        with mock.patch(
+            "appointments.signals.ajustar_contadores", side_effect=RuntimeError
+        ):
+            with self.assertRaises(RuntimeError):
+                self.client.patch(
+                    f"/api/reservas/{reserva.id}/",
+                    {"estado": "cancelada"},
+                    format="json",
+                )
+        reserva.refresh_from_db()
+        self.assertEqual(reserva.estado, "pendiente")
+        self.assertCoincideConReconstruccion()
+
+    def test_stats_read_counters(self):
+        self.reservar(self.manana, 9)
+        with CaptureQueriesContext(connection) as ctx:
+            estadisticas.resumen_doctor(self.doctor.id, self.manana, self.manana)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        # Solo la subconsulta de las pendientes de hoy toca Reserva
+        self.assertIn("fecha_hora", ctx.captured_queries[0]["sql"])
+        self.assertNotIn("COUNT(DISTINCT", ctx.captured_queries[0]["sql"].upper())
+
+
+class UtilizacionTest(HorarioDiarioMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Lunes de la semana próxima; plantilla de 180 minutos diarios
+        hoy = timezone.localdate()
+        self.lunes = hoy + timedelta(days=7 - hoy.weekday())
+        self.reservar(self.lunes, 9, procedimiento=self.procedimiento)
+        self.reservar(self.lunes + timedelta(days=8), 10)
+        self.reservar(self.lunes, 11, estado="cancelada")
+
+    def get_utilizacion(self, start_date, end_date, usuario="auth0|doctor"):
+        self.authenticate(usuario)
+        return self.client.get(
+            "/api/stats/utilizacion/",
+            {"start_date": start_date.isoformat(), "end_date": end_date.isoformat()},
+        )
+
+    def test_booked_over_template_minutes(self):
+        with self.assertNumQueries(2):
+            datos = estadisticas.utilizacion(
+                self.lunes, self.lunes + timedelta(days=13)
+            )
+        self.assertEqual(
+            datos["total"],
+            {"capacidad_min": 14 * 180, "reservados_min": 120, "utilizacion": 0.0476},
+        )
+        (doctor,) = datos["doctores"]
+        self.assertEqual(
+            [(s["semana"], s["reservados_min"]) for s in doctor["semanas"]],
+            [
+                (self.lunes.isoformat(), 60),
+                ((self.lunes + timedelta(days=7)).isoformat(), 60),
+            ],
+        )
+        self.assertEqual(
+            {
+                p["procedimiento_id"]: p["reservados_min"]
+                for p in doctor["procedimientos"]
+            },
+            {self.procedimiento.id: 60, None: 60},
+        )
+
+    def test_partial_weeks_only_count_days_in_range(self):
+        response = self.get_utilizacion(
+            self.lunes + timedelta(days=5), self.lunes + timedelta(days=8)
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        semanas = response.data["doctores"][0]["semanas"]
+        self.assertEqual([s["capacidad_min"] for s in semanas], [2 * 180, 2 * 180])
+        self.assertEqual(response.data["total"]["reservados_min"], 60)
+
+    def test_cached_and_scoped(self):
+        self.create_user("auth0|otro", role="doctor")
+        primera = self.get_utilizacion(self.lunes, self.lunes)
+        self.assertEqual(primera.data["doctor_id"], self.doctor.id)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                self.get_utilizacion(self.lunes, self.lunes).data, primera.data
+            )
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(
+            self.get_utilizacion(self.lunes, self.lunes, "auth0|paciente").status_code,
+            status.HTTP_403_FORBIDDEN,
+        )
+
+
+class AplicarPlantillaTest(HorarioDiarioMixin, TestCase):
+    def aplicar(self, template, **extra):
+        self.authenticate("auth0|doctor")
+        return self.client.post(
+            f"/api/horarios-semanales/{template.id}/aplicar_a_doctor/",
+            {"doctor_id": self.doctor.id, **extra},
+        )
+
+    def test_full_mode_inserts_in_one_query(self):
+        HorarioDoctor.objects.create(
+            doctor=self.doctor,
+            dia_semana=0,
+            hora_inicio=dt_time(18, 0),
+            hora_fin=dt_time(19, 0),
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.aplicar(self.template)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["horarios_actualizados"]), 7)
+        self.assertEqual(
+            (response.data["creados"], response.data["eliminados"]), (7, 1)
+        )
+        self.assertEqual(
+            sum(
+                q["sql"].startswith("INSERT") and "horariodoctor" in q["sql"]
+                for q in ctx.captured_queries
+            ),
+            1,
+        )
+        self.assertEqual(HorarioDoctor.objects.filter(doctor=self.doctor).count(), 7)
+
+    def test_activar_only_touches_changed_blocks(self):
+        self.aplicar(self.template)
+        anteriores = dict(
+            HorarioDoctor.objects.filter(doctor=self.doctor).values_list(
+                "dia_semana", "pk"
+            )
+        )
+        HorarioDoctor.objects.filter(pk=anteriores[1]).update(activo=False)
+        parecida = HorarioSemanalTemplate.objects.create(
+            doctor=self.doctor, nombre="Lunes largo"
+        )
+        # Lunes hasta las 13:00, tarde extra el miércoles y sin domingo
+        bloques = [(dia, 9, 13 if dia == 0 else 12) for dia in range(6)]
+        for dia, inicio, fin in bloques + [(2, 15, 17)]:
+            HorarioTemplateItem.objects.create(
+                template=parecida,
+                dia_semana=dia,
+                hora_inicio=dt_time(inicio, 0),
+                hora_fin=dt_time(fin, 0),
+            )
+
+        self.authenticate("auth0|doctor")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                f"/api/horarios-semanales/{parecida.id}/activar/",
+                {"doctor_id": self.doctor.id},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["modo"], "diferencial")
+        self.assertEqual(
+            (
+                response.data["creados"],
+                response.data["actualizados"],
+                response.data["eliminados"],
+            ),
+            (1, 2, 1),
+        )
+        self.assertEqual(
+            sum(
+                q["sql"].startswith("UPDATE") and "horariodoctor" in q["sql"]
+                for q in ctx.captured_queries
+            ),
+            1,
+        )
+        horarios = HorarioDoctor.objects.filter(doctor=self.doctor)
+        self.assertTrue(all(h.activo for h in horarios))
+        # El lunes se actualiza en su fila; solo el domingo se borra
+        self.assertEqual(
+            {h.dia_semana: h.pk for h in horarios.filter(hora_inicio=dt_time(9, 0))},
+            {dia: pk for dia, pk in anteriores.items() if dia != 6},
+        )
+        self.assertEqual(horarios.get(dia_semana=0).hora_fin, dt_time(13, 0))
+        self.assertEqual(
+            [h["dia_semana"] for h in response.data["horarios_actualizados"]],
+            [0, 1, 2, 2, 3, 4, 5],
+        )
+
+    def test_invalid_activation_changes_nothing(self):
+        parecida = HorarioSemanalTemplate.objects.create(
+            doctor=self.doctor, nombre="Otra"
+        )
+        self.authenticate("auth0|doctor")
+        for datos in ({"doctor_id": self.doctor.id, "modo": "parcial"}, {}):
+            response = self.client.post(
+                f"/api/horarios-semanales/{parecida.id}/activar/", datos
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.template.refresh_from_db()
+        parecida.refresh_from_db()
+        self.assertTrue(self.template.es_activo)
+        self.assertFalse(parecida.es_activo)
+
+    def test_invalid_modo(self):
+        response = self.aplicar(self.template, modo="parcial")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -11,11 +11,15 @@ from .views import (
     whoami,
     admin_stats,
     DisponibilidadView,
+    DisponibilidadProcedimientoView,
+    ProximaDisponibilidadView,
     CustomUserViewSet,
     HorarioSemanalTemplateViewSet,
     doctor_stats,
     doctor_reservas,
     update_profile,
+    stats_series,
+    stats_utilizacion,
 )
 from .views import admin_stats
 
@@ -34,6 +38,16 @@ urlpatterns = [
     path(
         "reservas/disponibilidad/", DisponibilidadView.as_view(), name="disponibilidad"
     ),
+    path(
+        "reservas/disponibilidad/procedimiento/",
+        DisponibilidadProcedimientoView.as_view(),
+        name="disponibilidad_procedimiento",
+    ),
+    path(
+        "reservas/proxima-disponibilidad/",
+        ProximaDisponibilidadView.as_view(),
+        name="proxima_disponibilidad",
+    ),
     path("", include(router.urls)),
     path(
         "pacientes/by_email/<str:email>/",
@@ -44,6 +58,8 @@ urlpatterns = [
     path("whoami/", whoami, name="whoami"),
     path("admin/stats/", admin_stats, name="admin_stats"),
     path("doctor/stats/", doctor_stats, name="doctor_stats"),
+    path("stats/series/", stats_series, name="stats_series"),
+    path("stats/utilizacion/", stats_utilizacion, name="stats_utilizacion"),
     path("doctor/reservas/", doctor_reservas, name="doctor_reservas"),
     path("profile/update/", update_profile, name="update_profile"),
 ]
@@ -8,5 +8,13 @@ from .api.doctor_views import (
     doctor_reservas,
     ProcedimientoViewSet,
 )
-from .api.reservas_views import ReservaViewSet, DisponibilidadView, admin_stats
+from .api.reservas_views import (
+    ReservaViewSet,
+    DisponibilidadView,
+    DisponibilidadProcedimientoView,
+    ProximaDisponibilidadView,
+    admin_stats,
+    stats_series,
+    stats_utilizacion,
+)
 from .api.templates_views import HorarioSemanalTemplateViewSet, HorarioDoctorViewSet
@@ -53,11 +53,68 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
 }
 
+# Paginación por cursor de reservas, pacientes y doctores (appointments/pagination.py)
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# Rango máximo (en días) que acepta reservas/disponibilidad/
+DISPONIBILIDAD_MAX_DIAS = 92
+# Horizonte (en días) de la búsqueda de próxima disponibilidad
+PROXIMA_DISPONIBILIDAD_DIAS = 180
+# Duración máxima (minutos) de una reserva; acota la consulta de solapes (appointments/agenda.py)
+RESERVA_MAX_DURACION_MIN = 480
+# Segundos que un paciente retiene un horario mientras confirma (reservas/retener/)
+RESERVA_TEMPORAL_TTL = 300
+# Intervalo mínimo (segundos) entre barridos de reservas temporales vencidas
+RESERVA_TEMPORAL_BARRIDO = 60
+# Máximo de reservas por petición en reservas/estado/ (cambio de estado en lote)
+RESERVA_ESTADO_MAX_LOTE = 500
+# Segundos que se recuerda la respuesta de una petición con Idempotency-Key
+IDEMPOTENCIA_TTL = 24 * 60 * 60
+# Segundos tras los que una petición con Idempotency-Key aún "en curso" se da por abandonada
+IDEMPOTENCIA_EN_CURSO_TTL = 60
+# Intervalo mínimo (segundos) entre barridos de claves de idempotencia vencidas
+IDEMPOTENCIA_BARRIDO = 600
+# Rango máximo (días) y TTL (segundos) del cache de stats/series/ y stats/utilizacion/
+ESTADISTICAS_MAX_DIAS = 366
+ESTADISTICAS_CACHE_TTL = 60
+# Días que cubre la disponibilidad materializada (DisponibilidadDia)
+DISPONIBILIDAD_HORIZONTE_DIAS = 90
+# Bloques por doctor a partir de los cuales se usa el camino vectorizado (si hay NumPy; ver bench_disponibilidad)
+DISPONIBILIDAD_NUMPY_MIN_BLOQUES = 128
+
 AUTH0_DOMAIN = "dev-i0gse8er5ywneiwa.us.auth0.com"  # ej: dev-xxxx.us.auth0.com
 API_IDENTIFIER = (
     "https://sanitasoris/api"  # igual al "Audience" que usas en getAccessTokenSilently
 )
 ALGORITHMS = ["RS256"]
+# Cache del JWKS de Auth0 (segundos). AUTH0_JWKS_FILE permite cargar las llaves
+# desde un archivo local en lugar de descargarlas (útil para pruebas offline).
+AUTH0_JWKS_TTL = 3600
+AUTH0_JWKS_REFRESH_MARGIN = 300
+AUTH0_JWKS_FILE = None
+# Número máximo de tokens verificados que se mantienen en memoria.
+AUTH0_TOKEN_CACHE_SIZE = 1024
+
+# Cache de auth0_id -> rol/perfiles (ver appointments/principal.py). Con
+# PRINCIPAL_CACHE_ALIAS se usa ese alias de CACHES en lugar de memoria local.
+PRINCIPAL_CACHE_TTL = 300
+PRINCIPAL_CACHE_SIZE = 2048
+PRINCIPAL_CACHE_ALIAS = None
+
+# Cache de Django. En local basta la memoria del proceso; en producción con
+# varios workers conviene un backend compartido (Redis, Memcached o
+# FileBasedCache) para que las invalidaciones lleguen a todos.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "sanitasoris",
+    }
+}
+
+# Cache de slots de reservas/disponibilidad/ (ver appointments/disponibilidad_cache.py)
+DISPONIBILIDAD_CACHE_ALIAS = "default"
+DISPONIBILIDAD_CACHE_TTL = 600
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
@@ -107,6 +164,10 @@ WSGI_APPLICATION = "sanitasoris.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Con SQLite las reservas se protegen entre procesos con el bloqueo de escritura
+# de toda la base (appointments/agenda.py), así que las escrituras de agenda de
+# todos los doctores se serializan. Con varios workers en producción conviene
+# PostgreSQL, que bloquea solo la agenda de cada doctor.
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",